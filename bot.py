@@ -50,9 +50,10 @@ except Exception:
  WAITING_HABIT_TITLE, WAITING_HABIT_DESCRIPTION) = range(9)
 
 WEBAPP_URL = os.getenv("WEBAPP_URL")
+DB_PATH = os.getenv("DB_PATH", "goals_bot.db")
 
-# Инициализация базы данных
-db = Database()
+# Инициализация базы данных (PRAGMA и пул — см. StorageSettings в database.py)
+db = Database(DB_PATH)
 
 
 def _webapp_url() -> str:
@@ -531,8 +532,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return WAITING_HABIT_TITLE
     elif data.startswith("toggle_habit_"):
         habit_id = int(data.split("_")[2])
-        today = date.today().isoformat()
-        completed = await db.toggle_habit_record(habit_id, today)
+        completed = await db.toggle_habit_record(habit_id)
         status = "✅ Выполнено!" if completed else "❌ Отменено"
         await query.edit_message_text(f"{status}\n\nПривычка отмечена на сегодня.")
         await show_habit_detail(update, context, habit_id)
@@ -930,10 +930,17 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def post_init(application: Application) -> None:
     """Инициализация базы данных при запуске приложения"""
+    await db.open()
     await db.init_db()
+    db.start_wal_checkpointer("bot")
     logger.info("База данных инициализирована")
 
 
+async def post_shutdown(application: Application) -> None:
+    """Закрытие пула соединений с БД при остановке бота"""
+    await db.close()
+
+
 def main():
     """Главная функция запуска бота"""
     # Получение токена из переменных окружения
@@ -943,7 +950,7 @@ def main():
         return
     
     # Создание приложения
-    application = Application.builder().token(token).post_init(post_init).build()
+    application = Application.builder().token(token).post_init(post_init).post_shutdown(post_shutdown).build()
     
     # ConversationHandler для добавления элементов (per_message=False по умолчанию — предупреждение подавлено выше)
     conv_handler = ConversationHandler(
@@ -0,0 +1,363 @@
+"""
+Выгрузка привычек, целей и подцелей в Google Календарь фоновой задачей.
+
+POST /api/user/{id}/calendar-sync только ставит задачу и сразу отвечает; запросы к Calendar API идут
+в фоне — параллельно, но не больше CALENDAR_SYNC_CONCURRENCY одновременно, через общий
+клиент google_api (http_clients.py). Ход задачи мини-приложение опрашивает через
+GET /api/user/{id}/calendar-sync/status. У пользователя одна задача за раз; задачи живут в памяти
+процесса веб-сервера (он один), завершённые забываются через CALENDAR_SYNC_JOB_TTL_SEC.
+
+Выгрузка инкрементальная: в calendar_event_map по (пользователь, kind, local_id) хранится id события
+в Google и хеш его тела при последней выгрузке. Новые записи создаются (POST), изменившиеся —
+перезаписываются (PUT), события удалённых или завершённых записей удаляются (DELETE) — только для
+включённых в настройках видов; совпавшие по хешу не трогаются, поэтому повторная выгрузка без
+изменений не делает ни одного запроса. Проверка на фейковом API: scripts/check_calendar_sync.py.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+
+from database import Database
+
+CALENDAR_EVENTS_URL = os.getenv(
+    "GOOGLE_CALENDAR_EVENTS_URL", "https://www.googleapis.com/calendar/v3/calendars/primary/events"
+)
+CALENDAR_SYNC_CONCURRENCY = int(os.getenv("CALENDAR_SYNC_CONCURRENCY", "5"))
+CALENDAR_SYNC_JOB_TTL_SEC = int(os.getenv("CALENDAR_SYNC_JOB_TTL_SEC", "3600"))
+MAX_ATTEMPTS = 3  # попыток на запрос при 429/5xx и сетевых ошибках
+
+# Вид события → флаг в calendar_sync_settings
+CALENDAR_KINDS = {"habit": "sync_habits", "goal": "sync_goals", "subgoal": "sync_subgoals"}
+
+# (kind, local_id, метка для ошибок, тело события)
+CalendarEvent = Tuple[str, int, str, Dict]
+
+logger = logging.getLogger(__name__)
+
+
+def habit_suggested_time(title: str, index: int) -> tuple:
+    """
+    Определяет рекомендуемое время для привычки по названию.
+    Возвращает (hour, minute). index — постоянный номер привычки (её id), а не место в списке:
+    время не сдвигается, когда другие привычки добавляют или удаляют. Разносит привычки по дню (6–22 ч).
+    """
+    t = (title or "").lower()
+    # Вода: равномерно в течение дня — 8, 11, 14, 17, 20
+    if any(x in t for x in ["вод", "воды", "пить", "воду"]):
+        slots = [(8, 0), (11, 0), (14, 0), (17, 0), (20, 0)]
+        h, m = slots[index % len(slots)]
+        return h, m
+    # Утренние: зарядка, спорт, витамины — 6:30–8:30
+    if any(x in t for x in ["зарядк", "спорт", "упражнен", "витамин", "утр", "таблет", "разминк"]):
+        return 7 + (index % 2), 0 if index % 2 == 0 else 30
+    # Вечерние: чтение, медитация, дневник, сон — 20–22
+    if any(x in t for x in ["чита", "книг", "медитац", "дневник", "сон", "спат", "отдых", "расслаб"]):
+        return 20 + (index % 3), 0
+    # Дневные: прогулка, ходьба, растяжка — 12, 18
+    if any(x in t for x in ["прогулк", "ходьб", "растяжк"]):
+        return 12 if index % 2 == 0 else 18, 0
+    # По умолчанию: 8–20, соседние номера — через 5 часов
+    return 8 + (index * 5) % 13, 0
+
+
+def build_calendar_events(
+    settings: Dict,
+    habits: List[Dict],
+    goals: List[Dict],
+    missions: List[Dict],
+    subgoals: Dict[int, List[Dict]],
+    today: str,
+    tz: str,
+) -> List[CalendarEvent]:
+    """События календаря по настройкам выгрузки; без обращений к БД и сети.
+    Тело события зависит только от самой записи (ежедневная серия привычки начинается с дня её создания,
+    а не с дня выгрузки, время берётся по id, а не по месту в списке), чтобы хеш не менялся от одной
+    выгрузки к другой и от добавления или удаления соседних записей."""
+    events: List[CalendarEvent] = []
+    if settings.get("sync_habits", True):
+        for h in habits:
+            title = (h.get("title") or "").strip() or "Привычка"
+            hour, minute = habit_suggested_time(title, h["id"])
+            end_h = hour + 1 if minute == 30 else hour
+            end_m = 30 if minute == 0 else 0
+            day = str(h.get("created_at") or today)[:10]
+            events.append(("habit", h["id"], f"habit {title}", {
+                "summary": f"Привычка: {title}",
+                "description": "Из приложения «Твои цели»",
+                "start": {"dateTime": f"{day}T{hour:02d}:{minute:02d}:00", "timeZone": tz},
+                "end": {"dateTime": f"{day}T{end_h:02d}:{end_m:02d}:00", "timeZone": tz},
+                "recurrence": ["RRULE:FREQ=DAILY"],
+            }))
+    if settings.get("sync_goals", True):
+        for g in goals:
+            title = (g.get("title") or "").strip() or "Цель"
+            if not g.get("deadline"):
+                continue
+            dl_str = str(g["deadline"])[:10]
+            events.append(("goal", g["id"], f"goal {title}", {
+                "summary": f"Цель: {title}",
+                "description": (g.get("description") or "")[:500] or "Из приложения «Твои цели»",
+                "start": {"dateTime": f"{dl_str}T09:00:00", "timeZone": tz},
+                "end": {"dateTime": f"{dl_str}T10:00:00", "timeZone": tz},
+            }))
+    if settings.get("sync_subgoals", True):
+        for m in missions:
+            if not m.get("deadline"):
+                continue
+            dl_str = str(m["deadline"])[:10]
+            mtitle = (m.get("title") or "").strip() or "Миссия"
+            for sg in subgoals.get(m.get("id"), []):
+                sgtitle = (sg.get("title") or "").strip() or "Подцель"
+                hour = 9 + (sg["id"] % 8)
+                events.append(("subgoal", sg["id"], f"subgoal {sgtitle}", {
+                    "summary": f"{mtitle}: {sgtitle}",
+                    "description": "Из приложения «Твои цели»",
+                    "start": {"dateTime": f"{dl_str}T{hour:02d}:00:00", "timeZone": tz},
+                    "end": {"dateTime": f"{dl_str}T{hour:02d}:30:00", "timeZone": tz},
+                }))
+    return events
+
+
+async def load_calendar_events(db: Database, user_id: int, settings: Dict, today: str, tz: str) -> List[CalendarEvent]:
+    """Данные для выгрузки несколькими запросами (подцели всех миссий — одним) и события по ним."""
+    habits = await db.get_habits(user_id, active_only=True) if settings.get("sync_habits", True) else []
+    goals = await db.get_goals(user_id, include_completed=False) if settings.get("sync_goals", True) else []
+    missions, subgoals = [], {}
+    if settings.get("sync_subgoals", True):
+        missions = [m for m in await db.get_missions(user_id, include_completed=False) if m.get("deadline")]
+        subgoals = await db.get_subgoals_for_missions([m["id"] for m in missions])
+    return build_calendar_events(settings, habits, goals, missions, subgoals, today, tz)
+
+
+def synced_kinds(settings: Dict) -> Tuple[str, ...]:
+    """Виды событий, включённые в настройках: лишние события удаляются только среди них."""
+    return tuple(kind for kind, flag in CALENDAR_KINDS.items() if settings.get(flag, True))
+
+
+def event_hash(event: Dict) -> str:
+    """Хеш тела события (ключи по порядку) — для сравнения с последней выгрузкой."""
+    data = json.dumps(event, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
+
+
+@dataclass
+class CalendarSyncJob:
+    """Задача выгрузки одного пользователя; to_dict() — ответ /calendar-sync/status."""
+    user_id: int
+    id: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+    status: str = "queued"  # queued → running → done | failed
+    total: int = 0  # запросов к Calendar API по плану
+    done: int = 0
+    created: int = 0
+    updated: int = 0
+    deleted: int = 0
+    unchanged: int = 0  # совпали по хешу — без запросов
+    unauthorized: bool = False  # Google ответил 401 — токен недействителен
+    errors: List[str] = field(default_factory=list)
+    detail: Optional[str] = None
+    started_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def to_dict(self) -> Dict:
+        out = {
+            "job_id": self.id,
+            "status": self.status,
+            "total": self.total,
+            "done": self.done,
+            "created": self.created,
+            "updated": self.updated,
+            "deleted": self.deleted,
+            "unchanged": self.unchanged,
+            "errors": self.errors[:10],
+            "elapsed": round((self.finished_at or time.time()) - self.started_at, 2),
+        }
+        if self.detail:
+            out["detail"] = self.detail
+        # Если все запросы завершились ошибкой — подсказка по 403
+        if self.finished and self.created + self.updated + self.deleted == 0 and any("403" in e for e in self.errors):
+            out["hint"] = (
+                "403 Forbidden: Включите Google Calendar API в Google Cloud Console и "
+                "отключите/подключите Google в настройках (чтобы получить доступ к календарю)."
+            )
+        return out
+
+
+async def _request(
+    client: httpx.AsyncClient, method: str, url: str, headers: Dict, label: str, job: CalendarSyncJob,
+    event: Optional[Dict] = None,
+) -> Optional[httpx.Response]:
+    """Запрос с повторами при 429/5xx и сетевых ошибках. Ответ с другим кодом возвращается вызывающему;
+    None — повторы исчерпаны (ошибка уже записана в job)."""
+    error = None
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            r = await client.request(method, url, json=event, headers=headers)
+        except httpx.HTTPError as e:
+            error = f"{label}: {e}"
+            await asyncio.sleep(attempt)
+            continue
+        if r.status_code == 429 or r.status_code >= 500:
+            error = f"{label}: {r.status_code}"
+            await asyncio.sleep(attempt)
+            continue
+        return r
+    job.errors.append(error)
+    return None
+
+
+def _failed(r: httpx.Response, label: str, job: CalendarSyncJob) -> None:
+    if r.status_code == 401:
+        job.unauthorized = True
+    logger.warning("Calendar API %s: %s %s", label, r.status_code, (r.text or "")[:200])
+    job.errors.append(f"{label}: {r.status_code}")
+
+
+async def sync_events(
+    db: Database,
+    client: httpx.AsyncClient,
+    access_token: str,
+    user_id: int,
+    events: Sequence[CalendarEvent],
+    job: CalendarSyncJob,
+    kinds: Sequence[str] = tuple(CALENDAR_KINDS),
+    concurrency: int = CALENDAR_SYNC_CONCURRENCY,
+    url: str = CALENDAR_EVENTS_URL,
+) -> None:
+    """Привести календарь к events по calendar_event_map: создать новые, перезаписать изменившиеся и удалить
+    лишние события видов kinds — не больше concurrency запросами одновременно; ход — в job.
+    Соответствие сохраняется и при ошибке или отмене — по тем запросам, что успели пройти."""
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+    known = await db.get_calendar_event_map(user_id)
+    wanted = set()
+    ops: List[Callable[[], Awaitable[None]]] = []
+    upserts: List[Tuple[str, int, str, str]] = []
+    deletes: List[Tuple[str, int]] = []
+
+    async def insert(kind: str, local_id: int, label: str, event: Dict, digest: str) -> None:
+        r = await _request(client, "POST", url, headers, label, job, event)
+        if r is None:
+            return
+        if r.status_code not in (200, 201):
+            _failed(r, label, job)
+            return
+        upserts.append((kind, local_id, r.json()["id"], digest))
+        job.created += 1
+
+    async def update(kind: str, local_id: int, label: str, event: Dict, digest: str, event_id: str) -> None:
+        r = await _request(client, "PUT", f"{url}/{event_id}", headers, label, job, event)
+        if r is None:
+            return
+        if r.status_code in (404, 410):
+            # Событие удалили в самом календаре — создаём заново
+            await insert(kind, local_id, label, event, digest)
+            return
+        if r.status_code != 200:
+            _failed(r, label, job)
+            return
+        upserts.append((kind, local_id, event_id, digest))
+        job.updated += 1
+
+    async def delete(kind: str, local_id: int, event_id: str) -> None:
+        label = f"{kind} #{local_id}"
+        r = await _request(client, "DELETE", f"{url}/{event_id}", headers, label, job)
+        if r is None:
+            return
+        if r.status_code not in (200, 204, 404, 410):
+            _failed(r, label, job)
+            return
+        deletes.append((kind, local_id))
+        job.deleted += 1
+
+    for kind, local_id, label, event in events:
+        key = (kind, local_id)
+        wanted.add(key)
+        digest = event_hash(event)
+        mapped = known.get(key)
+        if mapped is None:
+            ops.append(lambda a=(kind, local_id, label, event, digest): insert(*a))
+        elif mapped[1] != digest:
+            ops.append(lambda a=(kind, local_id, label, event, digest, mapped[0]): update(*a))
+        else:
+            job.unchanged += 1
+    for (kind, local_id), (event_id, _) in known.items():
+        if kind in kinds and (kind, local_id) not in wanted:
+            ops.append(lambda a=(kind, local_id, event_id): delete(*a))
+
+    limit = asyncio.Semaphore(max(1, concurrency))
+    job.total = len(ops)
+
+    async def one(op: Callable[[], Awaitable[None]]) -> None:
+        async with limit:
+            await op()
+            job.done += 1
+
+    try:
+        # Дожидаемся всех запросов, даже если какой-то упал, чтобы не потерять id уже созданных событий
+        results = await asyncio.gather(*(one(op) for op in ops), return_exceptions=True)
+    finally:
+        await db.save_calendar_event_map(user_id, upserts, deletes)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+class CalendarSyncJobs:
+    """Фоновые задачи выгрузки по пользователям (последняя задача пользователя)."""
+
+    def __init__(self, ttl: float = CALENDAR_SYNC_JOB_TTL_SEC):
+        self.ttl = ttl
+        self._jobs: Dict[int, CalendarSyncJob] = {}
+
+    def get(self, user_id: int) -> Optional[CalendarSyncJob]:
+        return self._jobs.get(user_id)
+
+    def start(self, user_id: int, run: Callable[[CalendarSyncJob], Awaitable[None]]) -> CalendarSyncJob:
+        """Запустить run(job) в фоне. Если у пользователя задача уже идёт — вернуть её, новую не ставить."""
+        job = self._jobs.get(user_id)
+        if job is not None and not job.finished:
+            return job
+        now = time.time()
+        self._jobs = {
+            uid: j for uid, j in self._jobs.items() if not j.finished or now - (j.finished_at or now) < self.ttl
+        }
+        job = CalendarSyncJob(user_id)
+        self._jobs[user_id] = job
+        job.task = asyncio.create_task(self._run(job, run))
+        return job
+
+    async def _run(self, job: CalendarSyncJob, run: Callable[[CalendarSyncJob], Awaitable[None]]) -> None:
+        job.status = "running"
+        try:
+            await run(job)
+            job.status = "done"
+        except Exception as e:
+            logger.exception("calendar sync user %s: %s", job.user_id, e)
+            job.status = "failed"
+            job.detail = str(e)
+        finally:
+            job.finished_at = time.time()
+            logger.info(
+                "calendar sync user %s: %s, создано %s, обновлено %s, удалено %s, без изменений %s за %.2f с",
+                job.user_id, job.status, job.created, job.updated, job.deleted, job.unchanged,
+                job.finished_at - job.started_at,
+            )
+
+    async def shutdown(self) -> None:
+        """Остановить незавершённые задачи (при остановке веб-сервера)."""
+        tasks = [j.task for j in self._jobs.values() if j.task is not None and not j.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
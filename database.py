@@ -1,16 +1,519 @@
+import asyncio
+import logging
+import math
+import os
+import sqlite3
 import aiosqlite
-from datetime import datetime
-from typing import List, Optional, Dict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import AsyncIterator, List, Optional, Dict, Sequence, Tuple
 import json
 
+from user_timezones import infer_timezone, valid_timezone, zone
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class StorageSettings:
+    """Настройки хранилища SQLite. Задаются переменными окружения рядом с DB_PATH:
+
+    DB_JOURNAL_MODE (WAL), DB_SYNCHRONOUS (NORMAL), DB_CACHE_SIZE_KB (16384),
+    DB_MMAP_SIZE_MB (64), DB_BUSY_TIMEOUT_MS (5000), DB_READERS (4),
+    DB_CHECKPOINT_PROCESS (reminder | webapp | bot | none) и DB_CHECKPOINT_INTERVAL_SEC (300).
+    """
+
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    cache_size_kb: int = 16384
+    mmap_size_mb: int = 64
+    busy_timeout_ms: int = 5000
+    readers: int = 4
+    checkpoint_process: str = "reminder"
+    checkpoint_interval_sec: int = 300
+
+    @classmethod
+    def from_env(cls) -> "StorageSettings":
+        return cls(
+            journal_mode=os.getenv("DB_JOURNAL_MODE", "WAL").strip().upper() or "WAL",
+            synchronous=os.getenv("DB_SYNCHRONOUS", "NORMAL").strip().upper() or "NORMAL",
+            cache_size_kb=int(os.getenv("DB_CACHE_SIZE_KB", "16384")),
+            mmap_size_mb=int(os.getenv("DB_MMAP_SIZE_MB", "64")),
+            busy_timeout_ms=int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000")),
+            readers=max(1, int(os.getenv("DB_READERS", "4"))),
+            checkpoint_process=os.getenv("DB_CHECKPOINT_PROCESS", "reminder").strip().lower(),
+            checkpoint_interval_sec=int(os.getenv("DB_CHECKPOINT_INTERVAL_SEC", "300")),
+        )
+
+
+# Ожидаемые значения счётчиков привычек, посчитанные с нуля по habit_records:
+# id, total_completions, current_streak (серия, заканчивающаяся last_done_date), longest_streak, last_done_date.
+# Серии — «острова» подряд идущих дат: julianday(date) - ROW_NUMBER() постоянен внутри серии.
+_HABIT_COUNTERS_SQL = """
+    WITH done AS (
+        SELECT habit_id, date,
+               julianday(date) - ROW_NUMBER() OVER (PARTITION BY habit_id ORDER BY date) AS grp
+        FROM habit_records
+        WHERE (completed = 1 OR count > 0){scope}
+    ), runs AS (
+        SELECT habit_id, COUNT(*) AS len, MAX(date) AS last_date FROM done GROUP BY habit_id, grp
+    ), totals AS (
+        SELECT habit_id, SUM(COALESCE(NULLIF(count, 0), 1)) AS total
+        FROM habit_records WHERE 1 = 1{scope} GROUP BY habit_id
+    )
+    SELECT h.id,
+           COALESCE(t.total, 0),
+           COALESCE((SELECT r.len FROM runs r WHERE r.habit_id = h.id ORDER BY r.last_date DESC LIMIT 1), 0),
+           COALESCE((SELECT MAX(r.len) FROM runs r WHERE r.habit_id = h.id), 0),
+           (SELECT MAX(r.last_date) FROM runs r WHERE r.habit_id = h.id)
+    FROM habits h LEFT JOIN totals t ON t.habit_id = h.id
+    {where}
+"""
+
+_HABIT_COUNTER_FIELDS = ("total_completions", "current_streak", "longest_streak", "last_done_date")
+
+
+# Обычное время выполнения привычки h за период (с даты-параметра): круговое среднее минут от полуночи
+# (время как угол на циферблате суток), чтобы 23:50 и 00:10 давали 00:00, а не 12:00. NULL — нет отметок
+# со временем. Подзапрос по индексу (habit_id, date): в снимке считается только для привычек, прошедших фильтры.
+_HABIT_MINUTES_EXPR = """(
+    SELECT CAST(round(atan2(SUM(sin(a)), SUM(cos(a))) * 1440 / 6.283185307179586) + 1440 AS INTEGER) % 1440
+    FROM (
+        SELECT CASE WHEN length(r.completed_at) >= 16  -- 'YYYY-MM-DD HH:MM[:SS[.ffffff]]': substr дешевле strftime
+                    THEN substr(r.completed_at, 12, 2) * 60 + substr(r.completed_at, 15, 2)
+                    ELSE CAST(strftime('%H', r.completed_at) AS INTEGER) * 60
+                         + CAST(strftime('%M', r.completed_at) AS INTEGER)
+               END * 6.283185307179586 / 1440 AS a
+        FROM habit_records r
+        WHERE r.habit_id = h.id AND r.date >= ? AND r.completed_at IS NOT NULL
+    )
+)"""
+
+
+def _null_safe(func):
+    return lambda *args: None if None in args else func(*args)
+
+
+async def _ensure_math_functions(conn: aiosqlite.Connection) -> None:
+    """sin/cos/atan2 для _HABIT_MINUTES_EXPR: встроены в SQLite >= 3.35 с SQLITE_ENABLE_MATH_FUNCTIONS,
+    иначе регистрируются из Python."""
+    try:
+        await conn.execute("SELECT sin(0), cos(0), atan2(0, 1)")
+    except sqlite3.OperationalError:
+        await conn.create_function("sin", 1, _null_safe(math.sin), deterministic=True)
+        await conn.create_function("cos", 1, _null_safe(math.cos), deterministic=True)
+        await conn.create_function("atan2", 2, _null_safe(math.atan2), deterministic=True)
+
+
+async def _compute_habit_counters(db: aiosqlite.Connection, habit_id: Optional[int] = None) -> List[tuple]:
+    """Пересчитать счётчики по habit_records: для одной привычки или для всех."""
+    if habit_id is None:
+        sql, params = _HABIT_COUNTERS_SQL.format(scope="", where=""), ()
+    else:
+        sql = _HABIT_COUNTERS_SQL.format(scope=" AND habit_id = ?", where="WHERE h.id = ?")
+        params = (habit_id, habit_id, habit_id)
+    async with db.execute(sql, params) as c:
+        return [tuple(row) for row in await c.fetchall()]
+
+
+async def _store_habit_counters(db: aiosqlite.Connection, rows: List[tuple]) -> None:
+    await db.executemany(
+        "UPDATE habits SET total_completions = ?, current_streak = ?, longest_streak = ?, last_done_date = ?"
+        " WHERE id = ?",
+        [(total, cur, longest, last, hid) for hid, total, cur, longest, last in rows],
+    )
+
+
+async def _rebuild_habit_counters(db: aiosqlite.Connection) -> None:
+    await _store_habit_counters(db, await _compute_habit_counters(db))
+
+
+async def _local_today(db: aiosqlite.Connection, user_id: int = None, habit_id: int = None) -> str:
+    """Сегодняшняя дата YYYY-MM-DD в поясе пользователя (по user_id или по его привычке habit_id)."""
+    if habit_id is not None:
+        sql, arg = "SELECT u.timezone FROM habits h JOIN users u ON u.user_id = h.user_id WHERE h.id = ?", habit_id
+    else:
+        sql, arg = "SELECT timezone FROM users WHERE user_id = ?", user_id
+    async with db.execute(sql, (arg,)) as c:
+        row = await c.fetchone()
+    return datetime.now(timezone.utc).astimezone(zone(row[0] if row else None)).date().isoformat()
+
+
+async def _infer_user_timezones(db: aiosqlite.Connection) -> None:
+    """Заполнить timezone по городу и коду страны у пользователей, у которых он ещё не задан."""
+    async with db.execute(
+        """SELECT user_id, city, country_code FROM users
+           WHERE timezone IS NULL AND (city IS NOT NULL OR country_code IS NOT NULL)"""
+    ) as c:
+        rows = await c.fetchall()
+    updates = [(tz, uid) for uid, city, code in rows if (tz := infer_timezone(city, code))]
+    await db.executemany("UPDATE users SET timezone = ?, timezone_auto = 1 WHERE user_id = ?", updates)
+
+
+def _record_contribution(rec: Optional[Tuple[int, int]]) -> int:
+    """Вклад записи (completed, count) в total_completions — как SUM(COALESCE(NULLIF(count, 0), 1))."""
+    if rec is None:
+        return 0
+    return rec[1] if rec[1] else 1
+
+
+def _record_done(rec: Optional[Tuple[int, int]]) -> bool:
+    return rec is not None and (rec[0] == 1 or (rec[1] or 0) > 0)
+
+
+# Версионированные миграции схемы: (номер, описание, шаги). Номер последней применённой
+# хранится в PRAGMA user_version. Шаг — SQL-строка, (таблица, колонка, тип) для
+# ADD COLUMN, который пропускается, если колонка уже есть (БД до введения миграций),
+# или async-функция (db), например пересчёт данных.
+_MIGRATIONS = [
+    (1, "колонки, добавленные после первой версии схемы", [
+        ("users", "first_name", "TEXT"),
+        ("users", "last_name", "TEXT"),
+        ("users", "display_name", "TEXT"),
+        ("users", "gender", "TEXT"),
+        ("users", "weight", "REAL"),
+        ("users", "height", "REAL"),
+        ("users", "age", "INTEGER"),
+        ("users", "target_weight", "REAL"),
+        ("users", "city", "TEXT"),
+        ("users", "country", "TEXT"),
+        ("users", "country_code", "TEXT"),
+        ("users", "geo_consent", "INTEGER"),
+        ("missions", "deadline", "TEXT"),
+        ("missions", "is_example", "INTEGER DEFAULT 0"),
+        ("missions", "sort_order", "INTEGER"),
+        ("goals", "is_example", "INTEGER DEFAULT 0"),
+        ("goals", "sort_order", "INTEGER"),
+        ("subgoals", "sort_order", "INTEGER"),
+        ("habits", "is_example", "INTEGER DEFAULT 0"),
+        ("habits", "is_water_calculated", "INTEGER DEFAULT 0"),
+        ("habits", "achievement_21_notified", "INTEGER DEFAULT 0"),
+        ("habits", "sort_order", "INTEGER"),
+        ("habit_records", "count", "INTEGER DEFAULT 0"),
+        ("habit_records", "completed_at", "TIMESTAMP"),
+        ("user_reminder_settings", "quiet_hours_start", "TEXT"),
+        ("user_reminder_settings", "quiet_hours_end", "TEXT"),
+        ("user_reminder_settings", "reminder_intensity", "INTEGER DEFAULT 2"),
+        ("user_reminder_settings", "first_reminder_sent", "INTEGER DEFAULT 0"),
+    ]),
+    (2, "вторичные индексы и reminder_sent_log.sent_on", [
+        # Дата отправки хранится отдельно: date(sent_at) = ? не может использовать индекс
+        ("reminder_sent_log", "sent_on", "TEXT"),
+        "UPDATE reminder_sent_log SET sent_on = date(sent_at) WHERE sent_on IS NULL",
+        "CREATE INDEX IF NOT EXISTS idx_missions_user_sort ON missions(user_id, sort_order)",
+        "CREATE INDEX IF NOT EXISTS idx_goals_user_sort ON goals(user_id, sort_order)",
+        "CREATE INDEX IF NOT EXISTS idx_habits_user_sort ON habits(user_id, sort_order)",
+        "CREATE INDEX IF NOT EXISTS idx_subgoals_mission_sort ON subgoals(mission_id, sort_order)",
+        # Покрывающий индекс для серий, сумм повторений и календаря — без чтения строк таблицы
+        "CREATE INDEX IF NOT EXISTS idx_habit_records_habit_date ON habit_records(habit_id, date, completed, count)",
+        "CREATE INDEX IF NOT EXISTS idx_reminder_sent_log_key"
+        " ON reminder_sent_log(user_id, habit_id, reminder_type, sent_on)",
+        "CREATE INDEX IF NOT EXISTS idx_shaolen_history_user_created ON shaolen_history(user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_user_achievements_user ON user_achievements(user_id, achieved_at)",
+        "CREATE INDEX IF NOT EXISTS idx_time_capsule_history_user ON time_capsule_history(user_id, viewed_at)",
+    ]),
+    (3, "счётчики привычек: total_completions, current_streak, longest_streak, last_done_date", [
+        ("habits", "total_completions", "INTEGER DEFAULT 0"),
+        ("habits", "current_streak", "INTEGER DEFAULT 0"),
+        ("habits", "longest_streak", "INTEGER DEFAULT 0"),
+        ("habits", "last_done_date", "TEXT"),
+        _rebuild_habit_counters,
+    ]),
+    (4, "индексы для общего планирования напоминаний", [
+        "CREATE INDEX IF NOT EXISTS idx_reminder_sent_log_sent_on ON reminder_sent_log(sent_on)",
+        "CREATE INDEX IF NOT EXISTS idx_missions_deadline ON missions(deadline)",
+    ]),
+    (5, "расписание напоминаний reminder_schedule", [
+        """CREATE TABLE IF NOT EXISTS reminder_schedule (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            habit_id INTEGER,
+            mission_id INTEGER,
+            reminder_type TEXT NOT NULL,
+            due_at TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_reminder_schedule_due ON reminder_schedule(due_at)",
+        "CREATE INDEX IF NOT EXISTS idx_reminder_schedule_user ON reminder_schedule(user_id)",
+        # Пользователи, чьё расписание устарело (привычки, отметки, настройки) — пересчитывает воркер
+        "CREATE TABLE IF NOT EXISTS reminder_schedule_dirty (user_id INTEGER PRIMARY KEY)",
+    ]),
+    (6, "шарды воркера напоминаний и уникальный ключ отправки", [
+        # Heartbeat шардов: просроченный шард забирают живые (см. reminder_worker.assign_shards)
+        """CREATE TABLE IF NOT EXISTS reminder_shard_lease (
+            shard_count INTEGER NOT NULL,
+            shard INTEGER NOT NULL,
+            owner TEXT,
+            heartbeat_at REAL NOT NULL,
+            PRIMARY KEY (shard_count, shard)
+        )""",
+        # Одно напоминание одного типа в день: дубли от пересекающихся тиков убираем до создания ключа.
+        # NULL в UNIQUE-индексе SQLite не равны друг другу, поэтому ключ — по COALESCE(..., 0)
+        """DELETE FROM reminder_sent_log WHERE id NOT IN (
+            SELECT MIN(id) FROM reminder_sent_log
+            GROUP BY user_id, COALESCE(habit_id, 0), COALESCE(mission_id, 0), reminder_type, sent_on
+        )""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_reminder_sent_log_claim ON reminder_sent_log"
+        "(user_id, COALESCE(habit_id, 0), COALESCE(mission_id, 0), reminder_type, sent_on)",
+    ]),
+    (7, "дневные итоги старых напоминаний reminder_sent_daily", [
+        # Сюда maintenance.py сворачивает reminder_sent_log старше срока хранения
+        """CREATE TABLE IF NOT EXISTS reminder_sent_daily (
+            user_id INTEGER NOT NULL,
+            sent_on TEXT NOT NULL,
+            reminder_type TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, sent_on, reminder_type)
+        )""",
+        # Удаление по сроку хранения — по дате, без прохода по всей таблице
+        "CREATE INDEX IF NOT EXISTS idx_analytics_date ON analytics(date)",
+        "CREATE INDEX IF NOT EXISTS idx_shaolen_daily_requests_date ON shaolen_daily_requests(date)",
+    ]),
+    (8, "часовой пояс пользователя users.timezone", [
+        ("users", "timezone", "TEXT"),  # имя IANA; NULL — DEFAULT_TIMEZONE (user_timezones.py)
+        ("users", "timezone_auto", "INTEGER DEFAULT 1"),  # 1 — выведен из города, 0 — задан пользователем
+        _infer_user_timezones,
+    ]),
+    (9, "события выполнения привычек для воркера напоминаний", [
+        # Последнее изменение «выполнена сегодня» по привычке (см. _publish_habit_event); воркер забирает
+        # их перед отправкой и снимает напоминания по выполненным привычкам без пересборки расписания
+        """CREATE TABLE IF NOT EXISTS reminder_habit_events (
+            habit_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            done INTEGER NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_reminder_schedule_habit ON reminder_schedule(habit_id)",
+    ]),
+    (10, "соответствие событий Google Календаря привычкам, целям и подцелям", [
+        # kind — habit/goal/subgoal, local_id — id в своей таблице; content_hash — хеш тела события
+        # при последней выгрузке (calendar_sync.py): совпал — событие не трогаем
+        """CREATE TABLE IF NOT EXISTS calendar_event_map (
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            local_id INTEGER NOT NULL,
+            event_id TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, kind, local_id)
+        )""",
+    ]),
+    (11, "шаги Google Fit по дням", [
+        # Дневные итоги из dataset:aggregate (google_fit.py): графики и расчёт воды читают шаги отсюда,
+        # без запроса к Google; updated_at — когда день последний раз получен из Google
+        """CREATE TABLE IF NOT EXISTS steps_daily (
+            user_id INTEGER NOT NULL,
+            date DATE NOT NULL,
+            steps INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, date)
+        )""",
+    ]),
+]
+
+
+async def _add_column_if_missing(db: aiosqlite.Connection, table: str, column: str, decl: str) -> None:
+    async with db.execute(f"PRAGMA table_info({table})") as c:
+        existing = {row[1] for row in await c.fetchall()}
+    if column not in existing:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _shard_filter(shard: Optional[Tuple[int, Sequence[int]]], column: str = "user_id") -> Tuple[str, tuple]:
+    """Условие « AND column % N IN (...)» для шардов воркера напоминаний: shard = (N, номера шардов)."""
+    if shard is None:
+        return "", ()
+    count, shards = shard
+    return f" AND {column} % ? IN ({','.join('?' * len(shards))})", (count, *shards)
+
+
+async def _mark_schedule_dirty(
+    db: aiosqlite.Connection,
+    user_id: Optional[int] = None,
+    habit_id: Optional[int] = None,
+    mission_id: Optional[int] = None,
+    goal_id: Optional[int] = None,
+) -> None:
+    """Пометить расписание напоминаний пользователя к пересчёту (в текущей транзакции записи).
+    Пользователь задаётся явно или через привычку/миссию/цель."""
+    if user_id is not None:
+        await db.execute("INSERT OR IGNORE INTO reminder_schedule_dirty (user_id) VALUES (?)", (user_id,))
+        return
+    for table, row_id in (("habits", habit_id), ("missions", mission_id), ("goals", goal_id)):
+        if row_id is not None:
+            await db.execute(
+                f"INSERT OR IGNORE INTO reminder_schedule_dirty (user_id) SELECT user_id FROM {table} WHERE id = ?",
+                (row_id,),
+            )
+            return
+
+
+async def _publish_habit_event(db: aiosqlite.Connection, habit_id: int, done: bool) -> None:
+    """Событие «привычка выполнена / снята отметка за сегодня» для воркера напоминаний (в текущей транзакции
+    записи). По привычке хранится только последнее состояние, поэтому очередь не растёт от частых нажатий."""
+    await db.execute(
+        """INSERT INTO reminder_habit_events (habit_id, user_id, done)
+           SELECT id, user_id, ? FROM habits WHERE id = ?
+           ON CONFLICT(habit_id) DO UPDATE SET done = excluded.done""",
+        (1 if done else 0, habit_id),
+    )
+
+
+_JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+_SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
 
 class Database:
-    def __init__(self, db_path: str = "goals_bot.db"):
+    """Доступ к SQLite через долгоживущий пул соединений.
+
+    Одно соединение на запись (операции сериализуются asyncio.Lock, чтобы транзакции
+    разных корутин не перемешивались) и settings.readers соединений на чтение. Соединения
+    открываются один раз (open() или лениво при первом запросе) и закрываются close().
+    В режиме WAL читатели не ждут писателя, а бот, веб-приложение и воркер напоминаний
+    не упираются в «database is locked».
+    """
+
+    def __init__(self, db_path: str = "goals_bot.db", settings: Optional[StorageSettings] = None):
         self.db_path = db_path
+        self.settings = settings or StorageSettings.from_env()
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._reader_pool: Optional[asyncio.Queue] = None
+        self._reader_conns: List[aiosqlite.Connection] = []
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._open_lock: Optional[asyncio.Lock] = None
+        self._checkpoint_task: Optional[asyncio.Task] = None
+
+    # === ПУЛ СОЕДИНЕНИЙ ===
+    async def _connect(self, readonly: bool) -> aiosqlite.Connection:
+        """Открыть соединение и один раз применить PRAGMA из настроек."""
+        st = self.settings
+        conn = await aiosqlite.connect(self.db_path, timeout=st.busy_timeout_ms / 1000.0)
+        conn.row_factory = aiosqlite.Row
+        await conn.execute(f"PRAGMA busy_timeout = {int(st.busy_timeout_ms)}")
+        # Отрицательное значение cache_size — размер в KiB, а не в страницах
+        await conn.execute(f"PRAGMA cache_size = {-abs(int(st.cache_size_kb))}")
+        await conn.execute(f"PRAGMA mmap_size = {max(0, int(st.mmap_size_mb)) * 1024 * 1024}")
+        await conn.execute("PRAGMA temp_store = MEMORY")
+        await _ensure_math_functions(conn)
+        if readonly:
+            await conn.execute("PRAGMA query_only = 1")
+            return conn
+        # Для новой (пустой) БД — освобождение места через PRAGMA incremental_vacuum (см. maintenance.py).
+        # Должно идти до journal_mode; у существующей БД режим меняет только VACUUM
+        await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # journal_mode хранится в самом файле БД, его выставляет соединение на запись
+        if st.journal_mode in _JOURNAL_MODES:
+            async with conn.execute(f"PRAGMA journal_mode = {st.journal_mode}") as c:
+                row = await c.fetchone()
+            if row and str(row[0]).upper() != st.journal_mode:
+                logger.warning("SQLite journal_mode=%s не применён, текущий: %s", st.journal_mode, row[0])
+        if st.synchronous in _SYNCHRONOUS_MODES:
+            await conn.execute(f"PRAGMA synchronous = {st.synchronous}")
+        return conn
+
+    async def open(self) -> None:
+        """Открыть пул (повторный вызов ничего не делает)."""
+        if self._writer is not None:
+            return
+        if self._open_lock is None:
+            self._open_lock = asyncio.Lock()
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            writer = await self._connect(readonly=False)
+            pool: asyncio.Queue = asyncio.Queue()
+            conns = []
+            try:
+                for _ in range(self.settings.readers):
+                    conn = await self._connect(readonly=True)
+                    conns.append(conn)
+                    pool.put_nowait(conn)
+            except Exception:
+                for conn in conns:
+                    await conn.close()
+                await writer.close()
+                raise
+            self._write_lock = asyncio.Lock()
+            self._reader_conns = conns
+            self._reader_pool = pool
+            self._writer = writer
+
+    async def close(self) -> None:
+        """Остановить фоновый checkpoint и закрыть все соединения пула."""
+        task, self._checkpoint_task = self._checkpoint_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        writer, conns = self._writer, self._reader_conns
+        self._writer, self._reader_pool, self._reader_conns = None, None, []
+        for conn in conns:
+            await conn.close()
+        if writer is not None:
+            await writer.close()
+
+    @asynccontextmanager
+    async def _read(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Взять соединение на чтение из пула."""
+        await self.open()
+        pool = self._reader_pool
+        conn = await pool.get()
+        try:
+            yield conn
+        finally:
+            pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def _write(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Эксклюзивный доступ к соединению на запись; при ошибке незакоммиченное откатывается."""
+        await self.open()
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+    async def wal_checkpoint(self) -> Optional[Tuple[int, int, int]]:
+        """PRAGMA wal_checkpoint(TRUNCATE): перенести WAL в основной файл и обнулить его.
+        Возвращает (busy, log_frames, checkpointed_frames) или None, если режим не WAL."""
+        if self.settings.journal_mode != "WAL":
+            return None
+        async with self._write() as db:
+            async with db.execute("PRAGMA wal_checkpoint(TRUNCATE)") as c:
+                row = await c.fetchone()
+        return (int(row[0]), int(row[1]), int(row[2])) if row else None
+
+    def start_wal_checkpointer(self, process: str) -> Optional[asyncio.Task]:
+        """Запустить периодический checkpoint, если этот процесс назначен DB_CHECKPOINT_PROCESS.
+        Так checkpoint(TRUNCATE) выполняет ровно один из процессов бот / веб-приложение / воркер."""
+        st = self.settings
+        if (
+            st.journal_mode != "WAL"
+            or st.checkpoint_interval_sec <= 0
+            or st.checkpoint_process != (process or "").strip().lower()
+            or self._checkpoint_task is not None
+        ):
+            return None
+
+        async def _loop():
+            while True:
+                await asyncio.sleep(st.checkpoint_interval_sec)
+                try:
+                    res = await self.wal_checkpoint()
+                    if res and res[0]:
+                        logger.info("wal_checkpoint(TRUNCATE) не завершён (занято читателями): %s", res)
+                except Exception as e:
+                    logger.warning("wal_checkpoint: %s", e)
+
+        self._checkpoint_task = asyncio.create_task(_loop())
+        logger.info("WAL checkpoint каждые %ss в процессе %s", st.checkpoint_interval_sec, process)
+        return self._checkpoint_task
 
     async def init_db(self):
         """Инициализация базы данных и создание таблиц"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             # Таблица пользователей
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS users (
@@ -22,19 +525,6 @@ class Database:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
-            for col in ("first_name", "last_name", "display_name"):
-                try:
-                    await db.execute(f"ALTER TABLE users ADD COLUMN {col} TEXT")
-                except Exception:
-                    pass
-            for col, typ in [
-                ("gender", "TEXT"), ("weight", "REAL"), ("height", "REAL"), ("age", "INTEGER"),
-                ("target_weight", "REAL"), ("city", "TEXT"), ("country", "TEXT"), ("country_code", "TEXT"), ("geo_consent", "INTEGER"),
-            ]:
-                try:
-                    await db.execute(f"ALTER TABLE users ADD COLUMN {col} {typ}")
-                except Exception:
-                    pass
 
             # История веса (одна запись на пользователя на дату; только день, без времени суток)
             await db.execute("""
@@ -61,19 +551,6 @@ class Database:
                     FOREIGN KEY (user_id) REFERENCES users(user_id)
                 )
             """)
-            try:
-                await db.execute("ALTER TABLE missions ADD COLUMN deadline TEXT")
-            except Exception:
-                pass
-            for col, default in [("is_example", "0")]:
-                try:
-                    await db.execute(f"ALTER TABLE missions ADD COLUMN {col} INTEGER DEFAULT {default}")
-                except Exception:
-                    pass
-            try:
-                await db.execute("ALTER TABLE missions ADD COLUMN sort_order INTEGER")
-            except Exception:
-                pass
 
             # Таблица подцелей (подцели миссий)
             await db.execute("""
@@ -104,10 +581,6 @@ class Database:
                     FOREIGN KEY (user_id) REFERENCES users(user_id)
                 )
             """)
-            try:
-                await db.execute("ALTER TABLE goals ADD COLUMN is_example INTEGER DEFAULT 0")
-            except Exception:
-                pass
 
             # Таблица привычек
             await db.execute("""
@@ -121,23 +594,6 @@ class Database:
                     FOREIGN KEY (user_id) REFERENCES users(user_id)
                 )
             """)
-            try:
-                await db.execute("ALTER TABLE habits ADD COLUMN is_example INTEGER DEFAULT 0")
-            except Exception:
-                pass
-            try:
-                await db.execute("ALTER TABLE habits ADD COLUMN is_water_calculated INTEGER DEFAULT 0")
-            except Exception:
-                pass
-            try:
-                await db.execute("ALTER TABLE habits ADD COLUMN achievement_21_notified INTEGER DEFAULT 0")
-            except Exception:
-                pass
-            for tbl, col in [("subgoals", "sort_order"), ("goals", "sort_order"), ("habits", "sort_order")]:
-                try:
-                    await db.execute(f"ALTER TABLE {tbl} ADD COLUMN {col} INTEGER")
-                except Exception:
-                    pass
 
             # Таблица записей привычек (трекинг выполнения)
             await db.execute("""
@@ -151,17 +607,6 @@ class Database:
                     UNIQUE(habit_id, date)
                 )
             """)
-            
-            # Добавляем колонку count если её нет (для существующих БД)
-            try:
-                await db.execute("ALTER TABLE habit_records ADD COLUMN count INTEGER DEFAULT 0")
-            except Exception:
-                pass  # Колонка уже существует
-            # Время выполнения привычки в этот день (для умных напоминаний)
-            try:
-                await db.execute("ALTER TABLE habit_records ADD COLUMN completed_at TIMESTAMP")
-            except Exception:
-                pass
 
             # Настройки умных напоминаний (глобальные для пользователя)
             await db.execute("""
@@ -175,14 +620,6 @@ class Database:
                     FOREIGN KEY (user_id) REFERENCES users(user_id)
                 )
             """)
-            for col, typ in [
-                ("quiet_hours_start", "TEXT"), ("quiet_hours_end", "TEXT"),
-                ("reminder_intensity", "INTEGER DEFAULT 2"), ("first_reminder_sent", "INTEGER DEFAULT 0"),
-            ]:
-                try:
-                    await db.execute(f"ALTER TABLE user_reminder_settings ADD COLUMN {col} {typ}")
-                except Exception:
-                    pass
 
             # Включить/выключить напоминания по отдельной привычке (NULL = включено)
             await db.execute("""
@@ -315,6 +752,28 @@ class Database:
             """)
 
             await db.commit()
+            await self._migrate(db)
+
+    async def _migrate(self, db: aiosqlite.Connection) -> None:
+        """Применить миграции из _MIGRATIONS, номер которых больше PRAGMA user_version.
+        Каждая миграция выполняется в своей транзакции вместе с записью нового user_version."""
+        async with db.execute("PRAGMA user_version") as c:
+            row = await c.fetchone()
+        current = int(row[0]) if row else 0
+        for version, description, steps in _MIGRATIONS:
+            if version <= current:
+                continue
+            await db.execute("BEGIN")
+            for step in steps:
+                if isinstance(step, tuple):
+                    await _add_column_if_missing(db, *step)
+                elif callable(step):
+                    await step(db)
+                else:
+                    await db.execute(step)
+            await db.execute(f"PRAGMA user_version = {int(version)}")
+            await db.commit()
+            logger.info("Миграция БД %s применена: %s", version, description)
 
     async def add_user(
         self,
@@ -327,7 +786,7 @@ class Database:
         un = username or ""
         fn = first_name or ""
         ln = last_name or ""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 """INSERT INTO users (user_id, username, first_name, last_name)
                    VALUES (?, ?, ?, ?)
@@ -342,8 +801,7 @@ class Database:
 
     async def get_user(self, user_id: int) -> Optional[Dict]:
         """Получение пользователя по ID."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as c:
                 row = await c.fetchone()
                 return dict(row) if row else None
@@ -351,10 +809,26 @@ class Database:
     async def update_user_display_name(self, user_id: int, display_name: Optional[str]) -> None:
         """Обновить отображаемое имя пользователя."""
         dn = (display_name or "").strip() or None
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute("UPDATE users SET display_name = ? WHERE user_id = ?", (dn, user_id))
             await db.commit()
 
+    async def set_user_telegram_names(
+        self,
+        user_id: int,
+        first_name: Optional[str],
+        last_name: Optional[str],
+        username: Optional[str],
+    ) -> None:
+        """Перезаписать имя и username из Telegram (getChat); display_name не трогаем."""
+        async with self._write() as db:
+            await db.execute(
+                """UPDATE users SET first_name = ?, last_name = ?, username = ?
+                   WHERE user_id = ?""",
+                (first_name, last_name, username, user_id),
+            )
+            await db.commit()
+
     async def update_user_profile_extended(
         self,
         user_id: int,
@@ -369,7 +843,7 @@ class Database:
         geo_consent: Optional[int] = None,
     ) -> None:
         """Обновить расширенные поля профиля (пол, вес, рост, возраст, цель, город, страна, код страны, согласие на гео)."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             updates, vals = [], []
             if gender is not None:
                 updates.append("gender = ?")
@@ -406,11 +880,69 @@ class Database:
                 "UPDATE users SET " + ", ".join(updates) + " WHERE user_id = ?",
                 vals,
             )
+            if city is not None or country_code is not None:
+                # Пояс, выведенный из города, следует за городом; заданный пользователем не трогаем
+                async with db.execute(
+                    "SELECT city, country_code, timezone FROM users WHERE user_id = ? AND COALESCE(timezone_auto, 1) = 1",
+                    (user_id,),
+                ) as c:
+                    row = await c.fetchone()
+                if row is not None:
+                    tz = infer_timezone(row["city"], row["country_code"]) or row["timezone"]
+                    if tz != row["timezone"]:
+                        await db.execute("UPDATE users SET timezone = ? WHERE user_id = ?", (tz, user_id))
+                        await _mark_schedule_dirty(db, user_id=user_id)
             await db.commit()
 
+    async def set_user_timezone(self, user_id: int, tz: Optional[str], auto: bool = False) -> bool:
+        """
+        Задать часовой пояс пользователя (имя IANA). auto=False — выбран пользователем: больше не
+        выводится из города; tz=None при auto=False возвращает автоопределение по городу.
+        auto=True (например, пояс из геокодера) применяется, только если пользователь не задал пояс сам.
+        Возвращает False, если пояс неизвестен.
+        """
+        if tz is not None and valid_timezone(tz) is None:
+            return False
+        async with self._write() as db:
+            if auto:
+                cursor = await db.execute(
+                    """UPDATE users SET timezone = ? WHERE user_id = ? AND COALESCE(timezone_auto, 1) = 1
+                       AND timezone IS NOT ?""",
+                    (tz, user_id, tz),
+                )
+            elif tz is None:
+                async with db.execute("SELECT city, country_code FROM users WHERE user_id = ?", (user_id,)) as c:
+                    row = await c.fetchone()
+                tz = infer_timezone(row["city"], row["country_code"]) if row else None
+                cursor = await db.execute(
+                    "UPDATE users SET timezone = ?, timezone_auto = 1 WHERE user_id = ?", (tz, user_id)
+                )
+            else:
+                cursor = await db.execute(
+                    "UPDATE users SET timezone = ?, timezone_auto = 0 WHERE user_id = ?", (tz, user_id)
+                )
+            if cursor.rowcount:
+                await _mark_schedule_dirty(db, user_id=user_id)
+            await db.commit()
+        return True
+
+    async def get_user_timezones(
+        self, user_ids: Optional[List[int]] = None, shard: Optional[Tuple[int, Sequence[int]]] = None
+    ) -> Dict[int, Optional[str]]:
+        """{user_id: имя пояса или None (DEFAULT_TIMEZONE)} — для группировки напоминаний по поясам."""
+        sql, params = _shard_filter(shard)
+        if user_ids is not None:
+            if not user_ids:
+                return {}
+            sql += f" AND user_id IN ({','.join('?' * len(user_ids))})"
+            params += tuple(user_ids)
+        async with self._read() as db:
+            async with db.execute("SELECT user_id, timezone FROM users WHERE 1" + sql, params) as c:
+                return {uid: tz for uid, tz in await c.fetchall()}
+
     async def add_weight_entry(self, user_id: int, date: str, weight: float) -> None:
         """Добавить/обновить запись веса на дату (date в формате YYYY-MM-DD)."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "INSERT OR REPLACE INTO weight_history (user_id, date, weight) VALUES (?, ?, ?)",
                 (user_id, date, weight),
@@ -421,8 +953,7 @@ class Database:
         self, user_id: int, period: str = "7"
     ) -> List[Dict]:
         """История веса за период: 7 (последние 7 точек), week, month, 6months, year."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             if period == "7":
                 query = """
                     SELECT date, weight FROM weight_history
@@ -467,7 +998,7 @@ class Database:
     # === МИССИИ ===
     async def add_mission(self, user_id: int, title: str, description: str = "", deadline: Optional[str] = None, is_example: int = 0) -> int:
         """Добавление миссии. is_example=1 — предустановленный пример."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             async with db.execute(
                 "SELECT COALESCE(MAX(sort_order), -1) + 1 FROM missions WHERE user_id = ?",
                 (user_id,)
@@ -478,13 +1009,13 @@ class Database:
                 "INSERT INTO missions (user_id, title, description, deadline, is_example, sort_order) VALUES (?, ?, ?, ?, ?, ?)",
                 (user_id, title, description or "", deadline, 1 if is_example else 0, sort_order)
             )
+            await _mark_schedule_dirty(db, user_id)
             await db.commit()
             return cursor.lastrowid
 
     async def get_missions(self, user_id: int, include_completed: bool = False) -> List[Dict]:
         """Получение всех миссий пользователя (по sort_order, затем created_at)."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             query = "SELECT * FROM missions WHERE user_id = ?"
             if not include_completed:
                 query += " AND is_completed = 0"
@@ -497,7 +1028,7 @@ class Database:
         """Установить порядок миссий (список id в нужном порядке)."""
         if not mission_ids:
             return
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             for i, mid in enumerate(mission_ids):
                 await db.execute(
                     "UPDATE missions SET sort_order = ? WHERE id = ? AND user_id = ?",
@@ -507,34 +1038,36 @@ class Database:
 
     async def get_mission(self, mission_id: int) -> Optional[Dict]:
         """Получение миссии по ID"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute("SELECT * FROM missions WHERE id = ?", (mission_id,)) as cursor:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
 
     async def complete_mission(self, mission_id: int):
         """Завершение миссии"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "UPDATE missions SET is_completed = 1, completed_at = ? WHERE id = ?",
                 (datetime.now(), mission_id)
             )
+            await _mark_schedule_dirty(db, mission_id=mission_id)
             await db.commit()
 
     async def update_mission(self, mission_id: int, title: str, description: str = "", deadline: Optional[str] = None) -> bool:
         """Обновление миссии. После сохранения пользователем снимается метка «пример»."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "UPDATE missions SET title = ?, description = ?, deadline = ?, is_example = 0 WHERE id = ?",
                 (title, description or "", deadline, mission_id)
             )
+            await _mark_schedule_dirty(db, mission_id=mission_id)
             await db.commit()
             return True
 
     async def delete_mission(self, mission_id: int):
         """Удаление миссии"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
+            await _mark_schedule_dirty(db, mission_id=mission_id)
             await db.execute("DELETE FROM missions WHERE id = ?", (mission_id,))
             await db.execute("DELETE FROM subgoals WHERE mission_id = ?", (mission_id,))
             await db.commit()
@@ -542,7 +1075,7 @@ class Database:
     # === ПОДЦЕЛИ ===
     async def add_subgoal(self, mission_id: int, title: str, description: str = "") -> int:
         """Добавление подцели к миссии"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             async with db.execute(
                 "SELECT COALESCE(MAX(sort_order), -1) + 1 FROM subgoals WHERE mission_id = ?",
                 (mission_id,)
@@ -558,8 +1091,7 @@ class Database:
 
     async def get_subgoals(self, mission_id: int) -> List[Dict]:
         """Получение всех подцелей миссии (по sort_order, затем по id)."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                 "SELECT * FROM subgoals WHERE mission_id = ? ORDER BY COALESCE(sort_order, 999999), id ASC",
                 (mission_id,)
@@ -567,11 +1099,27 @@ class Database:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
 
+    async def get_subgoals_for_missions(self, mission_ids: List[int]) -> Dict[int, List[Dict]]:
+        """Подцели нескольких миссий одним запросом: {mission_id: [подцели по sort_order, затем по id]}."""
+        result: Dict[int, List[Dict]] = {mid: [] for mid in mission_ids}
+        if not mission_ids:
+            return result
+        placeholders = ",".join("?" * len(mission_ids))
+        async with self._read() as db:
+            async with db.execute(
+                f"""SELECT * FROM subgoals WHERE mission_id IN ({placeholders})
+                    ORDER BY mission_id, COALESCE(sort_order, 999999), id ASC""",
+                tuple(mission_ids),
+            ) as cursor:
+                for row in await cursor.fetchall():
+                    result.setdefault(row["mission_id"], []).append(dict(row))
+        return result
+
     async def set_subgoals_order(self, mission_id: int, subgoal_ids: List[int]) -> None:
         """Установить порядок подцелей (список id в нужном порядке)."""
         if not subgoal_ids:
             return
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             for i, sg_id in enumerate(subgoal_ids):
                 await db.execute(
                     "UPDATE subgoals SET sort_order = ? WHERE id = ? AND mission_id = ?",
@@ -581,15 +1129,14 @@ class Database:
 
     async def get_subgoal(self, subgoal_id: int) -> Optional[Dict]:
         """Получение подцели по ID"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute("SELECT * FROM subgoals WHERE id = ?", (subgoal_id,)) as cursor:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
 
     async def complete_subgoal(self, subgoal_id: int):
         """Завершение подцели"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "UPDATE subgoals SET is_completed = 1, completed_at = ? WHERE id = ?",
                 (datetime.now(), subgoal_id)
@@ -598,7 +1145,7 @@ class Database:
 
     async def uncomplete_subgoal(self, subgoal_id: int):
         """Снять отметку выполнения подцели"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "UPDATE subgoals SET is_completed = 0, completed_at = NULL WHERE id = ?",
                 (subgoal_id,)
@@ -607,20 +1154,19 @@ class Database:
 
     async def update_subgoal(self, subgoal_id: int, title: str, description: str = "") -> bool:
         """Обновление подцели (название и описание)."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "UPDATE subgoals SET title = ?, description = ? WHERE id = ?",
                 (title, description, subgoal_id)
             )
             await db.commit()
-            db.row_factory = aiosqlite.Row
             async with db.execute("SELECT 1 FROM subgoals WHERE id = ?", (subgoal_id,)) as cur:
                 row = await cur.fetchone()
                 return row is not None
 
     async def delete_subgoal(self, subgoal_id: int):
         """Удаление подцели"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute("DELETE FROM subgoals WHERE id = ?", (subgoal_id,))
             await db.commit()
 
@@ -628,7 +1174,7 @@ class Database:
     async def add_goal(self, user_id: int, title: str, description: str = "",
                       deadline: Optional[str] = None, priority: int = 1, is_example: int = 0) -> int:
         """Добавление цели. is_example=1 — предустановленный пример."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             async with db.execute(
                 "SELECT COALESCE(MAX(sort_order), -1) + 1 FROM goals WHERE user_id = ?",
                 (user_id,)
@@ -639,13 +1185,13 @@ class Database:
                 "INSERT INTO goals (user_id, title, description, deadline, priority, is_example, sort_order) VALUES (?, ?, ?, ?, ?, ?, ?)",
                 (user_id, title, description, deadline, priority, 1 if is_example else 0, sort_order)
             )
+            await _mark_schedule_dirty(db, user_id)
             await db.commit()
             return cursor.lastrowid
 
     async def get_goals(self, user_id: int, include_completed: bool = False) -> List[Dict]:
         """Получение всех целей пользователя (по sort_order, затем priority, created_at)."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             query = "SELECT * FROM goals WHERE user_id = ?"
             if not include_completed:
                 query += " AND is_completed = 0"
@@ -658,7 +1204,7 @@ class Database:
         """Установить порядок целей (список id в нужном порядке)."""
         if not goal_ids:
             return
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             for i, gid in enumerate(goal_ids):
                 await db.execute(
                     "UPDATE goals SET sort_order = ? WHERE id = ? AND user_id = ?",
@@ -668,34 +1214,35 @@ class Database:
 
     async def get_goal(self, goal_id: int) -> Optional[Dict]:
         """Получение цели по ID"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute("SELECT * FROM goals WHERE id = ?", (goal_id,)) as cursor:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
 
     async def complete_goal(self, goal_id: int):
         """Завершение цели"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "UPDATE goals SET is_completed = 1, completed_at = ? WHERE id = ?",
                 (datetime.now(), goal_id)
             )
+            await _mark_schedule_dirty(db, goal_id=goal_id)
             await db.commit()
 
     async def uncomplete_goal(self, goal_id: int):
         """Снять отметку выполнения цели"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "UPDATE goals SET is_completed = 0, completed_at = NULL WHERE id = ?",
                 (goal_id,)
             )
+            await _mark_schedule_dirty(db, goal_id=goal_id)
             await db.commit()
 
     async def update_goal(self, goal_id: int, title: str, description: str = "",
                          deadline: Optional[str] = None, priority: int = 1) -> bool:
         """Обновление цели. После сохранения пользователем снимается метка «пример»."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 """UPDATE goals SET title = ?, description = ?, deadline = ?, priority = ?, is_example = 0
                    WHERE id = ?""",
@@ -706,14 +1253,15 @@ class Database:
 
     async def delete_goal(self, goal_id: int):
         """Удаление цели"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
+            await _mark_schedule_dirty(db, goal_id=goal_id)
             await db.execute("DELETE FROM goals WHERE id = ?", (goal_id,))
             await db.commit()
 
     # === ПРИВЫЧКИ ===
     async def add_habit(self, user_id: int, title: str, description: str = "", is_example: int = 0, is_water_calculated: int = 0) -> int:
         """Добавление привычки. is_example=1 — пример; is_water_calculated=1 — рассчитана автоматически (вода)."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             async with db.execute(
                 "SELECT COALESCE(MAX(sort_order), -1) + 1 FROM habits WHERE user_id = ?",
                 (user_id,)
@@ -724,12 +1272,13 @@ class Database:
                 "INSERT INTO habits (user_id, title, description, is_example, is_water_calculated, sort_order) VALUES (?, ?, ?, ?, ?, ?)",
                 (user_id, title, description, 1 if is_example else 0, 1 if is_water_calculated else 0, sort_order)
             )
+            await _mark_schedule_dirty(db, user_id)
             await db.commit()
             return cursor.lastrowid
 
     async def update_habit(self, habit_id: int, title: str, description: str = "") -> bool:
         """Обновление привычки. После сохранения пользователем снимается метка «пример» и «рассчитана автоматически»."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "UPDATE habits SET title = ?, description = ?, is_example = 0, is_water_calculated = 0 WHERE id = ?",
                 (title, description or "", habit_id)
@@ -739,19 +1288,15 @@ class Database:
 
     async def get_habit(self, habit_id: int) -> Optional[Dict]:
         """Получение привычки по ID (без today_count)"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute("SELECT * FROM habits WHERE id = ?", (habit_id,)) as cursor:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
 
     async def get_habits(self, user_id: int, active_only: bool = True) -> List[Dict]:
-        """Получение всех привычек пользователя с текущим счетчиком на сегодня"""
-        from datetime import date
-        today = date.today().isoformat()
-        
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        """Получение всех привычек пользователя с текущим счетчиком на сегодня (в его часовом поясе)"""
+        async with self._read() as db:
+            today = await _local_today(db, user_id=user_id)
             query = """
                 SELECT h.*,
                        COALESCE(hr.count, 0) as today_count,
@@ -768,11 +1313,67 @@ class Database:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
 
+    async def get_habits_enriched(self, user_id: int, active_only: bool = False, avg_days: int = 30) -> List[Dict]:
+        """
+        Привычки пользователя со всем, что нужно экрану привычек, достижениям и Шаолень, за два запроса:
+        today_count, reminders_enabled, total_completions, streak, last_7_days ([старая, ..., сегодня])
+        и avg_completion_time (HH:MM за последние avg_days дней или None).
+        total_completions и streak берутся из счётчиков в habits (см. _apply_record_change).
+        «Сегодня» — в часовом поясе пользователя, как и даты отметок.
+        """
+        from datetime import date, timedelta
+        async with self._read() as db:
+            today = date.fromisoformat(await _local_today(db, user_id=user_id))
+            since = (today - timedelta(days=max(avg_days, 6))).isoformat()
+            avg_since = (today - timedelta(days=avg_days)).isoformat()
+            last_7 = [(today - timedelta(days=i)).isoformat() for i in range(6, -1, -1)]
+
+            query = """
+                SELECT h.*,
+                       COALESCE(hr.count, 0) as today_count,
+                       COALESCE(hrs.reminders_enabled, 1) as reminders_enabled
+                FROM habits h
+                LEFT JOIN habit_records hr ON h.id = hr.habit_id AND hr.date = ?
+                LEFT JOIN habit_reminder_settings hrs ON h.id = hrs.habit_id
+                WHERE h.user_id = ?
+            """
+            if active_only:
+                query += " AND h.is_active = 1"
+            query += " ORDER BY COALESCE(h.sort_order, 999999), h.created_at DESC"
+            async with db.execute(query, (today.isoformat(), user_id)) as cursor:
+                habits = [dict(row) for row in await cursor.fetchall()]
+            if not habits:
+                return []
+
+            done: Dict[int, set] = {}
+            completed_at: Dict[int, list] = {}
+            async with db.execute(
+                """SELECT hr.habit_id, hr.date, (hr.completed = 1 OR hr.count > 0), hr.completed_at
+                   FROM habit_records hr
+                   JOIN habits h ON h.id = hr.habit_id AND h.user_id = ?
+                   WHERE hr.date >= ?""",
+                (user_id, since),
+            ) as cursor:
+                for hid, d, is_done, at in await cursor.fetchall():
+                    if is_done:
+                        done.setdefault(hid, set()).add(d)
+                    if at is not None and d >= avg_since:
+                        completed_at.setdefault(hid, []).append(at)
+
+        for h in habits:
+            dates = done.get(h["id"], set())
+            h["total_completions"] = int(h.get("total_completions") or 0)
+            # Серия «считая сегодня»: хранимая серия заканчивается last_done_date
+            h["streak"] = int(h.get("current_streak") or 0) if h.get("last_done_date") == today.isoformat() else 0
+            h["last_7_days"] = [1 if d in dates else 0 for d in last_7]
+            h["avg_completion_time"] = self._avg_time_of_day(completed_at.get(h["id"], []))
+        return habits
+
     async def set_habits_order(self, user_id: int, habit_ids: List[int]) -> None:
         """Установить порядок привычек (список id в нужном порядке)."""
         if not habit_ids:
             return
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             for i, hid in enumerate(habit_ids):
                 await db.execute(
                     "UPDATE habits SET sort_order = ? WHERE id = ? AND user_id = ?",
@@ -780,33 +1381,34 @@ class Database:
                 )
             await db.commit()
 
-    async def toggle_habit_record(self, habit_id: int, date: str) -> bool:
-        """Переключение выполнения привычки на дату (возвращает True если выполнена)"""
-        async with aiosqlite.connect(self.db_path) as db:
+    async def toggle_habit_record(self, habit_id: int, date: str = None) -> bool:
+        """Переключение выполнения привычки на дату, по умолчанию сегодня в поясе пользователя (возвращает True если выполнена)"""
+        async with self._write() as db:
+            if date is None:
+                date = await _local_today(db, habit_id=habit_id)
             # Проверяем существующую запись
-            async with db.execute(
-                "SELECT completed FROM habit_records WHERE habit_id = ? AND date = ?",
-                (habit_id, date)
-            ) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    new_status = 0 if row[0] else 1
-                    await db.execute(
-                        "UPDATE habit_records SET completed = ? WHERE habit_id = ? AND date = ?",
-                        (new_status, habit_id, date)
-                    )
-                else:
-                    await db.execute(
-                        "INSERT INTO habit_records (habit_id, date, completed) VALUES (?, ?, 1)",
-                        (habit_id, date)
-                    )
-                    new_status = 1
+            before = await self._lock_habit_record(db, habit_id, date)
+            if before:
+                new_status = 0 if before[0] else 1
+                await db.execute(
+                    "UPDATE habit_records SET completed = ? WHERE habit_id = ? AND date = ?",
+                    (new_status, habit_id, date)
+                )
+                after = (new_status, before[1])
+            else:
+                await db.execute(
+                    "INSERT INTO habit_records (habit_id, date, completed) VALUES (?, ?, 1)",
+                    (habit_id, date)
+                )
+                new_status = 1
+                after = (1, 0)
+            await self._apply_record_change(db, habit_id, date, before, after)
             await db.commit()
             return new_status == 1
 
     async def get_habit_stats(self, habit_id: int, days: int = 30) -> Dict:
         """Получение статистики привычки за последние N дней"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 """SELECT COUNT(*) as total, SUM(completed) as completed 
                    FROM habit_records 
@@ -822,68 +1424,150 @@ class Database:
                     "completion_rate": (completed / total * 100) if total > 0 else 0
                 }
 
-    async def increment_habit_count(self, habit_id: int, date: str = None) -> int:
-        """Увеличивает счетчик привычки на 1 для указанной даты (по умолчанию сегодня). Записывает completed_at."""
-        from datetime import date as dt_date
-        if date is None:
-            date = dt_date.today().isoformat()
+    async def increment_habit_count(self, habit_id: int, date: str = None, delta: int = 1) -> int:
+        """
+        Увеличивает счетчик привычки на delta (по умолчанию 1) для указанной даты (по умолчанию сегодня
+        в часовом поясе пользователя). Записывает completed_at. Несколько нажатий можно передать одним
+        вызовом через delta.
+        """
+        delta = max(1, int(delta))
         now = datetime.now()
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
+            if date is None:
+                date = await _local_today(db, habit_id=habit_id)
+            before = await self._lock_habit_record(db, habit_id, date)
             async with db.execute(
-                "SELECT count FROM habit_records WHERE habit_id = ? AND date = ?",
-                (habit_id, date)
+                """INSERT INTO habit_records (habit_id, date, count, completed, completed_at)
+                   VALUES (?, ?, ?, 1, ?)
+                   ON CONFLICT(habit_id, date) DO UPDATE SET
+                       count = COALESCE(count, 0) + excluded.count,
+                       completed = 1,
+                       completed_at = COALESCE(completed_at, excluded.completed_at)
+                   RETURNING count""",
+                (habit_id, date, delta, now),
             ) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    new_count = (row[0] or 0) + 1
-                    await db.execute(
-                        "UPDATE habit_records SET count = ?, completed = 1, completed_at = COALESCE(completed_at, ?) WHERE habit_id = ? AND date = ?",
-                        (new_count, now, habit_id, date)
-                    )
-                else:
-                    new_count = 1
-                    await db.execute(
-                        "INSERT INTO habit_records (habit_id, date, count, completed, completed_at) VALUES (?, ?, 1, 1, ?)",
-                        (habit_id, date, now)
-                    )
+                new_count = (await cursor.fetchone())[0]
+            await self._apply_record_change(db, habit_id, date, before, (1, new_count))
             await db.commit()
             return new_count
 
-    async def decrement_habit_count(self, habit_id: int, date: str = None) -> int:
-        """Уменьшает счетчик привычки на 1 для указанной даты (по умолчанию сегодня)"""
-        from datetime import date as dt_date
-        if date is None:
-            date = dt_date.today().isoformat()
-        
-        async with aiosqlite.connect(self.db_path) as db:
-            # Проверяем существующую запись
+    async def decrement_habit_count(self, habit_id: int, date: str = None, delta: int = 1) -> int:
+        """Уменьшает счетчик привычки на delta (по умолчанию 1) для указанной даты (по умолчанию сегодня в поясе пользователя)"""
+        delta = max(1, int(delta))
+        async with self._write() as db:
+            if date is None:
+                date = await _local_today(db, habit_id=habit_id)
+            before = await self._lock_habit_record(db, habit_id, date)
             async with db.execute(
-                "SELECT count FROM habit_records WHERE habit_id = ? AND date = ?",
-                (habit_id, date)
+                """UPDATE habit_records SET count = MAX(count - ?, 0)
+                   WHERE habit_id = ? AND date = ? AND count > 0
+                   RETURNING completed, count""",
+                (delta, habit_id, date),
             ) as cursor:
                 row = await cursor.fetchone()
-                if row and row[0] and row[0] > 0:
-                    new_count = row[0] - 1
-                    if new_count > 0:
-                        await db.execute(
-                            "UPDATE habit_records SET count = ? WHERE habit_id = ? AND date = ?",
-                            (new_count, habit_id, date)
-                        )
-                    else:
-                        # Удаляем запись если счетчик стал 0
-                        await db.execute(
-                            "DELETE FROM habit_records WHERE habit_id = ? AND date = ?",
-                            (habit_id, date)
-                        )
-                        new_count = 0
-                else:
-                    new_count = 0
+            if row is None:
+                await db.rollback()
+                return 0
+            new_count = row[1]
+            after = (row[0], new_count)
+            if new_count == 0:
+                # Удаляем запись если счетчик стал 0
+                await db.execute("DELETE FROM habit_records WHERE habit_id = ? AND date = ?", (habit_id, date))
+                after = None
+            await self._apply_record_change(db, habit_id, date, before, after)
             await db.commit()
             return new_count
 
+    async def _lock_habit_record(
+        self, db: aiosqlite.Connection, habit_id: int, date: str
+    ) -> Optional[Tuple[int, int]]:
+        """
+        Начать транзакцию с блокировкой на запись (BEGIN IMMEDIATE) и прочитать запись за date.
+        Между чтением и изменением ни бот, ни веб-сервер, ни другое соединение не могут записать —
+        нажатия не теряются. Прежнее состояние нужно счётчикам привычки (_apply_record_change).
+        """
+        await db.execute("BEGIN IMMEDIATE")
+        async with db.execute(
+            "SELECT completed, count FROM habit_records WHERE habit_id = ? AND date = ?", (habit_id, date)
+        ) as cursor:
+            row = await cursor.fetchone()
+        return (row[0], row[1]) if row else None
+
+    async def _apply_record_change(
+        self,
+        db: aiosqlite.Connection,
+        habit_id: int,
+        date: str,
+        before: Optional[Tuple[int, int]],
+        after: Optional[Tuple[int, int]],
+    ) -> None:
+        """
+        Обновить счётчики привычки в той же транзакции, где изменилась запись (completed, count) за date.
+        Отметка за новый последний день продлевает серию арифметикой; правка прошлого или снятие
+        отметки пересчитывает серии этой привычки по индексу habit_records.
+        """
+        from datetime import date as dt_date
+        delta = _record_contribution(after) - _record_contribution(before)
+        was_done, is_done = _record_done(before), _record_done(after)
+        if was_done != is_done and date == await _local_today(db, habit_id=habit_id):
+            # Выполнение за сегодня (в поясе пользователя, как у воркера) снимает, а отмена возвращает напоминания
+            await _publish_habit_event(db, habit_id, is_done)
+        if was_done == is_done:
+            if delta:
+                await db.execute(
+                    "UPDATE habits SET total_completions = COALESCE(total_completions, 0) + ? WHERE id = ?",
+                    (delta, habit_id),
+                )
+            return
+        if is_done:
+            async with db.execute(
+                "SELECT last_done_date, current_streak, longest_streak FROM habits WHERE id = ?", (habit_id,)
+            ) as c:
+                row = await c.fetchone()
+            last = row[0] if row else None
+            if row and (last is None or date > last):
+                from datetime import timedelta
+                next_day = (dt_date.fromisoformat(last) + timedelta(days=1)).isoformat() if last else None
+                streak = (row[1] or 0) + 1 if date == next_day else 1
+                await db.execute(
+                    """UPDATE habits SET total_completions = COALESCE(total_completions, 0) + ?,
+                              current_streak = ?, longest_streak = MAX(COALESCE(longest_streak, 0), ?),
+                              last_done_date = ?
+                       WHERE id = ?""",
+                    (delta, streak, streak, date, habit_id),
+                )
+                return
+        await _store_habit_counters(db, await _compute_habit_counters(db, habit_id))
+
+    async def check_habit_counters(self, fix: bool = False) -> List[Dict]:
+        """
+        Сверить счётчики в habits с пересчётом по habit_records.
+        Возвращает расхождения [{habit_id, field, stored, expected}]; при fix=True исправляет их.
+        """
+        async with self._write() as db:
+            expected = await _compute_habit_counters(db)
+            async with db.execute(
+                "SELECT id, total_completions, current_streak, longest_streak, last_done_date FROM habits"
+            ) as c:
+                stored = {row[0]: tuple(row[1:]) for row in await c.fetchall()}
+            mismatches = []
+            broken = []
+            for row in expected:
+                have = stored.get(row[0])
+                if have is None or have == row[1:]:
+                    continue
+                broken.append(row)
+                for field, got, want in zip(_HABIT_COUNTER_FIELDS, have, row[1:]):
+                    if got != want:
+                        mismatches.append({"habit_id": row[0], "field": field, "stored": got, "expected": want})
+            if fix and broken:
+                await _store_habit_counters(db, broken)
+                await db.commit()
+        return mismatches
+
     async def set_habit_achievement_notified(self, habit_id: int) -> None:
         """Пометить, что уведомление о достижении 21 для привычки уже отправлено."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute("UPDATE habits SET achievement_21_notified = 1 WHERE id = ?", (habit_id,))
             await db.commit()
 
@@ -894,12 +1578,13 @@ class Database:
         title = ((habit.get("title") or "").strip() or "Привычка") if habit else "Привычка"
         total_completions = await self.get_habit_total_completions(habit_id) if habit else 0
 
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             if user_id and total_completions >= 21:
                 await db.execute(
                     "INSERT INTO user_achievements (user_id, habit_title) VALUES (?, ?)",
                     (user_id, title),
                 )
+            await _mark_schedule_dirty(db, habit_id=habit_id)
             await db.execute("DELETE FROM habits WHERE id = ?", (habit_id,))
             await db.execute("DELETE FROM habit_records WHERE habit_id = ?", (habit_id,))
             await db.execute("DELETE FROM habit_reminder_settings WHERE habit_id = ?", (habit_id,))
@@ -907,8 +1592,7 @@ class Database:
 
     async def get_user_achievements(self, user_id: int) -> List[Dict]:
         """Сохранённые достижения (привычки с 21 днём, удалённые пользователем)."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                 "SELECT habit_title, achieved_at FROM user_achievements WHERE user_id = ? ORDER BY achieved_at DESC",
                 (user_id,),
@@ -923,13 +1607,17 @@ class Database:
 
     async def get_user_reminder_settings(self, user_id: int) -> Dict:
         """Настройки напоминаний пользователя (по умолчанию включены)."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                 "SELECT * FROM user_reminder_settings WHERE user_id = ?", (user_id,)
             ) as c:
                 row = await c.fetchone()
-        if not row:
+        return self._reminder_settings(dict(row) if row else None)
+
+    @staticmethod
+    def _reminder_settings(r: Optional[Dict]) -> Dict:
+        """Строка user_reminder_settings (или None — настроек нет) -> словарь с умолчаниями."""
+        if not r:
             return {
                 "notifications_enabled": True,
                 "quiet_hours_start": None,
@@ -937,7 +1625,6 @@ class Database:
                 "reminder_intensity": 2,
                 "first_reminder_sent": False,
             }
-        r = dict(row)
         return {
             "notifications_enabled": bool(r.get("notifications_enabled", 1)),
             "quiet_hours_start": r.get("quiet_hours_start"),
@@ -961,7 +1648,7 @@ class Database:
         qe = cur["quiet_hours_end"] if quiet_hours_end is None else quiet_hours_end
         ri = cur["reminder_intensity"] if reminder_intensity is None else reminder_intensity
         first = cur["first_reminder_sent"]
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 """INSERT INTO user_reminder_settings
                    (user_id, notifications_enabled, quiet_hours_start, quiet_hours_end, reminder_intensity, first_reminder_sent)
@@ -975,11 +1662,12 @@ class Database:
                 """,
                 (user_id, 1 if ne else 0, qs, qe, ri, 1 if first else 0),
             )
+            await _mark_schedule_dirty(db, user_id)
             await db.commit()
 
     async def set_first_reminder_sent(self, user_id: int) -> None:
         """Отметить, что первое напоминание пользователю отправлено."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 """INSERT INTO user_reminder_settings (user_id, notifications_enabled, first_reminder_sent)
                    VALUES (?, 1, 1) ON CONFLICT(user_id) DO UPDATE SET first_reminder_sent = 1""",
@@ -989,7 +1677,7 @@ class Database:
 
     async def get_habit_reminder_enabled(self, habit_id: int) -> bool:
         """Включены ли напоминания для привычки (по умолчанию да)."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 "SELECT reminders_enabled FROM habit_reminder_settings WHERE habit_id = ?",
                 (habit_id,),
@@ -999,12 +1687,13 @@ class Database:
 
     async def set_habit_reminder_enabled(self, habit_id: int, enabled: bool) -> None:
         """Включить/выключить напоминания для привычки."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 """INSERT INTO habit_reminder_settings (habit_id, reminders_enabled)
                    VALUES (?, ?) ON CONFLICT(habit_id) DO UPDATE SET reminders_enabled = ?""",
                 (habit_id, 1 if enabled else 0, 1 if enabled else 0),
             )
+            await _mark_schedule_dirty(db, habit_id=habit_id)
             await db.commit()
 
     async def log_reminder_sent(
@@ -1015,12 +1704,15 @@ class Database:
         goal_id: Optional[int] = None,
         mission_id: Optional[int] = None,
     ) -> None:
-        """Записать отправку напоминания."""
-        async with aiosqlite.connect(self.db_path) as db:
+        """Записать отправку напоминания (sent_on — дата отправки для проверки «сегодня»)."""
+        from datetime import date
+        today = date.today().isoformat()
+        async with self._write() as db:
             await db.execute(
-                """INSERT INTO reminder_sent_log (user_id, habit_id, goal_id, mission_id, reminder_type)
-                   VALUES (?, ?, ?, ?, ?)""",
-                (user_id, habit_id, goal_id, mission_id, reminder_type),
+                """INSERT OR IGNORE INTO reminder_sent_log
+                   (user_id, habit_id, goal_id, mission_id, reminder_type, sent_on)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (user_id, habit_id, goal_id, mission_id, reminder_type, today),
             )
             await db.commit()
 
@@ -1030,19 +1722,19 @@ class Database:
         """Было ли уже отправлено сегодня напоминание этого типа (для привычки или общее)."""
         from datetime import date
         today = date.today().isoformat()
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             if habit_id is not None:
                 async with db.execute(
                     """SELECT 1 FROM reminder_sent_log
                        WHERE user_id = ? AND habit_id = ? AND reminder_type = ?
-                         AND date(sent_at) = ?""",
+                         AND sent_on = ?""",
                     (user_id, habit_id, reminder_type, today),
                 ) as c:
                     row = await c.fetchone()
             else:
                 async with db.execute(
                     """SELECT 1 FROM reminder_sent_log
-                       WHERE user_id = ? AND reminder_type = ? AND date(sent_at) = ?""",
+                       WHERE user_id = ? AND reminder_type = ? AND sent_on = ?""",
                     (user_id, reminder_type, today),
                 ) as c:
                     row = await c.fetchone()
@@ -1054,10 +1746,10 @@ class Database:
         """Было ли уже отправлено сегодня напоминание по миссии."""
         from datetime import date
         today = date.today().isoformat()
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 """SELECT 1 FROM reminder_sent_log
-                   WHERE user_id = ? AND mission_id = ? AND reminder_type = ? AND date(sent_at) = ?""",
+                   WHERE user_id = ? AND mission_id = ? AND reminder_type = ? AND sent_on = ?""",
                 (user_id, mission_id, reminder_type, today),
             ) as c:
                 row = await c.fetchone()
@@ -1065,20 +1757,47 @@ class Database:
 
     async def get_habit_avg_completion_time(self, habit_id: int, days: int = 30) -> Optional[str]:
         """Среднее время выполнения привычки за последние days дней (строка HH:MM или None)."""
-        async with aiosqlite.connect(self.db_path) as db:
+        from datetime import date, timedelta
+        since = (date.today() - timedelta(days=days)).isoformat()
+        async with self._read() as db:
+            async with db.execute(f"SELECT {_HABIT_MINUTES_EXPR} FROM habits h WHERE h.id = ?", (since, habit_id)) as c:
+                row = await c.fetchone()
+        if row is None or row[0] is None:
+            return None
+        return f"{row[0] // 60:02d}:{row[0] % 60:02d}"
+
+    async def get_habit_minutes(
+        self,
+        user_ids: Optional[List[int]] = None,
+        shard: Optional[Tuple[int, Sequence[int]]] = None,
+        days: int = 30,
+    ) -> Dict[int, Optional[int]]:
+        """
+        {habit_id: обычное время выполнения в минутах от полуночи} для активных привычек пользователей
+        user_ids / шардов shard (None — всех): круговое среднее за days дней одним запросом (_HABIT_MINUTES_EXPR).
+        None — у привычки нет отметок со временем.
+        """
+        from datetime import date, timedelta
+        since = (date.today() - timedelta(days=days)).isoformat()
+        scope, params = _shard_filter(shard, "h.user_id")
+        if user_ids is not None:
+            if not user_ids:
+                return {}
+            scope += f" AND h.user_id IN ({','.join('?' * len(user_ids))})"
+            params += tuple(user_ids)
+        async with self._read() as db:
             async with db.execute(
-                """SELECT completed_at FROM habit_records
-                   WHERE habit_id = ? AND completed_at IS NOT NULL
-                     AND date >= date('now', '-' || ? || ' days')
-                   ORDER BY date DESC""",
-                (habit_id, days),
+                f"SELECT h.id, {_HABIT_MINUTES_EXPR} FROM habits h WHERE h.is_active = 1" + scope, (since, *params)
             ) as c:
-                rows = await c.fetchall()
-        if not rows:
-            return None
+                return {hid: minutes for hid, minutes in await c.fetchall()}
+
+    @staticmethod
+    def _avg_time_of_day(values) -> Optional[str]:
+        """Среднее время суток (HH:MM) по значениям completed_at: "YYYY-MM-DD HH:MM:SS" или "HH:MM".
+        Круговое среднее, как в _HABIT_MINUTES_EXPR: 23:50 и 00:10 дают 00:00."""
         from datetime import datetime as dt
         times = []
-        for (t,) in rows:
+        for t in values:
             if t is None:
                 continue
             try:
@@ -1092,9 +1811,9 @@ class Database:
         times = [x for x in times if x is not None]
         if not times:
             return None
-        # Среднее время по минутам от полуночи
-        total_min = sum(t.hour * 60 + t.minute for t in times)
-        avg_min = total_min // len(times)
+        angles = [(t.hour * 60 + t.minute) * 2 * math.pi / 1440 for t in times]
+        angle = math.atan2(sum(map(math.sin, angles)), sum(map(math.cos, angles)))
+        avg_min = (int(round(angle * 1440 / (2 * math.pi))) + 1440) % 1440
         h, m = avg_min // 60, avg_min % 60
         return f"{h:02d}:{m:02d}"
 
@@ -1108,7 +1827,7 @@ class Database:
             habit_id = h["id"]
             if not await self.get_habit_reminder_enabled(habit_id):
                 continue
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._read() as db:
                 async with db.execute(
                     "SELECT 1 FROM habit_records WHERE habit_id = ? AND date = ? AND (completed = 1 OR count > 0)",
                     (habit_id, today),
@@ -1118,9 +1837,263 @@ class Database:
                 out.append(h)
         return out
 
+    async def get_reminder_snapshot(
+        self,
+        today: Optional[str] = None,
+        mission_deadline: Optional[str] = None,
+        with_goals: bool = False,
+        user_ids: Optional[List[int]] = None,
+        shard: Optional[Tuple[int, Sequence[int]]] = None,
+        habit_minutes: Optional[Dict[int, Optional[int]]] = None,
+    ) -> Dict:
+        """
+        Всё, что нужно одному тику воркера напоминаний, несколькими общими запросами (без цикла по пользователям):
+          settings — {user_id: настройки} для пользователей с включёнными уведомлениями;
+          habits — {user_id: [{id, title, avg_min}]}: активные привычки с напоминаниями, не выполненные today,
+                   avg_min — обычное время выполнения за 30 дней в минутах от полуночи (None — нет истории):
+                   из habit_minutes (кэш воркера, см. get_habit_minutes) или тем же запросом по области снимка;
+          sent — {(user_id, habit_id, reminder_type)}, sent_any — {(user_id, reminder_type)},
+                 sent_missions — {(user_id, mission_id, reminder_type)}: что уже отправлено сегодня;
+          missions — {user_id: [{id, title}]}: незавершённые миссии с дедлайном mission_deadline;
+          open_goals — {user_id: число незавершённых целей} (только при with_goals).
+        user_ids — ограничить снимок этими пользователями (пересчёт расписания, пачка due-напоминаний),
+        shard — (N, номера шардов): только пользователи с user_id % N из списка.
+        """
+        from datetime import date, timedelta
+        today = today or date.today().isoformat()
+
+        def only(col: str) -> Tuple[str, tuple]:
+            sql, params = _shard_filter(shard, col)
+            if user_ids is not None:
+                sql += f" AND {col} IN ({','.join('?' * len(user_ids))})"
+                params += tuple(user_ids)
+            return sql, params
+        users_sql, users_params = only("u.user_id")
+        habits_sql, habits_params = only("h.user_id")
+        where_sql, where_params = only("user_id")
+        snapshot: Dict = {
+            "settings": {}, "habits": {}, "sent": set(), "sent_any": set(),
+            "sent_missions": set(), "missions": {}, "open_goals": {},
+        }
+        async with self._read() as db:
+            async with db.execute(
+                """SELECT u.user_id AS uid, s.user_id AS settings_user_id, s.notifications_enabled,
+                          s.quiet_hours_start, s.quiet_hours_end, s.reminder_intensity, s.first_reminder_sent
+                   FROM users u
+                   LEFT JOIN user_reminder_settings s ON s.user_id = u.user_id
+                   WHERE u.user_id NOT IN (SELECT user_id FROM user_reminder_settings WHERE notifications_enabled = 0)"""
+                + users_sql,
+                users_params,
+            ) as c:
+                for row in await c.fetchall():
+                    r = dict(row)
+                    snapshot["settings"][r["uid"]] = self._reminder_settings(
+                        r if r["settings_user_id"] is not None else None
+                    )
+            if habit_minutes is None:
+                minutes_sql = _HABIT_MINUTES_EXPR
+                minutes_params: tuple = ((date.fromisoformat(today) - timedelta(days=30)).isoformat(),)
+            else:
+                minutes_sql, minutes_params = "NULL", ()
+            async with db.execute(
+                f"""SELECT h.user_id, h.id, h.title, {minutes_sql} AS avg_min
+                   FROM habits h
+                   LEFT JOIN habit_reminder_settings hrs ON hrs.habit_id = h.id
+                   LEFT JOIN habit_records hr ON hr.habit_id = h.id AND hr.date = ?
+                   WHERE h.is_active = 1
+                     AND (hrs.habit_id IS NULL OR COALESCE(hrs.reminders_enabled, 0) != 0)
+                     AND NOT COALESCE(hr.completed = 1 OR hr.count > 0, 0)"""
+                + habits_sql
+                + " ORDER BY h.user_id, COALESCE(h.sort_order, 999999), h.created_at DESC",
+                (*minutes_params, today, *habits_params),
+            ) as c:
+                for uid, hid, title, avg_min in await c.fetchall():
+                    if uid in snapshot["settings"]:
+                        if habit_minutes is not None:
+                            avg_min = habit_minutes.get(hid)
+                        snapshot["habits"].setdefault(uid, []).append({"id": hid, "title": title, "avg_min": avg_min})
+            async with db.execute(
+                "SELECT user_id, habit_id, mission_id, reminder_type FROM reminder_sent_log WHERE sent_on = ?"
+                + where_sql,
+                (today, *where_params),
+            ) as c:
+                for uid, hid, mid, rtype in await c.fetchall():
+                    snapshot["sent_any"].add((uid, rtype))
+                    if hid is not None:
+                        snapshot["sent"].add((uid, hid, rtype))
+                    if mid is not None:
+                        snapshot["sent_missions"].add((uid, mid, rtype))
+            if mission_deadline:
+                next_day = (date.fromisoformat(mission_deadline) + timedelta(days=1)).isoformat()
+                async with db.execute(
+                    """SELECT user_id, id, title FROM missions
+                       WHERE deadline >= ? AND deadline < ? AND is_completed = 0"""
+                    + where_sql
+                    + " ORDER BY user_id, COALESCE(sort_order, 999999), created_at DESC",
+                    (mission_deadline, next_day, *where_params),
+                ) as c:
+                    for uid, mid, title in await c.fetchall():
+                        snapshot["missions"].setdefault(uid, []).append({"id": mid, "title": title})
+            if with_goals:
+                async with db.execute(
+                    "SELECT user_id, COUNT(*) FROM goals WHERE is_completed = 0" + where_sql + " GROUP BY user_id",
+                    where_params,
+                ) as c:
+                    snapshot["open_goals"] = {uid: n for uid, n in await c.fetchall()}
+        return snapshot
+
+    # --- Расписание напоминаний: строки (user_id, habit_id, mission_id, reminder_type, due_at UTC) ---
+
+    async def replace_reminder_schedule(
+        self,
+        rows: List[tuple],
+        user_ids: Optional[List[int]] = None,
+        shard: Optional[Tuple[int, Sequence[int]]] = None,
+    ) -> None:
+        """Заменить расписание: у указанных пользователей, у пользователей шардов shard
+        или целиком (ночная пересборка одного воркера)."""
+        async with self._write() as db:
+            if user_ids is not None:
+                for start in range(0, len(user_ids), 1000):
+                    chunk = user_ids[start:start + 1000]
+                    await db.execute(
+                        f"DELETE FROM reminder_schedule WHERE user_id IN ({','.join('?' * len(chunk))})",
+                        tuple(chunk),
+                    )
+            else:
+                shard_sql, shard_params = _shard_filter(shard)
+                await db.execute("DELETE FROM reminder_schedule WHERE 1" + shard_sql, shard_params)
+            await db.executemany(
+                "INSERT INTO reminder_schedule (user_id, habit_id, mission_id, reminder_type, due_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            await db.commit()
+
+    async def add_reminder_schedule(self, rows: List[tuple]) -> None:
+        """Добавить строки в расписание (например, повтор неудавшейся отправки)."""
+        await self.replace_reminder_schedule(rows, user_ids=[])
+
+    async def pop_due_reminders(
+        self, now_utc: str, limit: int = 500, shard: Optional[Tuple[int, Sequence[int]]] = None
+    ) -> List[Dict]:
+        """Забрать из расписания до limit строк с due_at <= now_utc (самые ранние первыми)."""
+        shard_sql, shard_params = _shard_filter(shard)
+        async with self._write() as db:
+            async with db.execute(
+                f"""DELETE FROM reminder_schedule
+                    WHERE id IN (SELECT id FROM reminder_schedule WHERE due_at <= ?{shard_sql}
+                                 ORDER BY due_at LIMIT ?)
+                    RETURNING user_id, habit_id, mission_id, reminder_type, due_at""",
+                (now_utc, *shard_params, limit),
+            ) as c:
+                rows = [dict(r) for r in await c.fetchall()]
+            await db.commit()
+        return rows
+
+    async def next_reminder_due_at(self, shard: Optional[Tuple[int, Sequence[int]]] = None) -> Optional[str]:
+        """Ближайший due_at в расписании (UTC, 'YYYY-MM-DD HH:MM:SS') или None, если расписание пусто."""
+        shard_sql, shard_params = _shard_filter(shard)
+        async with self._read() as db:
+            async with db.execute("SELECT MIN(due_at) FROM reminder_schedule WHERE 1" + shard_sql, shard_params) as c:
+                row = await c.fetchone()
+        return row[0] if row else None
+
+    async def take_reminder_schedule_dirty(self, shard: Optional[Tuple[int, Sequence[int]]] = None) -> List[int]:
+        """Забрать пользователей, помеченных к пересчёту расписания (см. _mark_schedule_dirty)."""
+        shard_sql, shard_params = _shard_filter(shard)
+        async with self._write() as db:
+            async with db.execute(
+                "DELETE FROM reminder_schedule_dirty WHERE 1" + shard_sql + " RETURNING user_id", shard_params
+            ) as c:
+                user_ids = [r[0] for r in await c.fetchall()]
+            await db.commit()
+        return user_ids
+
+    async def take_habit_events(self, shard: Optional[Tuple[int, Sequence[int]]] = None) -> Dict[int, Tuple[int, bool]]:
+        """Забрать события выполнения привычек (см. _publish_habit_event): {habit_id: (user_id, выполнена)}."""
+        shard_sql, shard_params = _shard_filter(shard)
+        async with self._write() as db:
+            async with db.execute(
+                "DELETE FROM reminder_habit_events WHERE 1" + shard_sql + " RETURNING habit_id, user_id, done",
+                shard_params,
+            ) as c:
+                events = {hid: (uid, bool(done)) for hid, uid, done in await c.fetchall()}
+            await db.commit()
+        return events
+
+    async def drop_habit_reminders(self, habit_ids: Sequence[int]) -> int:
+        """Удалить из расписания напоминания по привычкам habit_ids. Возвращает число удалённых строк."""
+        dropped = 0
+        async with self._write() as db:
+            for start in range(0, len(habit_ids), 1000):
+                chunk = list(habit_ids[start:start + 1000])
+                async with db.execute(
+                    f"DELETE FROM reminder_schedule WHERE habit_id IN ({','.join('?' * len(chunk))})", chunk
+                ) as c:
+                    dropped += c.rowcount
+            await db.commit()
+        return dropped
+
+    async def heartbeat_reminder_shard(self, shard: int, shard_count: int, owner: str) -> None:
+        """Продлить аренду шарда воркера напоминаний."""
+        import time
+        async with self._write() as db:
+            await db.execute(
+                """INSERT INTO reminder_shard_lease (shard_count, shard, owner, heartbeat_at) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(shard_count, shard) DO UPDATE SET
+                     owner = excluded.owner, heartbeat_at = excluded.heartbeat_at""",
+                (shard_count, shard, owner, time.time()),
+            )
+            await db.commit()
+
+    async def get_reminder_shard_leases(self, shard_count: int) -> Dict[int, float]:
+        """{номер шарда: время последнего heartbeat (unix)} для разбиения на shard_count шардов."""
+        async with self._read() as db:
+            async with db.execute(
+                "SELECT shard, heartbeat_at FROM reminder_shard_lease WHERE shard_count = ?", (shard_count,)
+            ) as c:
+                return {shard: ts for shard, ts in await c.fetchall()}
+
+    async def claim_reminders(self, keys: List[tuple]) -> List[Optional[int]]:
+        """
+        Занять отправку напоминаний одним INSERT OR IGNORE … RETURNING в reminder_sent_log
+        по уникальному ключу (user_id, habit_id, mission_id, reminder_type, sent_on).
+        keys — [(user_id, reminder_type, habit_id, mission_id[, sent_on])], sent_on — местная дата
+        пользователя (по умолчанию сегодня по часам сервера); результат выровнен по keys:
+        id записи или None, если напоминание уже занято (отправлено) другим тиком или шардом.
+        """
+        from datetime import date
+        today = date.today().isoformat()
+        keys = [(uid, rtype, hid, mid, rest[0] if rest else today) for uid, rtype, hid, mid, *rest in keys]
+        claimed: Dict[tuple, int] = {}
+        async with self._write() as db:
+            for start in range(0, len(keys), 1000):
+                chunk = keys[start:start + 1000]
+                async with db.execute(
+                    "INSERT OR IGNORE INTO reminder_sent_log (user_id, habit_id, mission_id, reminder_type, sent_on)"
+                    f" VALUES {','.join(['(?, ?, ?, ?, ?)'] * len(chunk))}"
+                    " RETURNING id, user_id, habit_id, mission_id, reminder_type, sent_on",
+                    [v for uid, rtype, hid, mid, day in chunk for v in (uid, hid, mid, rtype, day)],
+                ) as c:
+                    for rid, uid, hid, mid, rtype, day in await c.fetchall():
+                        claimed[(uid, rtype, hid or 0, mid or 0, day)] = rid
+            await db.commit()
+        return [claimed.get((uid, rtype, hid or 0, mid or 0, day)) for uid, rtype, hid, mid, day in keys]
+
+    async def release_reminder_claims(self, claim_ids: List[int]) -> None:
+        """Снять занятые отправки, которые не удалось доставить (их можно будет повторить)."""
+        if not claim_ids:
+            return
+        async with self._write() as db:
+            await db.execute(
+                f"DELETE FROM reminder_sent_log WHERE id IN ({','.join('?' * len(claim_ids))})", tuple(claim_ids)
+            )
+            await db.commit()
+
     async def get_users_with_reminders_enabled(self) -> List[int]:
         """user_id всех пользователей, у которых включены уведомления (по умолчанию включены)."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 """SELECT user_id FROM users
                    WHERE user_id NOT IN (SELECT user_id FROM user_reminder_settings WHERE notifications_enabled = 0)"""
@@ -1130,17 +2103,15 @@ class Database:
 
     async def get_all_user_ids(self) -> List[int]:
         """Список user_id всех пользователей в БД."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT user_id FROM users") as c:
                 rows = await c.fetchall()
         return [r[0] for r in rows]
 
     async def get_todays_habit_titles(self, user_id: int) -> List[str]:
-        """Список названий привычек, отмеченных сегодня (хотя бы одно выполнение)."""
-        from datetime import date
-        today = date.today().isoformat()
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        """Список названий привычек, отмеченных сегодня в поясе пользователя (хотя бы одно выполнение)."""
+        async with self._read() as db:
+            today = await _local_today(db, user_id=user_id)
             async with db.execute(
                 """
                 SELECT h.title FROM habits h
@@ -1165,8 +2136,7 @@ class Database:
         last = date(year, month, last_day)
         total_habits = len(await self.get_habits(user_id, active_only=True))
         result = {}
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                 """
                 SELECT hr.date,
@@ -1195,24 +2165,24 @@ class Database:
 
     async def get_habit_last_7_days(self, user_id: int) -> Dict:
         """
-        Для каждой привычки — статус за последние 7 дней (включая сегодня).
+        Для каждой привычки — статус за последние 7 дней (включая сегодня в поясе пользователя).
         dates: [старая, ..., сегодня], habits: [{ id, title, days: [0|1, ...] }]
         """
         from datetime import date, timedelta
-        today = date.today()
-        dates = [(today - timedelta(days=i)).isoformat() for i in range(6, -1, -1)]
         habits = await self.get_habits(user_id, active_only=True)
         result = []
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
+            today = date.fromisoformat(await _local_today(db, user_id=user_id))
+            dates = [(today - timedelta(days=i)).isoformat() for i in range(6, -1, -1)]
             for h in habits:
                 hid = h.get("id")
                 title = (h.get("title") or "").strip() or "Привычка"
                 done_dates = set()
                 async with db.execute(
                     """SELECT date FROM habit_records
-                       WHERE habit_id = ? AND date >= date('now', '-6 days')
+                       WHERE habit_id = ? AND date >= ?
                          AND (completed = 1 OR COALESCE(count, 0) > 0)""",
-                    (hid,),
+                    (hid, dates[0]),
                 ) as c:
                     for row in await c.fetchall():
                         done_dates.add(row[0])
@@ -1221,33 +2191,35 @@ class Database:
         return {"dates": dates, "habits": result}
 
     async def get_habit_completions_by_date(self, user_id: int, days: int = 30) -> List[Dict]:
-        """По дням: дата и суммарное количество выполнений привычек за день (для графика)."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        """По дням: дата и суммарное количество выполнений привычек за день (для графика), дни — в поясе пользователя."""
+        from datetime import date, timedelta
+        async with self._read() as db:
+            today = date.fromisoformat(await _local_today(db, user_id=user_id))
+            since = (today - timedelta(days=days)).isoformat()
             async with db.execute(
                 """
                 SELECT hr.date, SUM(COALESCE(hr.count, 0)) as total
                 FROM habit_records hr
                 JOIN habits h ON h.id = hr.habit_id AND h.user_id = ?
-                WHERE hr.date >= date('now', '-' || ? || ' days')
+                WHERE hr.date >= ?
                 GROUP BY hr.date
                 ORDER BY hr.date
                 """,
-                (user_id, days),
+                (user_id, since),
             ) as cursor:
                 rows = await cursor.fetchall()
                 return [{"date": row[0], "completions": int(row[1] or 0)} for row in rows]
 
     async def get_habit_streak(self, user_id: int) -> int:
-        """Текущая серия дней подряд с хотя бы одним выполнением привычки (считая сегодня)."""
+        """Текущая серия дней подряд с хотя бы одним выполнением привычки (считая сегодня в поясе пользователя)."""
         by_date = await self.get_habit_completions_by_date(user_id, days=365)
         if not by_date:
             return 0
         by_date_dict = {r["date"]: r["completions"] for r in by_date}
         from datetime import date, timedelta
-        today = date.today().isoformat()
+        async with self._read() as db:
+            d = date.fromisoformat(await _local_today(db, user_id=user_id))
         streak = 0
-        d = date.today()
         for _ in range(365):
             key = d.isoformat()
             if by_date_dict.get(key, 0) > 0:
@@ -1259,7 +2231,7 @@ class Database:
 
     async def get_habit_days_total(self, habit_id: int, days: int = 365) -> int:
         """Всего дней (не обязательно подряд) с выполнением привычки за последние days дней."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 """SELECT COUNT(DISTINCT date) FROM habit_records
                    WHERE habit_id = ? AND date >= date('now', '-' || ? || ' days')
@@ -1271,66 +2243,47 @@ class Database:
 
     async def get_habit_total_completions(self, habit_id: int) -> int:
         """Сумма всех повторений (count) по привычке — для прогресс-бара и достижения 21."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
+            async with db.execute("SELECT total_completions FROM habits WHERE id = ?", (habit_id,)) as c:
+                row = await c.fetchone()
+                return int(row[0] or 0) if row else 0
+
+    async def _get_done_dates(self, habit_id: int, days: int) -> Tuple[str, set]:
+        """Одним запросом: сегодня в поясе пользователя и даты с выполнением привычки за последние days дней."""
+        from datetime import date, timedelta
+        async with self._read() as db:
+            today = await _local_today(db, habit_id=habit_id)
+            since = (date.fromisoformat(today) - timedelta(days=max(days, 1) - 1)).isoformat()
             async with db.execute(
-                """SELECT COALESCE(SUM(COALESCE(NULLIF(count, 0), 1)), 0) FROM habit_records WHERE habit_id = ?""",
-                (habit_id,),
+                """SELECT date FROM habit_records
+                   WHERE habit_id = ? AND date >= ? AND (completed = 1 OR count > 0)""",
+                (habit_id, since),
             ) as c:
-                row = await c.fetchone()
-                return int(row[0] or 0)
+                return today, {row[0] for row in await c.fetchall()}
 
-    async def get_habit_streak_for_habit(self, habit_id: int, days: int = 365) -> int:
-        """Серия дней подряд выполнения данной привычки (считая сегодня)."""
+    @staticmethod
+    def _run_length(today: str, done_dates: set, days: int, done: bool) -> int:
+        """Сколько дней подряд, начиная с today, привычка была выполнена (done=True) или пропущена."""
         from datetime import date, timedelta
-        today = date.today().isoformat()
-        async with aiosqlite.connect(self.db_path) as db:
-            streak = 0
-            d = date.today()
-            for _ in range(days):
-                key = d.isoformat()
-                async with db.execute(
-                    """SELECT 1 FROM habit_records
-                       WHERE habit_id = ? AND date = ? AND (completed = 1 OR count > 0)""",
-                    (habit_id, key),
-                ) as c:
-                    row = await c.fetchone()
-                if row:
-                    streak += 1
-                    d -= timedelta(days=1)
-                else:
-                    break
-        return streak
+        d = date.fromisoformat(today)
+        n = 0
+        while n < days and (d.isoformat() in done_dates) == done:
+            n += 1
+            d -= timedelta(days=1)
+        return n
+
+    async def get_habit_streak_for_habit(self, habit_id: int, days: int = 365) -> int:
+        """Серия дней подряд выполнения данной привычки (считая сегодня). Экраны берут её из habits.current_streak."""
+        return self._run_length(*await self._get_done_dates(habit_id, days), days, True)
 
     async def get_habit_skip_streak(self, habit_id: int, days: int = 30) -> int:
         """Сколько дней подряд привычка не выполнялась (считая сегодня; 0 если сегодня выполнена)."""
-        from datetime import date, timedelta
-        today = date.today().isoformat()
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                "SELECT 1 FROM habit_records WHERE habit_id = ? AND date = ? AND (completed = 1 OR count > 0)",
-                (habit_id, today),
-            ) as c:
-                if await c.fetchone():
-                    return 0
-            skip = 0
-            d = date.today()
-            for _ in range(days):
-                key = d.isoformat()
-                async with db.execute(
-                    "SELECT 1 FROM habit_records WHERE habit_id = ? AND date = ? AND (completed = 1 OR count > 0)",
-                    (habit_id, key),
-                ) as c:
-                    row = await c.fetchone()
-                if row:
-                    break
-                skip += 1
-                d -= timedelta(days=1)
-        return skip
+        return self._run_length(*await self._get_done_dates(habit_id, days), days, False)
 
     # === АНАЛИТИКА ===
     async def get_user_analytics(self, user_id: int, days: int = 30) -> Dict:
         """Получение аналитики пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             # Статистика целей
             async with db.execute(
                 """SELECT COUNT(*) as total, SUM(is_completed) as completed 
@@ -1390,7 +2343,7 @@ class Database:
 
     async def user_examples_were_seeded_once(self, user_id: int) -> bool:
         """Были ли этому пользователю уже когда-то выданы примеры (если удалил — не добавлять снова)."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 "SELECT 1 FROM user_examples_seeded WHERE user_id = ? LIMIT 1",
                 (user_id,),
@@ -1399,7 +2352,7 @@ class Database:
 
     async def user_has_examples(self, user_id: int) -> bool:
         """Есть ли у пользователя сейчас предустановленные примеры (миссии/цели/привычки с is_example=1)."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             for table in ["missions", "goals", "habits"]:
                 try:
                     async with db.execute(
@@ -1414,7 +2367,7 @@ class Database:
 
     async def _mark_examples_seeded(self, user_id: int) -> None:
         """Отметить, что этому пользователю уже выдавались примеры (чтобы при удалении не добавлять снова)."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "INSERT OR IGNORE INTO user_examples_seeded (user_id) VALUES (?)",
                 (user_id,),
@@ -1464,7 +2417,7 @@ class Database:
     async def reset_user_data(self, user_id: int) -> None:
         """Сброс миссий, целей, привычек и аналитики. Профиль (имя, username, рост, вес и т.д.) не трогаем.
         После сброса добавляются предустановленные примеры (с плашкой «Пример»)."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "DELETE FROM subgoals WHERE mission_id IN (SELECT id FROM missions WHERE user_id = ?)",
                 (user_id,),
@@ -1482,6 +2435,7 @@ class Database:
             await db.execute("DELETE FROM habits WHERE user_id = ?", (user_id,))
             await db.execute("DELETE FROM analytics WHERE user_id = ?", (user_id,))
             await db.execute("DELETE FROM user_examples_seeded WHERE user_id = ?", (user_id,))
+            await _mark_schedule_dirty(db, user_id)
             await db.commit()
         await self.seed_user_examples(user_id)
         await self._mark_examples_seeded(user_id)
@@ -1491,7 +2445,7 @@ class Database:
         """Количество запросов к Шаолень за сегодня."""
         from datetime import date
         today = date.today().isoformat()
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 "SELECT request_count FROM shaolen_daily_requests WHERE user_id = ? AND date = ?",
                 (user_id, today),
@@ -1503,7 +2457,7 @@ class Database:
         """Увеличить счётчик запросов к Шаолень на сегодня на 1."""
         from datetime import date
         today = date.today().isoformat()
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 """INSERT INTO shaolen_daily_requests (user_id, date, request_count)
                    VALUES (?, ?, 1)
@@ -1516,7 +2470,7 @@ class Database:
         self, user_id: int, user_message: str, assistant_reply: str, has_image: bool = False
     ) -> None:
         """Добавить запись в историю запросов Шаолень."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 """INSERT INTO shaolen_history (user_id, user_message, assistant_reply, has_image)
                    VALUES (?, ?, ?, ?)""",
@@ -1526,8 +2480,7 @@ class Database:
 
     async def get_shaolen_history(self, user_id: int, limit: int = 50) -> List[Dict]:
         """Последние записи истории Шаолень по пользователю."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                 """SELECT id, user_id, created_at, user_message, assistant_reply, has_image
                    FROM shaolen_history WHERE user_id = ? ORDER BY created_at DESC LIMIT ?""",
@@ -1538,24 +2491,27 @@ class Database:
 
     async def get_all_users_with_stats(self) -> List[Dict]:
         """Для админки: все пользователи и агрегаты (число миссий, целей, привычек, запросов к Шаолень)."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                 """SELECT u.user_id, u.username, u.first_name, u.last_name, u.display_name, u.created_at,
                           (SELECT COUNT(*) FROM missions m WHERE m.user_id = u.user_id) AS missions_count,
                           (SELECT COUNT(*) FROM goals g WHERE g.user_id = u.user_id) AS goals_count,
                           (SELECT COUNT(*) FROM habits h WHERE h.user_id = u.user_id) AS habits_count,
                           (SELECT COUNT(*) FROM shaolen_history sh WHERE sh.user_id = u.user_id) AS shaolen_requests,
-                          (SELECT COUNT(*) FROM reminder_sent_log rsl WHERE rsl.user_id = u.user_id) AS reminders_count
-                   FROM users u ORDER BY u.user_id"""
+                          COALESCE(rl.n, 0) + COALESCE(rd.n, 0) AS reminders_count
+                   FROM users u
+                   LEFT JOIN (SELECT user_id, COUNT(*) AS n FROM reminder_sent_log GROUP BY user_id) rl
+                          ON rl.user_id = u.user_id
+                   LEFT JOIN (SELECT user_id, SUM(count) AS n FROM reminder_sent_daily GROUP BY user_id) rd
+                          ON rd.user_id = u.user_id
+                   ORDER BY u.user_id"""
             ) as c:
                 rows = await c.fetchall()
                 return [dict(r) for r in rows]
 
     async def get_shaolen_history_for_admin(self, limit: int = 200, offset: int = 0) -> List[Dict]:
         """Для админки: последние запросы к Шаолень с данными пользователя."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                 """SELECT sh.id, sh.user_id, sh.created_at, sh.user_message, sh.assistant_reply, sh.has_image,
                           u.username, u.first_name, u.last_name, u.display_name
@@ -1567,11 +2523,88 @@ class Database:
                 rows = await c.fetchall()
                 return [dict(r) for r in rows]
 
+    # === ОБСЛУЖИВАНИЕ: сроки хранения и место на диске (вызывается из maintenance.py) ===
+    async def rollup_reminder_sent_log(self, before: str) -> int:
+        """Свернуть reminder_sent_log за дни раньше before в reminder_sent_daily (по дню на транзакцию,
+        чтобы не держать запись надолго). Возвращает число удалённых строк журнала."""
+        async with self._read() as db:
+            async with db.execute(
+                "SELECT DISTINCT sent_on FROM reminder_sent_log WHERE sent_on < ? ORDER BY sent_on", (before,)
+            ) as c:
+                days = [r[0] for r in await c.fetchall()]
+        removed = 0
+        for day in days:
+            async with self._write() as db:
+                await db.execute(
+                    """INSERT INTO reminder_sent_daily (user_id, sent_on, reminder_type, count)
+                       SELECT user_id, sent_on, reminder_type, COUNT(*) FROM reminder_sent_log
+                       WHERE sent_on = ? GROUP BY user_id, reminder_type
+                       ON CONFLICT(user_id, sent_on, reminder_type) DO UPDATE SET count = count + excluded.count""",
+                    (day,),
+                )
+                cursor = await db.execute("DELETE FROM reminder_sent_log WHERE sent_on = ?", (day,))
+                removed += cursor.rowcount
+                await db.commit()
+        return removed
+
+    async def get_shaolen_history_before(self, before: str, after_id: int = 0, limit: int = 500) -> List[Dict]:
+        """Записи shaolen_history с created_at < before и id > after_id по возрастанию id (для архивации)."""
+        async with self._read() as db:
+            async with db.execute(
+                """SELECT id, user_id, created_at, user_message, assistant_reply, has_image
+                   FROM shaolen_history WHERE id > ? AND created_at < ? ORDER BY id LIMIT ?""",
+                (after_id, before, limit),
+            ) as c:
+                return [dict(r) for r in await c.fetchall()]
+
+    async def delete_shaolen_history(self, ids: List[int]) -> int:
+        """Удалить записи истории Шаолень по id (после того как они записаны в архив)."""
+        if not ids:
+            return 0
+        async with self._write() as db:
+            cursor = await db.execute(
+                f"DELETE FROM shaolen_history WHERE id IN ({','.join('?' * len(ids))})", tuple(ids)
+            )
+            await db.commit()
+            return cursor.rowcount
+
+    async def delete_rows_before(self, table: str, before: str) -> int:
+        """Удалить строки старше before из таблиц с дневной датой: analytics, shaolen_daily_requests."""
+        if table not in ("analytics", "shaolen_daily_requests"):
+            raise ValueError(f"delete_rows_before: таблица {table} не поддерживается")
+        async with self._write() as db:
+            cursor = await db.execute(f"DELETE FROM {table} WHERE date < ?", (before,))
+            await db.commit()
+            return cursor.rowcount
+
+    async def storage_stats(self) -> Dict:
+        """Размер БД: страницы, свободные страницы, режим auto_vacuum и байты файлов БД и WAL на диске."""
+        stats = {}
+        async with self._read() as db:
+            for pragma in ("page_size", "page_count", "freelist_count", "auto_vacuum"):
+                async with db.execute(f"PRAGMA {pragma}") as c:
+                    stats[pragma] = (await c.fetchone())[0]
+        stats["file_bytes"] = sum(
+            os.path.getsize(path) for path in (self.db_path, self.db_path + "-wal") if os.path.exists(path)
+        )
+        return stats
+
+    async def vacuum(self, full: bool = False) -> None:
+        """Вернуть свободные страницы файловой системе: PRAGMA incremental_vacuum (БД в режиме
+        auto_vacuum = INCREMENTAL) или, при full, полный VACUUM с переводом БД в этот режим."""
+        async with self._write() as db:
+            if full:
+                await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                await db.execute("VACUUM")
+            else:
+                # Прагма освобождает по странице за шаг, а execute() делает только первый шаг;
+                # executescript выполняет её до конца
+                await db.executescript("PRAGMA incremental_vacuum;")
+
     # === КАПСУЛА ВРЕМЕНИ (одна на пользователя) ===
     async def get_time_capsule(self, user_id: int) -> Optional[Dict]:
         """Получить капсулу пользователя, если есть."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                 "SELECT * FROM time_capsule WHERE user_id = ?", (user_id,)
             ) as c:
@@ -1587,7 +2620,7 @@ class Database:
     ) -> None:
         """Создать капсулу (одна на пользователя, заменяет существующую при повторе)."""
         now = datetime.now()
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 """INSERT OR REPLACE INTO time_capsule
                    (user_id, title, expected_result, open_at, created_at, last_edited_at)
@@ -1618,7 +2651,7 @@ class Database:
             last = now
         if (now - last).total_seconds() >= 3600:
             return False
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 """UPDATE time_capsule
                    SET title = ?, expected_result = ?, open_at = ?, last_edited_at = ?
@@ -1630,7 +2663,7 @@ class Database:
 
     async def delete_time_capsule(self, user_id: int) -> bool:
         """Удалить капсулу пользователя."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             cur = await db.execute("DELETE FROM time_capsule WHERE user_id = ?", (user_id,))
             await db.commit()
             return cur.rowcount > 0
@@ -1647,7 +2680,7 @@ class Database:
             open_at = open_at.isoformat() if open_at else None
         if hasattr(created_at, "isoformat"):
             created_at = created_at.isoformat() if created_at else None
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 """INSERT INTO time_capsule_history
                    (user_id, title, expected_result, open_at, created_at, viewed_at)
@@ -1667,8 +2700,7 @@ class Database:
 
     async def get_time_capsule_history(self, user_id: int) -> List[Dict]:
         """Список капсул в истории (от новых к старым)."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                 """SELECT id, user_id, title, expected_result, open_at, created_at, viewed_at, reflection
                    FROM time_capsule_history WHERE user_id = ? ORDER BY viewed_at DESC""",
@@ -1679,7 +2711,7 @@ class Database:
 
     async def add_capsule_reflection(self, history_id: int, user_id: int, reflection: str) -> bool:
         """Добавить впечатления к капсуле в истории (только раз, если ещё пусто)."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             async with db.execute(
                 "SELECT id, reflection FROM time_capsule_history WHERE id = ? AND user_id = ?",
                 (history_id, user_id),
@@ -1699,7 +2731,7 @@ class Database:
         self, user_id: int, access_token: str, refresh_token: Optional[str], expires_at: Optional[datetime]
     ) -> None:
         """Сохранить OAuth токены Google Fit."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 """INSERT INTO google_fit_tokens (user_id, access_token, refresh_token, expires_at, updated_at)
                    VALUES (?, ?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET
@@ -1713,8 +2745,7 @@ class Database:
 
     async def get_google_fit_tokens(self, user_id: int) -> Optional[Dict]:
         """Получить токены Google Fit пользователя."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                 "SELECT access_token, refresh_token, expires_at FROM google_fit_tokens WHERE user_id = ?",
                 (user_id,),
@@ -1723,16 +2754,43 @@ class Database:
         return dict(row) if row else None
 
     async def delete_google_fit_tokens(self, user_id: int) -> None:
-        """Удалить токены Google Fit (отключить)."""
-        async with aiosqlite.connect(self.db_path) as db:
+        """Удалить токены Google Fit (отключить). Соответствие событий календаря тоже забываем: после
+        повторного подключения (возможно, другого аккаунта) выгрузка создаст события заново."""
+        async with self._write() as db:
             await db.execute("DELETE FROM google_fit_tokens WHERE user_id = ?", (user_id,))
+            await db.execute("DELETE FROM calendar_event_map WHERE user_id = ?", (user_id,))
+            await db.commit()
+
+    # --- Шаги Google Fit ---
+    async def save_steps_daily(self, user_id: int, steps_by_day: Dict[str, int]) -> None:
+        """Сохранить шаги по дням {YYYY-MM-DD: шаги} (перезаписывает эти дни)."""
+        if not steps_by_day:
+            return
+        now = datetime.now()
+        async with self._write() as db:
+            await db.executemany(
+                """INSERT INTO steps_daily (user_id, date, steps, updated_at) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(user_id, date) DO UPDATE SET steps = excluded.steps, updated_at = excluded.updated_at""",
+                [(user_id, day, steps, now) for day, steps in steps_by_day.items()],
+            )
             await db.commit()
 
+    async def get_steps_daily(self, user_id: int, since: str, until: Optional[str] = None) -> List[Dict]:
+        """Шаги по дням с since по until (YYYY-MM-DD, включительно) по возрастанию даты: date, steps, updated_at."""
+        sql = "SELECT date, steps, updated_at FROM steps_daily WHERE user_id = ? AND date >= ?"
+        params: tuple = (user_id, since)
+        if until:
+            sql += " AND date <= ?"
+            params += (until,)
+        async with self._read() as db:
+            async with db.execute(sql + " ORDER BY date", params) as c:
+                rows = await c.fetchall()
+        return [dict(row) for row in rows]
+
     # --- Синхронизация с Google Календарь ---
     async def get_calendar_sync_settings(self, user_id: int) -> Dict:
         """Настройки выгрузки в календарь: sync_subgoals, sync_habits, sync_goals."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                 "SELECT sync_subgoals, sync_habits, sync_goals FROM calendar_sync_settings WHERE user_id = ?",
                 (user_id,),
@@ -1746,7 +2804,7 @@ class Database:
         self, user_id: int, sync_subgoals: bool = True, sync_habits: bool = True, sync_goals: bool = True
     ) -> None:
         """Сохранить настройки выгрузки в календарь."""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 """INSERT INTO calendar_sync_settings (user_id, sync_subgoals, sync_habits, sync_goals)
                    VALUES (?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET
@@ -1756,3 +2814,42 @@ class Database:
                 (user_id, 1 if sync_subgoals else 0, 1 if sync_habits else 0, 1 if sync_goals else 0),
             )
             await db.commit()
+
+    async def get_calendar_event_map(self, user_id: int) -> Dict[Tuple[str, int], Tuple[str, str]]:
+        """Выгруженные события пользователя: (kind, local_id) → (event_id, content_hash)."""
+        async with self._read() as db:
+            async with db.execute(
+                "SELECT kind, local_id, event_id, content_hash FROM calendar_event_map WHERE user_id = ?",
+                (user_id,),
+            ) as c:
+                rows = await c.fetchall()
+        return {(row[0], row[1]): (row[2], row[3]) for row in rows}
+
+    async def save_calendar_event_map(
+        self,
+        user_id: int,
+        upserts: Sequence[Tuple[str, int, str, str]],
+        deletes: Sequence[Tuple[str, int]] = (),
+    ) -> None:
+        """Записать итог выгрузки одной транзакцией: upserts — (kind, local_id, event_id, content_hash),
+        deletes — (kind, local_id) удалённых из календаря событий."""
+        if not upserts and not deletes:
+            return
+        now = datetime.now()
+        async with self._write() as db:
+            if upserts:
+                await db.executemany(
+                    """INSERT INTO calendar_event_map (user_id, kind, local_id, event_id, content_hash, updated_at)
+                       VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(user_id, kind, local_id) DO UPDATE SET
+                       event_id = excluded.event_id,
+                       content_hash = excluded.content_hash,
+                       updated_at = excluded.updated_at""",
+                    [(user_id, kind, local_id, event_id, content_hash, now)
+                     for kind, local_id, event_id, content_hash in upserts],
+                )
+            if deletes:
+                await db.executemany(
+                    "DELETE FROM calendar_event_map WHERE user_id = ? AND kind = ? AND local_id = ?",
+                    [(user_id, kind, local_id) for kind, local_id in deletes],
+                )
+            await db.commit()
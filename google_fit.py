@@ -0,0 +1,208 @@
+"""
+Шаги Google Fit для веб-сервера: кэш на пользователя и дневная история в steps_daily.
+
+GET /api/user/{id}/google-fit/steps не ходит в Google на каждое открытие экрана: шаги за сегодня
+(в часовом поясе пользователя) отдаются из памяти, пока им меньше GOOGLE_FIT_STEPS_TTL_SEC; до
+GOOGLE_FIT_STEPS_STALE_SEC отдаётся прежнее значение, а обновление идёт в фоне (stale-while-revalidate);
+старше — запрос ждёт ответа Google. Обновление одно на пользователя, сколько бы запросов ни пришло.
+Каждый ответ Google сохраняется по дням в steps_daily (при первом обращении за день — последние
+GOOGLE_FIT_STEPS_FETCH_DAYS дней, дальше только сегодня), поэтому после перезапуска кэш поднимается
+из БД, а графики и расчёт воды читают шаги оттуда без запросов к Google.
+"""
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from database import Database
+from google_tokens import GoogleTokenManager
+from user_timezones import zone
+
+FITNESS_AGGREGATE_URL = os.getenv(
+    "GOOGLE_FIT_AGGREGATE_URL", "https://www.googleapis.com/fitness/v1/users/me/dataset:aggregate"
+)
+STEPS_TTL_SEC = int(os.getenv("GOOGLE_FIT_STEPS_TTL_SEC", "60"))
+STEPS_STALE_SEC = int(os.getenv("GOOGLE_FIT_STEPS_STALE_SEC", "1800"))
+STEPS_FETCH_DAYS = int(os.getenv("GOOGLE_FIT_STEPS_FETCH_DAYS", "7"))
+# Расчёт воды: шаги сверх обычного дня, пересчитанные в минуты активной ходьбы
+STEPS_BASELINE = 5000
+STEPS_PER_ACTIVE_MINUTE = 100
+
+logger = logging.getLogger(__name__)
+
+
+def sum_step_buckets(data: Dict, tz: str) -> Dict[str, int]:
+    """Ответ dataset:aggregate (bucket → dataset → point → value) → {YYYY-MM-DD: шаги} по началу корзины."""
+    out: Dict[str, int] = {}
+    z = zone(tz)
+    for bucket in data.get("bucket", []):
+        start = datetime.fromtimestamp(int(bucket.get("startTimeMillis", 0)) / 1000, timezone.utc)
+        total = sum(
+            int(v.get("intVal", 0))
+            for ds in bucket.get("dataset", [])
+            for pt in ds.get("point", [])
+            for v in pt.get("value", [])
+        )
+        day = start.astimezone(z).date().isoformat()
+        out[day] = out.get(day, 0) + total
+    return out
+
+
+def activity_minutes_from_steps(history: List[Dict]) -> Optional[float]:
+    """Минуты активности в день для расчёта воды по строкам steps_daily; None — шагов нет."""
+    if not history:
+        return None
+    avg = sum(row["steps"] for row in history) / len(history)
+    return round(max(0.0, avg - STEPS_BASELINE) / STEPS_PER_ACTIVE_MINUTE, 1)
+
+
+@dataclass
+class StepsEntry:
+    """Шаги пользователя за день и когда они получены из Google."""
+    day: str
+    steps: int
+    fetched_at: float  # unix-время
+
+
+@dataclass
+class StepsStats:
+    """Счётчики с момента запуска — для /api/admin/metrics."""
+    fresh_hits: int = 0
+    stale_hits: int = 0  # отдано прежнее значение, обновление в фоне
+    fetches: int = 0  # запросов dataset:aggregate
+    fetch_errors: int = 0
+    joined_fetches: int = 0  # запросов, дождавшихся уже идущего обновления
+
+
+class StepsCache:
+    """Шаги за сегодня по пользователям. shutdown() — при остановке веб-сервера."""
+
+    def __init__(
+        self,
+        db: Database,
+        tokens: GoogleTokenManager,
+        client: Callable[[], httpx.AsyncClient],
+        ttl: float = STEPS_TTL_SEC,
+        stale: float = STEPS_STALE_SEC,
+        fetch_days: int = STEPS_FETCH_DAYS,
+        url: str = FITNESS_AGGREGATE_URL,
+    ):
+        self.db = db
+        self.tokens = tokens
+        self._client = client  # клиент google_api из общего пула (http_clients.py)
+        self.ttl = ttl
+        self.stale = max(stale, ttl)
+        self.fetch_days = max(1, fetch_days)
+        self.url = url
+        self.stats = StepsStats()
+        self._cache: Dict[int, StepsEntry] = {}
+        self._fetching: Dict[int, asyncio.Task] = {}
+
+    async def today(self, user_id: int, tz: str) -> Dict:
+        """Ответ /google-fit/steps: {"steps": N, "age": секунд с получения из Google} или {"steps": None, "error": ...}."""
+        day = datetime.now(timezone.utc).astimezone(zone(tz)).date().isoformat()
+        entry = await self._entry(user_id, day)
+        if entry is not None:
+            age = time.time() - entry.fetched_at
+            if age < self.ttl:
+                self.stats.fresh_hits += 1
+                return {"steps": entry.steps, "age": round(age)}
+            if age < self.stale:
+                self.stats.stale_hits += 1
+                if user_id not in self._fetching:
+                    self._fetch(user_id, tz, day, full=False)
+                return {"steps": entry.steps, "age": round(age)}
+        # shield: отмена одного HTTP-запроса не отменяет общее обновление, которого ждут другие
+        fresh, error = await asyncio.shield(self._fetch(user_id, tz, day, full=entry is None))
+        if fresh is not None:
+            return {"steps": fresh.steps, "age": 0}
+        if entry is not None:
+            # Google не ответил — лучше давние шаги за сегодня, чем ничего
+            return {"steps": entry.steps, "age": round(time.time() - entry.fetched_at), "error": error}
+        return {"steps": None, "error": error}
+
+    async def _entry(self, user_id: int, day: str) -> Optional[StepsEntry]:
+        entry = self._cache.get(user_id)
+        if entry is not None and entry.day == day:
+            return entry
+        rows = await self.db.get_steps_daily(user_id, day, day)
+        if not rows:
+            return None
+        updated = datetime.fromisoformat(str(rows[0]["updated_at"]))
+        entry = StepsEntry(day, rows[0]["steps"], updated.timestamp())
+        self._cache[user_id] = entry
+        return entry
+
+    def _fetch(self, user_id: int, tz: str, day: str, full: bool) -> asyncio.Task:
+        task = self._fetching.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._do_fetch(user_id, tz, day, full))
+            self._fetching[user_id] = task
+            task.add_done_callback(lambda _t: self._fetching.pop(user_id, None))
+        else:
+            self.stats.joined_fetches += 1
+        return task
+
+    async def _do_fetch(self, user_id: int, tz: str, day: str, full: bool) -> Tuple[Optional[StepsEntry], Optional[str]]:
+        access = await self.tokens.access_token(user_id)
+        if not access:
+            return None, "token_expired"
+        first = date.fromisoformat(day) - timedelta(days=self.fetch_days - 1 if full else 0)
+        start = datetime.combine(first, datetime.min.time(), zone(tz))
+        body = {
+            "aggregateBy": [{"dataTypeName": "com.google.step_count.delta"}],
+            # Корзины по календарным дням пользователя (с учётом перехода на летнее время)
+            "bucketByTime": {"period": {"type": "day", "value": 1, "timeZoneId": tz}},
+            "startTimeMillis": str(int(start.timestamp() * 1000)),
+            "endTimeMillis": str(int(time.time() * 1000)),
+        }
+        self.stats.fetches += 1
+        try:
+            r = await self._client().post(self.url, json=body, headers={"Authorization": f"Bearer {access}"})
+        except httpx.HTTPError as e:
+            logger.warning("Google Fitness API user %s: %s", user_id, e)
+            self.stats.fetch_errors += 1
+            return None, "api_error"
+        if r.status_code == 401:
+            self.tokens.expire(user_id)
+        if r.status_code != 200:
+            logger.warning("Fitness API %s: %s", r.status_code, (r.text or "")[:200])
+            self.stats.fetch_errors += 1
+            return None, "api_error"
+        try:
+            steps_by_day = sum_step_buckets(r.json(), tz)
+        except (ValueError, TypeError) as e:
+            logger.warning("Fitness API user %s: неожиданный ответ: %s", user_id, e)
+            self.stats.fetch_errors += 1
+            return None, "api_error"
+        steps_by_day.setdefault(day, 0)
+        await self.db.save_steps_daily(user_id, steps_by_day)
+        entry = StepsEntry(day, steps_by_day[day], time.time())
+        self._cache[user_id] = entry
+        return entry, None
+
+    def forget(self, user_id: int) -> None:
+        """Google отключили — не отдавать шаги из памяти (история в steps_daily остаётся)."""
+        self._cache.pop(user_id, None)
+
+    async def shutdown(self) -> None:
+        tasks = list(self._fetching.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def metrics(self) -> Dict:
+        s = self.stats
+        return {
+            "cached_users": len(self._cache),
+            "fresh_hits": s.fresh_hits,
+            "stale_hits": s.stale_hits,
+            "fetches": s.fetches,
+            "fetch_errors": s.fetch_errors,
+            "joined_fetches": s.joined_fetches,
+        }
@@ -0,0 +1,224 @@
+"""
+OAuth-токены Google (Fit, Календарь) для веб-сервера: кэш в памяти и обновление через refresh_token.
+
+Токены пользователя читаются из google_fit_tokens один раз и дальше берутся из памяти вместе со сроком
+действия. Обновление — одно на пользователя: параллельные запросы ждут тот же запрос к Google
+(single-flight), а не обновляют каждый свой. Если до истечения меньше GOOGLE_TOKEN_REFRESH_AHEAD_SEC,
+токен ещё отдаётся, а обновление запускается в фоне; меньше GOOGLE_TOKEN_REFRESH_MARGIN_SEC — запрос
+ждёт обновления. После неудачного обновления (например, доступ отозван) повтор не раньше чем через
+GOOGLE_TOKEN_RETRY_SEC. Кэш живёт в процессе веб-сервера (он один); токены, как и прежде, хранятся в БД.
+"""
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional
+
+import httpx
+
+from database import Database
+
+GOOGLE_TOKEN_URL = os.getenv("GOOGLE_OAUTH_TOKEN_URL", "https://oauth2.googleapis.com/token")
+GOOGLE_TOKEN_REFRESH_MARGIN_SEC = int(os.getenv("GOOGLE_TOKEN_REFRESH_MARGIN_SEC", "300"))
+GOOGLE_TOKEN_REFRESH_AHEAD_SEC = int(os.getenv("GOOGLE_TOKEN_REFRESH_AHEAD_SEC", "900"))
+GOOGLE_TOKEN_RETRY_SEC = int(os.getenv("GOOGLE_TOKEN_RETRY_SEC", "60"))
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_expires(value) -> Optional[float]:
+    """expires_at из БД (datetime или строка ISO) → unix-время; None — срок неизвестен."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+@dataclass
+class CachedToken:
+    """Токены одного пользователя в памяти."""
+    access_token: Optional[str]
+    refresh_token: Optional[str]
+    expires_at: Optional[float]  # unix-время; None — срок неизвестен, не обновляем
+    failed_at: float = 0.0  # время последнего неудачного обновления
+
+
+@dataclass
+class TokenStats:
+    """Счётчики с момента запуска — для /api/admin/metrics."""
+    cache_hits: int = 0
+    db_loads: int = 0
+    refreshes: int = 0
+    refresh_failures: int = 0
+    background_refreshes: int = 0
+    joined_refreshes: int = 0  # запросов, дождавшихся уже идущего обновления
+
+
+class GoogleTokenManager:
+    """Готовый access token по user_id для всех интеграций с Google. shutdown() — при остановке веб-сервера."""
+
+    def __init__(
+        self,
+        db: Database,
+        client: Callable[[], httpx.AsyncClient],
+        client_id: str,
+        client_secret: str,
+        token_url: str = GOOGLE_TOKEN_URL,
+        margin: float = GOOGLE_TOKEN_REFRESH_MARGIN_SEC,
+        ahead: float = GOOGLE_TOKEN_REFRESH_AHEAD_SEC,
+        retry: float = GOOGLE_TOKEN_RETRY_SEC,
+    ):
+        self.db = db
+        self._client = client  # клиент google_oauth из общего пула (http_clients.py)
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_url = token_url
+        self.margin = margin
+        self.ahead = max(ahead, margin)
+        self.retry = retry
+        self.stats = TokenStats()
+        self._cache: Dict[int, CachedToken] = {}
+        self._refreshing: Dict[int, asyncio.Task] = {}
+
+    async def _entry(self, user_id: int) -> Optional[CachedToken]:
+        entry = self._cache.get(user_id)
+        if entry is not None:
+            self.stats.cache_hits += 1
+            return entry
+        row = await self.db.get_google_fit_tokens(user_id)
+        self.stats.db_loads += 1
+        if not row:
+            return None
+        # Пока читали из БД, токены могли уже положить (store) — они свежее
+        entry = self._cache.setdefault(user_id, CachedToken(
+            row.get("access_token"), row.get("refresh_token"), _parse_expires(row.get("expires_at"))
+        ))
+        return entry
+
+    async def connected(self, user_id: int) -> bool:
+        """Подключён ли Google (есть сохранённые токены)."""
+        return await self._entry(user_id) is not None
+
+    async def access_token(self, user_id: int) -> Optional[str]:
+        """Действующий access token или None (Google не подключён либо токен истёк и не обновился)."""
+        entry = await self._entry(user_id)
+        if entry is None:
+            return None
+        if entry.expires_at is None or not entry.refresh_token:
+            return entry.access_token
+        left = entry.expires_at - time.time()
+        if left > self.ahead:
+            return entry.access_token
+        can_retry = time.time() - entry.failed_at >= self.retry
+        if left > self.margin:
+            if can_retry and user_id not in self._refreshing:
+                self.stats.background_refreshes += 1
+                self._refresh(user_id, entry)
+            return entry.access_token
+        if can_retry:
+            await self._wait_refresh(user_id, entry)
+            entry = self._cache.get(user_id)
+            if entry is None:
+                return None
+        # Обновить не удалось: старый токен годится, только если он формально ещё не истёк
+        return entry.access_token if entry.expires_at is None or entry.expires_at > time.time() else None
+
+    def _refresh(self, user_id: int, entry: CachedToken) -> asyncio.Task:
+        task = self._refreshing.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._do_refresh(user_id, entry))
+            self._refreshing[user_id] = task
+            task.add_done_callback(lambda _t: self._refreshing.pop(user_id, None))
+        else:
+            self.stats.joined_refreshes += 1
+        return task
+
+    async def _wait_refresh(self, user_id: int, entry: CachedToken) -> None:
+        # shield: отмена одного HTTP-запроса не отменяет общее обновление, которого ждут другие
+        await asyncio.shield(self._refresh(user_id, entry))
+
+    async def _do_refresh(self, user_id: int, entry: CachedToken) -> None:
+        self.stats.refreshes += 1
+        try:
+            r = await self._client().post(
+                self.token_url,
+                data={
+                    "client_id": self.client_id,
+                    "client_secret": self.client_secret,
+                    "refresh_token": entry.refresh_token,
+                    "grant_type": "refresh_token",
+                },
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+            )
+        except httpx.HTTPError as e:
+            logger.warning("Google token refresh user %s: %s", user_id, e)
+            self.stats.refresh_failures += 1
+            entry.failed_at = time.time()
+            return
+        try:
+            data = r.json() if r.status_code == 200 else {}
+        except ValueError:
+            data = {}
+        access = data.get("access_token")
+        if not access:
+            logger.warning("Google token refresh user %s: %s %s", user_id, r.status_code, (r.text or "")[:200])
+            self.stats.refresh_failures += 1
+            entry.failed_at = time.time()
+            return
+        if self._cache.get(user_id) is not entry:
+            return  # пока обновляли, Google отключили или подключили заново
+        refresh = data.get("refresh_token") or entry.refresh_token
+        expires = datetime.now(timezone.utc).timestamp() + int(data.get("expires_in", 3600))
+        self._cache[user_id] = CachedToken(access, refresh, expires)
+        await self.db.save_google_fit_tokens(
+            user_id, access, refresh, datetime.fromtimestamp(expires, timezone.utc)
+        )
+
+    async def store(self, user_id: int, access_token: str, refresh_token: Optional[str], expires_at: datetime) -> None:
+        """Сохранить токены после авторизации (OAuth callback) — в БД и в кэш."""
+        await self.db.save_google_fit_tokens(user_id, access_token, refresh_token, expires_at)
+        old = self._cache.get(user_id)
+        refresh_token = refresh_token or (old.refresh_token if old else None)
+        if not refresh_token:
+            # Google не прислал refresh_token — в БД остался прежний (COALESCE), перечитаем при обращении
+            self._cache.pop(user_id, None)
+            return
+        self._cache[user_id] = CachedToken(access_token, refresh_token, _parse_expires(expires_at))
+
+    def expire(self, user_id: int) -> None:
+        """Google ответил 401 на запрос с токеном — при следующем обращении обновить его."""
+        entry = self._cache.get(user_id)
+        if entry is not None and entry.refresh_token:
+            entry.expires_at = 0.0
+
+    async def forget(self, user_id: int) -> None:
+        """Отключить Google: удалить токены из БД и из кэша."""
+        self._cache.pop(user_id, None)
+        await self.db.delete_google_fit_tokens(user_id)
+
+    async def shutdown(self) -> None:
+        tasks = list(self._refreshing.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def metrics(self) -> Dict:
+        s = self.stats
+        return {
+            "cached_users": len(self._cache),
+            "refreshing": len(self._refreshing),
+            "cache_hits": s.cache_hits,
+            "db_loads": s.db_loads,
+            "refreshes": s.refreshes,
+            "refresh_failures": s.refresh_failures,
+            "background_refreshes": s.background_refreshes,
+            "joined_refreshes": s.joined_refreshes,
+        }
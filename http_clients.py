@@ -0,0 +1,170 @@
+"""
+Общие httpx-клиенты для исходящих запросов веб-сервера.
+
+Один долгоживущий AsyncClient на внешний сервис (Telegram Bot API, Google OAuth, Google API,
+Open-Meteo, ip-api): соединения переиспользуются (keep-alive, HTTP/2, если установлен пакет h2),
+у каждого сервиса свой лимит соединений и свои таймауты. Клиенты создаются в lifespan веб-сервера
+(HttpClients.open) и закрываются при остановке.
+
+Таймауты и лимиты переопределяются переменными окружения HTTP_TIMEOUT_<СЕРВИС> и
+HTTP_MAX_CONNECTIONS_<СЕРВИС> (например, HTTP_TIMEOUT_GOOGLE_API=30).
+По каждому сервису считаются задержки (до заголовков ответа, включая ожидание соединения), ошибки,
+коды ответов и занятость пула — см. HttpClients.metrics() и GET /api/admin/metrics.
+"""
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Optional
+
+import httpx
+
+try:
+    import h2  # noqa: F401  — нужен httpx для HTTP/2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+LATENCY_SAMPLES = 1000  # последних замеров на сервис для перцентилей
+
+
+@dataclass
+class UpstreamSettings:
+    """Таймауты и лимит соединений одного внешнего сервиса."""
+    timeout: float = 10.0  # чтение/запись, секунды
+    connect_timeout: float = 5.0
+    pool_timeout: float = 5.0  # ожидание свободного соединения из пула
+    max_connections: int = 10
+    keepalive_expiry: float = 60.0
+
+    @classmethod
+    def from_env(cls, name: str, timeout: float, max_connections: int) -> "UpstreamSettings":
+        key = name.upper()
+        return cls(
+            timeout=float(os.getenv(f"HTTP_TIMEOUT_{key}", str(timeout))),
+            max_connections=int(os.getenv(f"HTTP_MAX_CONNECTIONS_{key}", str(max_connections))),
+        )
+
+
+def default_upstreams() -> Dict[str, UpstreamSettings]:
+    """Сервисы веб-сервера: имя → настройки (с учётом переменных окружения)."""
+    return {
+        "telegram": UpstreamSettings.from_env("telegram", 15.0, 8),  # api.telegram.org
+        "google_oauth": UpstreamSettings.from_env("google_oauth", 15.0, 10),  # oauth2.googleapis.com
+        "google_api": UpstreamSettings.from_env("google_api", 15.0, 20),  # www.googleapis.com: Fitness, Calendar
+        "open_meteo": UpstreamSettings.from_env("open_meteo", 5.0, 10),  # погода и геокодинг
+        "ip_api": UpstreamSettings.from_env("ip_api", 5.0, 4),  # геолокация по IP
+    }
+
+
+@dataclass
+class UpstreamStats:
+    """Счётчики одного сервиса с момента запуска."""
+    max_connections: int = 0
+    requests: int = 0
+    errors: int = 0  # сетевые ошибки и таймауты (ответа нет)
+    pool_timeouts: int = 0  # не дождались свободного соединения
+    in_flight: int = 0
+    peak_in_flight: int = 0
+    saturated: int = 0  # запросов, начатых при занятом пуле (ждали соединение, если нет HTTP/2)
+    statuses: Dict[str, int] = field(default_factory=dict)  # "2xx" → число
+    latencies: Deque[float] = field(default_factory=lambda: deque(maxlen=LATENCY_SAMPLES))
+
+    def snapshot(self) -> Dict:
+        ordered = sorted(self.latencies)
+
+        def pct(q: float) -> Optional[float]:
+            if not ordered:
+                return None
+            return round(ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))] * 1000, 1)
+
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "statuses": dict(self.statuses),
+            "pool": {
+                "max_connections": self.max_connections,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "saturated": self.saturated,
+                "pool_timeouts": self.pool_timeouts,
+            },
+            "latency_ms": {"p50": pct(50), "p95": pct(95), "p99": pct(99), "samples": len(ordered)},
+        }
+
+
+class _MeteredTransport(httpx.AsyncBaseTransport):
+    """Транспорт с пулом соединений, который считает задержку, ошибки и занятость пула."""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, stats: UpstreamStats):
+        self._transport = transport
+        self._stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        stats = self._stats
+        stats.requests += 1
+        if stats.in_flight >= stats.max_connections:
+            stats.saturated += 1
+        stats.in_flight += 1
+        stats.peak_in_flight = max(stats.peak_in_flight, stats.in_flight)
+        t0 = time.monotonic()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except httpx.PoolTimeout:
+            stats.pool_timeouts += 1
+            stats.errors += 1
+            raise
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.in_flight -= 1
+        stats.latencies.append(time.monotonic() - t0)
+        key = f"{response.status_code // 100}xx"
+        stats.statuses[key] = stats.statuses.get(key, 0) + 1
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class HttpClients:
+    """Реестр общих клиентов по имени сервиса. open() — в startup, aclose() — в shutdown."""
+
+    def __init__(self, upstreams: Optional[Dict[str, UpstreamSettings]] = None):
+        self.upstreams = upstreams if upstreams is not None else default_upstreams()
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._stats: Dict[str, UpstreamStats] = {}
+
+    def open(self) -> None:
+        for name in self.upstreams:
+            self.client(name)
+
+    def client(self, name: str) -> httpx.AsyncClient:
+        """Клиент сервиса name (создаётся при первом обращении, если open() ещё не вызывали)."""
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            s = self.upstreams[name]
+            stats = self._stats.setdefault(name, UpstreamStats())
+            stats.max_connections = s.max_connections
+            limits = httpx.Limits(
+                max_connections=s.max_connections,
+                max_keepalive_connections=s.max_connections,
+                keepalive_expiry=s.keepalive_expiry,
+            )
+            transport = httpx.AsyncHTTPTransport(http2=HTTP2_AVAILABLE, limits=limits, retries=1)
+            client = httpx.AsyncClient(
+                transport=_MeteredTransport(transport, stats),
+                timeout=httpx.Timeout(s.timeout, connect=s.connect_timeout, pool=s.pool_timeout),
+            )
+            self._clients[name] = client
+        return client
+
+    async def aclose(self) -> None:
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    def metrics(self) -> Dict[str, Dict]:
+        """{сервис: счётчики} для /api/admin/metrics."""
+        return {"http2": HTTP2_AVAILABLE, **{name: stats.snapshot() for name, stats in self._stats.items()}}
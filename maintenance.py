@@ -0,0 +1,173 @@
+"""
+Обслуживание SQLite: сроки хранения растущих таблиц и возврат места на диске.
+
+- reminder_sent_log старше срока сворачивается в дневные итоги reminder_sent_daily
+  (user_id, день, тип → число); детальные строки нужны только для дедупликации за текущий день;
+- shaolen_history старше срока выгружается в сжатый архив
+  <SHAOLEN_ARCHIVE_DIR>/shaolen_history_<до даты>_<время>.jsonl.gz и только потом удаляется из БД;
+- analytics и shaolen_daily_requests — просто удаляются строки старше срока;
+- затем PRAGMA incremental_vacuum (или полный VACUUM по запросу) и wal_checkpoint(TRUNCATE).
+
+Запускается воркером напоминаний раз в сутки (MAINTENANCE_HOUR) или вручную:
+scripts/db_maintenance.py.
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+_ARCHIVE_CHUNK = 500
+
+
+@dataclass
+class RetentionSettings:
+    """Сроки хранения в днях (0 — хранить всё). Переменные окружения:
+
+    RETENTION_REMINDER_LOG_DAYS (90), RETENTION_SHAOLEN_HISTORY_DAYS (180),
+    RETENTION_ANALYTICS_DAYS (0), RETENTION_SHAOLEN_REQUESTS_DAYS (30),
+    SHAOLEN_ARCHIVE_DIR (папка archive рядом с БД) и MAINTENANCE_HOUR (4, час в поясе DEFAULT_TIMEZONE; -1 — воркер не запускает).
+    """
+
+    reminder_log_days: int = 90
+    shaolen_history_days: int = 180
+    analytics_days: int = 0
+    shaolen_requests_days: int = 30
+    archive_dir: str = ""
+    maintenance_hour: int = 4
+
+    @classmethod
+    def from_env(cls) -> "RetentionSettings":
+        return cls(
+            reminder_log_days=int(os.getenv("RETENTION_REMINDER_LOG_DAYS", "90")),
+            shaolen_history_days=int(os.getenv("RETENTION_SHAOLEN_HISTORY_DAYS", "180")),
+            analytics_days=int(os.getenv("RETENTION_ANALYTICS_DAYS", "0")),
+            shaolen_requests_days=int(os.getenv("RETENTION_SHAOLEN_REQUESTS_DAYS", "30")),
+            archive_dir=os.getenv("SHAOLEN_ARCHIVE_DIR", "").strip(),
+            maintenance_hour=int(os.getenv("MAINTENANCE_HOUR", "4")),
+        )
+
+
+@dataclass
+class MaintenanceReport:
+    """Итог одного прохода обслуживания."""
+    reminder_log_rolled_up: int = 0
+    shaolen_archived: int = 0
+    archive_path: Optional[str] = None
+    analytics_deleted: int = 0
+    shaolen_requests_deleted: int = 0
+    bytes_before: int = 0
+    bytes_after: int = 0
+    free_bytes_after: int = 0  # свободные страницы, которые остались внутри файла
+    auto_vacuum: int = 0  # 0 — NONE, 1 — FULL, 2 — INCREMENTAL
+
+    @property
+    def reclaimed_bytes(self) -> int:
+        return self.bytes_before - self.bytes_after
+
+    def summary(self) -> str:
+        text = (
+            f"reminder_sent_log → reminder_sent_daily: {self.reminder_log_rolled_up} строк; "
+            f"shaolen_history в архив: {self.shaolen_archived}"
+            + (f" ({self.archive_path})" if self.archive_path else "")
+            + f"; analytics: −{self.analytics_deleted}; shaolen_daily_requests: −{self.shaolen_requests_deleted}; "
+            f"размер {self.bytes_before / 1048576:.2f} → {self.bytes_after / 1048576:.2f} МБ "
+            f"(освобождено {self.reclaimed_bytes / 1048576:.2f} МБ)"
+        )
+        if self.auto_vacuum != 2 and self.free_bytes_after:
+            text += (
+                f"; {self.free_bytes_after / 1048576:.2f} МБ свободно внутри файла — "
+                "БД без auto_vacuum=INCREMENTAL, вернуть место на диск: scripts/db_maintenance.py --full-vacuum"
+            )
+        return text
+
+
+def _cutoff(today: date, days: int) -> Optional[str]:
+    return (today - timedelta(days=days)).isoformat() if days > 0 else None
+
+
+def _archive_dir(db: Database, settings: RetentionSettings) -> str:
+    return settings.archive_dir or os.path.join(os.path.dirname(os.path.abspath(db.db_path)), "archive")
+
+
+async def archive_shaolen_history(db: Database, before: str, archive_dir: str) -> tuple:
+    """Выгрузить shaolen_history раньше дня before (YYYY-MM-DD) в архив и удалить из БД. Возвращает (число, путь).
+    Файл пишется порциями и сбрасывается на диск; записи удаляются из БД только после этого."""
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"shaolen_history_{before}_{datetime.now():%Y%m%d%H%M%S}.jsonl.gz")
+    tmp = path + ".part"
+    ids, after_id = [], 0
+    f = await asyncio.to_thread(gzip.open, tmp, "wt", encoding="utf-8")
+    try:
+        while True:
+            chunk = await db.get_shaolen_history_before(before, after_id=after_id, limit=_ARCHIVE_CHUNK)
+            if not chunk:
+                break
+            text = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in chunk)
+            await asyncio.to_thread(f.write, text)
+            ids.extend(row["id"] for row in chunk)
+            after_id = chunk[-1]["id"]
+    finally:
+        await asyncio.to_thread(f.close)
+    if not ids:
+        os.remove(tmp)
+        return 0, None
+
+    def _sync_and_publish() -> None:
+        with open(tmp, "rb") as raw:
+            os.fsync(raw.fileno())
+        os.replace(tmp, path)
+
+    await asyncio.to_thread(_sync_and_publish)
+    deleted = 0
+    for i in range(0, len(ids), _ARCHIVE_CHUNK):
+        deleted += await db.delete_shaolen_history(ids[i:i + _ARCHIVE_CHUNK])
+    return deleted, path
+
+
+async def run_maintenance(
+    db: Database,
+    settings: Optional[RetentionSettings] = None,
+    today: Optional[date] = None,
+    full_vacuum: bool = False,
+) -> MaintenanceReport:
+    """Применить сроки хранения и вернуть освободившееся место. Безопасно запускать повторно."""
+    settings = settings or RetentionSettings.from_env()
+    today = today or date.today()
+    report = MaintenanceReport()
+    # Сначала переносим WAL в основной файл, чтобы «до» и «после» сравнивались честно
+    await db.wal_checkpoint()
+    report.bytes_before = (await db.storage_stats())["file_bytes"]
+
+    before = _cutoff(today, settings.reminder_log_days)
+    if before:
+        report.reminder_log_rolled_up = await db.rollup_reminder_sent_log(before)
+    before = _cutoff(today, settings.shaolen_history_days)
+    if before:
+        report.shaolen_archived, report.archive_path = await archive_shaolen_history(
+            db, before, _archive_dir(db, settings)
+        )
+    before = _cutoff(today, settings.analytics_days)
+    if before:
+        report.analytics_deleted = await db.delete_rows_before("analytics", before)
+    before = _cutoff(today, settings.shaolen_requests_days)
+    if before:
+        report.shaolen_requests_deleted = await db.delete_rows_before("shaolen_daily_requests", before)
+
+    stats = await db.storage_stats()
+    if full_vacuum or stats["auto_vacuum"] == 2:
+        await db.vacuum(full=full_vacuum)
+    await db.wal_checkpoint()
+    stats = await db.storage_stats()
+    report.bytes_after = stats["file_bytes"]
+    report.free_bytes_after = stats["freelist_count"] * stats["page_size"]
+    report.auto_vacuum = stats["auto_vacuum"]
+    logger.info("Обслуживание БД: %s", report.summary())
+    return report
@@ -0,0 +1,294 @@
+"""
+Симуляция суток работы воркера напоминаний без Telegram: python reminder_worker.py --simulate.
+
+Берёт синтетическую БД (N пользователей, в среднем M привычек с историей за K дней, миссии, цели,
+настройки) или копию существующей и проигрывает 24 часа, начиная с местной полуночи DEFAULT_TIMEZONE,
+тиками настоящего reminder_worker.run_tick. Часы подменены: воркер «спит» мгновенно, время сдвигает
+FakeClock; отправка — SimulatedDelivery, которая ничего не отправляет, а продвигает часы по лимиту
+бота (TELEGRAM_GLOBAL_RATE). Пользователи отмечают часть привычек около обычного времени — через
+Database.increment_habit_count, как мини-приложение, поэтому работают и события выполнения.
+
+Отчёт: SQL-запросов и время на тик, сообщения по типам и часам, опоздание отправки относительно
+due_at строки расписания (p50/p99/max). Служит регрессионным замером для оптимизаций напоминаний.
+"""
+import logging
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from database import Database
+from maintenance import RetentionSettings
+from telegram_delivery import GLOBAL_RATE, DeliveryReport
+import reminder_worker
+from user_timezones import DEFAULT_TIMEZONE, zone
+
+
+def build_synthetic_db(
+    path: str,
+    users: int,
+    habits: int = 3,
+    days: int = 30,
+    seed: int = 1,
+    timezones: Sequence[str] = (),
+    include_today: bool = True,
+) -> None:
+    """
+    Заполнить БД (схема уже создана init_db) синтетическими пользователями: у каждого от 0 до 2·habits
+    привычек с историей за days дней, миссии с дедлайнами, цели, часть уже отправленных сегодня напоминаний.
+    timezones — пояса, между которыми случайно делятся пользователи (пусто — у всех DEFAULT_TIMEZONE);
+    include_today=False — без отметок за сегодня (их проигрывает симуляция).
+    """
+    rnd = random.Random(seed)
+    today = date.today()
+    conn = sqlite3.connect(path)
+    user_rows, settings_rows, habit_rows, hrs_rows, record_rows = [], [], [], [], []
+    mission_rows, goal_rows, sent_rows = [], [], []
+    habit_id = 0
+    for uid in range(1, users + 1):
+        user_rows.append((uid, f"user{uid}", f"User {uid}", rnd.choice(timezones) if timezones else None))
+        if rnd.random() < 0.3:
+            quiet = ("23:00", "07:00") if rnd.random() < 0.3 else (None, None)
+            settings_rows.append((
+                uid, 0 if rnd.random() < 0.05 else 1, quiet[0], quiet[1],
+                rnd.choice((1, 2, 2, 3)), 1 if rnd.random() < 0.7 else 0,
+            ))
+        for _ in range(rnd.randint(0, 2 * habits)):
+            habit_id += 1
+            habit_rows.append((habit_id, uid, f"Привычка {habit_id}"))
+            if rnd.random() < 0.05:
+                hrs_rows.append((habit_id, 0))
+            if rnd.random() < 0.2:
+                continue  # без истории выполнения
+            pref = rnd.randint(6 * 60, 22 * 60)
+            for d in range(days, 0 if include_today else 1, -1):
+                if rnd.random() > 0.6:
+                    continue
+                day = (today - timedelta(days=d)).isoformat()
+                m = max(0, min(24 * 60 - 1, pref + rnd.randint(-40, 40)))
+                record_rows.append((habit_id, day, 1, rnd.randint(1, 3), f"{day} {m // 60:02d}:{m % 60:02d}:00"))
+        for _ in range(rnd.choice((0, 0, 1, 2))):
+            deadline = (today + timedelta(days=rnd.randint(-20, 20))).isoformat()
+            mission_rows.append((uid, f"Миссия {uid}", deadline))
+        for _ in range(rnd.choice((0, 1, 3))):
+            goal_rows.append((uid, f"Цель {uid}"))
+        if include_today and rnd.random() < 0.1:
+            sent_rows.append((uid, "goal_daily", today.isoformat()))
+
+    conn.executemany(
+        "INSERT INTO users (user_id, username, first_name, timezone, timezone_auto) VALUES (?, ?, ?, ?, 0)",
+        user_rows,
+    )
+    conn.executemany(
+        """INSERT INTO user_reminder_settings
+           (user_id, notifications_enabled, quiet_hours_start, quiet_hours_end, reminder_intensity, first_reminder_sent)
+           VALUES (?, ?, ?, ?, ?, ?)""",
+        settings_rows,
+    )
+    conn.executemany("INSERT INTO habits (id, user_id, title) VALUES (?, ?, ?)", habit_rows)
+    conn.executemany("INSERT INTO habit_reminder_settings (habit_id, reminders_enabled) VALUES (?, ?)", hrs_rows)
+    conn.executemany(
+        "INSERT INTO habit_records (habit_id, date, completed, count, completed_at) VALUES (?, ?, ?, ?, ?)",
+        record_rows,
+    )
+    conn.executemany("INSERT INTO missions (user_id, title, deadline) VALUES (?, ?, ?)", mission_rows)
+    conn.executemany("INSERT INTO goals (user_id, title) VALUES (?, ?)", goal_rows)
+    conn.executemany(
+        "INSERT INTO reminder_sent_log (user_id, reminder_type, sent_on) VALUES (?, ?, ?)", sent_rows
+    )
+    conn.commit()
+    conn.close()
+
+
+class FakeClock:
+    """Часы симуляции (UTC): clock() — текущий момент, advance() — сдвиг вперёд."""
+
+    def __init__(self, start: datetime):
+        self.now = start
+
+    def __call__(self) -> datetime:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += timedelta(seconds=seconds)
+
+
+class SimulatedReport(DeliveryReport):
+    """DeliveryReport заглушки: sent_at[i] — момент «доставки» i-го сообщения по часам симуляции."""
+
+    def __init__(self, n: int):
+        super().__init__(results=[True] * n, sent=n)
+        self.sent_at: List[datetime] = []
+
+
+class SimulatedDelivery:
+    """Заглушка TelegramDelivery: сообщения не отправляются, каждое сдвигает часы на 1/rate секунды."""
+
+    def __init__(self, clock: FakeClock, rate: float = GLOBAL_RATE):
+        self.clock = clock
+        self.rate = rate
+
+    async def send_many(
+        self,
+        messages: Sequence[Tuple[int, str]],
+        on_sent: Optional[Callable[[int], object]] = None,
+    ) -> SimulatedReport:
+        report = SimulatedReport(len(messages))
+        for i in range(len(messages)):
+            self.clock.advance(1 / self.rate)
+            report.sent_at.append(self.clock())
+            if on_sent is not None:
+                await on_sent(i)
+        report.elapsed = len(messages) / self.rate
+        return report
+
+    async def close(self) -> None:
+        pass
+
+
+def _selects(queries: List[str]) -> int:
+    return sum(q.lstrip().upper().startswith(("SELECT", "WITH")) for q in queries)
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+async def _plan_completions(
+    db: Database, start: datetime, end: datetime, share: float, seed: int
+) -> List[Tuple[datetime, int]]:
+    """Моменты (UTC) отметок привычек за симулируемые сутки: доля share привычек с историей — около обычного времени."""
+    rnd = random.Random(seed)
+    minutes = await db.get_habit_minutes()
+    async with db._read() as conn:
+        async with conn.execute("SELECT id, user_id FROM habits WHERE is_active = 1") as c:
+            owners = {hid: uid for hid, uid in await c.fetchall()}
+    timezones = await db.get_user_timezones()
+    out = []
+    for hid, avg_min in minutes.items():
+        if avg_min is None or hid not in owners or rnd.random() >= share:
+            continue
+        tz = zone(timezones.get(owners[hid]))
+        local_day = start.astimezone(tz).date()
+        m = avg_min + rnd.randint(-20, 60)
+        at = (datetime.combine(local_day, datetime.min.time(), tzinfo=tz) + timedelta(minutes=m)).astimezone(timezone.utc)
+        if at < start:
+            at += timedelta(days=1)
+        if at < end:
+            out.append((at, hid))
+    return sorted(out)
+
+
+async def simulate(
+    users: int = 5000,
+    habits: int = 3,
+    days: int = 30,
+    seed: int = 1,
+    db_path: Optional[str] = None,
+    timezones: Sequence[str] = (),
+    done_share: float = 0.6,
+    rate: float = GLOBAL_RATE,
+) -> None:
+    """Проиграть сутки воркера на синтетической БД (или копии db_path) и напечатать отчёт."""
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "simulation.db")
+        t0 = time.perf_counter()
+        if db_path:
+            src, dst = sqlite3.connect(db_path), sqlite3.connect(path)
+            src.backup(dst)
+            src.close()
+            dst.close()
+        db = Database(path)
+        await db.init_db()
+        await db.close()
+        if db_path:
+            print(f"копия {db_path} за {time.perf_counter() - t0:.1f} с")
+        else:
+            build_synthetic_db(path, users, habits, days, seed, timezones, include_today=False)
+            print(f"синтетическая БД: users={users}, привычек до {2 * habits} на пользователя, "
+                  f"история {days} дн., поясов {len(timezones) or 1} за {time.perf_counter() - t0:.1f} с")
+
+        db = Database(path)
+        await db.open()
+        queries: List[str] = []
+        for conn in [db._writer, *db._reader_conns]:
+            await conn.set_trace_callback(queries.append)
+        default_tz = zone()
+        start = datetime.combine(date.today(), datetime.min.time(), tzinfo=default_tz).astimezone(timezone.utc)
+        end = start + timedelta(days=1)
+        clock = FakeClock(start)
+        delivery = SimulatedDelivery(clock, rate=rate)
+        state = reminder_worker.WorkerState(owner="simulate", retention=RetentionSettings(maintenance_hour=-1))
+        completions = await _plan_completions(db, start, end, done_share, seed)
+
+        tick_queries: List[int] = []  # SQL-выражений за тик (executemany — по выражению на строку)
+        tick_selects: List[int] = []
+        tick_ms: List[float] = []
+        lateness: List[float] = []
+        by_type: Dict[str, int] = {}
+        by_hour: Dict[int, int] = {}
+        popped = sent = done = 0
+        first: Optional[Tuple[int, int, float]] = None
+        while clock() < end:
+            # Отметки пользователей до этого момента — вне замера тика
+            while done < len(completions) and completions[done][0] <= clock():
+                await db.increment_habit_count(completions[done][1])
+                done += 1
+            queries.clear()
+            t0 = time.perf_counter()
+            delay, batches = await reminder_worker.run_tick(db, delivery, state, clock=clock)
+            elapsed = (time.perf_counter() - t0) * 1000
+            if first is None:
+                first = (len(queries), _selects(queries), elapsed)
+                async with db._read() as conn:
+                    async with conn.execute("SELECT COUNT(*) FROM reminder_schedule") as c:
+                        scheduled = (await c.fetchone())[0]
+            else:
+                tick_queries.append(len(queries))
+                tick_selects.append(_selects(queries))
+                tick_ms.append(elapsed)
+            for batch in batches:
+                popped += batch.popped
+                sent_at = getattr(batch.report, "sent_at", [])
+                for job, at in zip(batch.jobs, sent_at):
+                    sent += 1
+                    by_type[job.reminder_type] = by_type.get(job.reminder_type, 0) + 1
+                    hour = at.astimezone(default_tz).hour
+                    by_hour[hour] = by_hour.get(hour, 0) + 1
+                    due = datetime.strptime(job.due_at, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+                    lateness.append((at - due).total_seconds())
+            clock.advance(delay)
+        await db.close()
+
+    n = max(len(tick_ms), 1)
+    print(
+        f"старт (полная сборка расписания): SQL-выражений={first[0]} (SELECT {first[1]}) "
+        f"время={first[2]:.1f} ms строк={scheduled}"
+    )
+    print(
+        f"тиков: {len(tick_ms)}; SQL-выражений на тик: среднее {sum(tick_queries) / n:.1f}, "
+        f"максимум {max(tick_queries, default=0)}; SELECT на тик: среднее {sum(tick_selects) / n:.1f}, "
+        f"максимум {max(tick_selects, default=0)}"
+    )
+    print(
+        f"время тика: p50 {_percentile(tick_ms, 50):.1f} ms, "
+        f"p99 {_percentile(tick_ms, 99):.1f} ms, максимум {max(tick_ms, default=0):.1f} ms, "
+        f"всего {sum(tick_ms) / 1000:.1f} с"
+    )
+    print(
+        f"отметок привычек: {done}; забрано строк расписания: {popped}, отправлено: {sent}, "
+        f"снято при перепроверке: {popped - sent}"
+    )
+    print("сообщений по типам: " + ", ".join(f"{k}: {v}" for k, v in sorted(by_type.items())))
+    print(f"сообщений по часам ({DEFAULT_TIMEZONE}): " + " ".join(f"{h:02d}:{by_hour[h]}" for h in sorted(by_hour)))
+    print(
+        f"опоздание относительно due_at: p50 {_percentile(lateness, 50):.1f} с, p99 {_percentile(lateness, 99):.1f} с, "
+        f"максимум {max(lateness, default=0):.1f} с (лимит отправки {rate:g} сообщ./с)"
+    )
@@ -1,31 +1,45 @@
 #!/usr/bin/env python3
 """
 Воркер умных напоминаний: анализирует историю привычек и отправляет контекстные
-напоминания в Telegram. Работает по московскому времени.
-Запуск: python reminder_worker.py (в цикле каждые 5 мин) или через systemd:
+напоминания в Telegram. Окна напоминаний считаются по местному времени пользователя
+(users.timezone, по умолчанию DEFAULT_TIMEZONE — Europe/Moscow).
+
+Моменты отправки заранее рассчитаны в таблице reminder_schedule; пользователи сгруппированы
+по часовым поясам, и расписание пояса пересобирается, когда в нём наступает полночь (плюс
+точечно при изменении привычек, отметок и настроек). Воркер спит до ближайшей строки и
+обрабатывает только то, что наступило.
+Запуск: python reminder_worker.py или через systemd:
   systemctl start goals-reminder
 """
+import argparse
 import asyncio
 import os
 import logging
-from datetime import datetime, date, time, timedelta
+import socket
+from dataclasses import dataclass, field
+from datetime import datetime, date, time, timedelta, timezone, tzinfo
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 
-import httpx
-
-try:
-    from zoneinfo import ZoneInfo
-    TZ_MOSCOW = ZoneInfo("Europe/Moscow")
-except ImportError:
-    TZ_MOSCOW = None
 from dotenv import load_dotenv
 
 from database import Database
+from maintenance import RetentionSettings, run_maintenance
+from telegram_delivery import GLOBAL_RATE, DeliveryReport, TelegramDelivery
+from user_timezones import DEFAULT_TIMEZONE, valid_timezone, zone
 
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 DB_PATH = os.getenv("DB_PATH", "goals_bot.db")
-INTERVAL_SEC = int(os.getenv("REMINDER_INTERVAL_SEC", "300"))  # 5 мин
+# Наибольший сон между проверками: за это время подхватываются изменения расписания из бота и веб-приложения
+MAX_SLEEP_SEC = int(os.getenv("REMINDER_MAX_SLEEP_SEC", "60"))
+DUE_BATCH = int(os.getenv("REMINDER_DUE_BATCH", "500"))  # строк расписания за один проход
+RETRY_SEC = 300  # повтор неудавшейся отправки (если окно напоминания ещё открыто)
+# Шард «i/N»: процесс обслуживает пользователей с user_id % N == i (переопределяется --shard)
+SHARD = os.getenv("REMINDER_SHARD", "0/1")
+# Шард без heartbeat дольше этого времени считается упавшим, его пользователей забирают живые
+LEASE_TTL_SEC = int(os.getenv("REMINDER_LEASE_TTL_SEC", "180"))
+ZONE_BATCH = 5000  # пользователей одного пояса в одном снимке (лимит параметров SQLite)
 DEFAULT_AVG_HOUR, DEFAULT_AVG_MIN = 10, 0  # если нет истории выполнения
 
 _log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
@@ -40,23 +54,14 @@ logging.basicConfig(
     ],
 )
 logger = logging.getLogger(__name__)
+# httpx пишет каждый запрос (с токеном бота в URL) на INFO — итог по пачке пишет сам воркер
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 DISABLE_HINT = (
     "\n\nКак отключить напоминания: открой приложение → Настройки (иконка шестерёнки) → отключи «Уведомления»."
 )
 
 
-def _parse_avg_time(avg_str: str):
-    """Возвращает (hour, minute) из строки HH:MM или None."""
-    if not avg_str or ":" not in avg_str:
-        return None
-    try:
-        parts = avg_str.strip().split(":")
-        return int(parts[0]), int(parts[1]) if len(parts) > 1 else 0
-    except (ValueError, IndexError):
-        return None
-
-
 def _time_to_minutes(h: int, m: int) -> int:
     return h * 60 + m
 
@@ -66,22 +71,6 @@ def _minutes_to_time(m: int):
     return m // 60, m % 60
 
 
-async def send_telegram_message(chat_id: int, text: str) -> bool:
-    if not BOT_TOKEN or not text:
-        return False
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    try:
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            r = await client.post(url, json={"chat_id": chat_id, "text": text})
-            if r.status_code != 200:
-                logger.warning("Telegram sendMessage %s: %s", r.status_code, r.text)
-                return False
-            return True
-    except Exception as e:
-        logger.exception("send_telegram_message: %s", e)
-        return False
-
-
 def _in_quiet_hours(now: time, start_str: str, end_str: str) -> bool:
     """Проверка: сейчас в тихих часах? start/end в формате HH:MM."""
     if not start_str or not end_str:
@@ -122,157 +111,563 @@ def _build_habit_third_message(title: str) -> str:
     return f"Напоминание: «{title}». Можешь перенести на вечер — открой приложение и отметь, когда сделаешь."
 
 
-def _now_moscow():
-    """Текущее время в Москве (для напоминаний по МСК)."""
-    if TZ_MOSCOW:
-        return datetime.now(TZ_MOSCOW)
-    return datetime.now()
-
-
-async def run_tick(db: Database) -> None:
-    now_dt = _now_moscow()
+def bucket_by_zone(timezones: Dict[int, Optional[str]]) -> Dict[str, List[int]]:
+    """{user_id: пояс} → {пояс: [user_id]}; пустой или неизвестный пояс — DEFAULT_TIMEZONE."""
+    buckets: Dict[str, List[int]] = {}
+    for user_id, tz_name in timezones.items():
+        buckets.setdefault(valid_timezone(tz_name) or DEFAULT_TIMEZONE, []).append(user_id)
+    return buckets
+
+
+@dataclass
+class ReminderJob:
+    """Одно запланированное сообщение: кому, что и как пометить в reminder_sent_log после отправки."""
+    user_id: int
+    reminder_type: str
+    text: str
+    habit_id: Optional[int] = None
+    mission_id: Optional[int] = None
+    # Первое напоминание пользователю (с подсказкой, как отключить) — после отправки выставить first_reminder_sent
+    first_reminder: bool = False
+    sent_on: Optional[str] = None  # местная дата пользователя — ключ в reminder_sent_log
+    due_at: Optional[str] = None  # момент из reminder_schedule (UTC), по которому отправляется
+
+
+def _in_window(now_min: int, lo: int, hi: int) -> bool:
+    if lo <= hi:
+        return lo <= now_min < hi
+    return now_min >= lo or now_min < hi
+
+
+# Окна без привязки к истории: общее напоминание по привычкам без истории и ежедневное о целях
+NO_HISTORY_WINDOW = (_time_to_minutes(DEFAULT_AVG_HOUR, DEFAULT_AVG_MIN) - 15,  # 09:45
+                     _time_to_minutes(DEFAULT_AVG_HOUR, DEFAULT_AVG_MIN) + 5)   # 10:05
+GOALS_WINDOW = (_time_to_minutes(10, 0), _time_to_minutes(10, 15))
+DAY_WINDOW = (0, 24 * 60)
+
+
+def _habit_windows(avg_min: int) -> List[tuple]:
+    """Окна напоминаний по привычке: (reminder_type, минимальная интенсивность, начало, конец) в минутах от полуночи."""
+    return [
+        ("habit_first", 1, _time_to_minutes(*_minutes_to_time(avg_min - 15)),
+         _time_to_minutes(*_minutes_to_time(avg_min + 5))),
+        ("habit_second", 2, _time_to_minutes(*_minutes_to_time(avg_min + 30)),
+         _time_to_minutes(*_minutes_to_time(avg_min + 45))),
+        ("habit_third", 3, _time_to_minutes(*_minutes_to_time(avg_min + 120)),
+         _time_to_minutes(*_minutes_to_time(avg_min + 135))),
+    ]
+
+
+def plan_reminders(snapshot: Dict, now_dt: datetime) -> List[ReminderJob]:
+    """
+    Рассчитать напоминания, которые нужно отправить сейчас, по снимку Database.get_reminder_snapshot().
+    now_dt — местное время пользователей снимка (один пояс). Без обращений к БД: правила те же,
+    что описаны в REMINDERS.md.
+    """
     now_time = now_dt.time()
-    today = now_dt.date().isoformat()
-
-    user_ids = await db.get_users_with_reminders_enabled()
-    if not user_ids:
-        return
-
-    for user_id in user_ids:
-        try:
-            settings = await db.get_user_reminder_settings(user_id)
-            if not settings.get("notifications_enabled", True):
+    now_min = now_time.hour * 60 + now_time.minute
+    goals_window = _in_window(now_min, *GOALS_WINDOW)
+    sent, sent_any, sent_missions = snapshot["sent"], snapshot["sent_any"], snapshot["sent_missions"]
+    jobs: List[ReminderJob] = []
+
+    for user_id, settings in snapshot["settings"].items():
+        if not settings.get("notifications_enabled", True):
+            continue
+        if _in_quiet_hours(
+            now_time,
+            settings.get("quiet_hours_start") or "",
+            settings.get("quiet_hours_end") or "",
+        ):
+            continue
+        intensity = int(settings.get("reminder_intensity") or 2)
+        first_sent = settings.get("first_reminder_sent", False)
+
+        no_history_habits = []  # привычки без истории выполнения (старые пользователи)
+        for habit in snapshot["habits"].get(user_id, []):
+            habit_id = habit["id"]
+            title = (habit.get("title") or "").strip() or "Привычка"
+            avg_min = habit.get("avg_min")
+            if avg_min is None:
+                no_history_habits.append(habit)
                 continue
-            if _in_quiet_hours(
-                now_time,
-                settings.get("quiet_hours_start") or "",
-                settings.get("quiet_hours_end") or "",
-            ):
-                continue
-            intensity = int(settings.get("reminder_intensity") or 2)
-            first_sent = settings.get("first_reminder_sent", False)
-
-            habits = await db.get_habits_not_done_today(user_id)
-            no_history_habits = []  # привычки без истории выполнения (старые пользователи)
-            now_min = now_time.hour * 60 + now_time.minute
-            default_first_lo = _time_to_minutes(DEFAULT_AVG_HOUR, DEFAULT_AVG_MIN) - 15  # 09:45
-            default_first_hi = _time_to_minutes(DEFAULT_AVG_HOUR, DEFAULT_AVG_MIN) + 5   # 10:05
-
-            for habit in habits:
-                habit_id = habit["id"]
-                title = (habit.get("title") or "").strip() or "Привычка"
-                avg_str = await db.get_habit_avg_completion_time(habit_id, days=30)
-                parsed = _parse_avg_time(avg_str)
-                if parsed is None:
-                    no_history_habits.append(habit)
-                    continue
-                h_avg, m_avg = parsed
-
-                avg_min = _time_to_minutes(h_avg, m_avg)
-                first_start = _minutes_to_time(avg_min - 15)
-                first_end = _minutes_to_time(avg_min + 5)
-                second_start = _minutes_to_time(avg_min + 30)
-                second_end = _minutes_to_time(avg_min + 45)
-                third_start = _minutes_to_time(avg_min + 120)
-                third_end = _minutes_to_time(avg_min + 135)
-
-                first_lo = _time_to_minutes(*first_start)
-                first_hi = _time_to_minutes(*first_end)
-                second_lo = _time_to_minutes(*second_start)
-                second_hi = _time_to_minutes(*second_end)
-                third_lo = _time_to_minutes(*third_start)
-                third_hi = _time_to_minutes(*third_end)
-
-                def in_window(lo: int, hi: int) -> bool:
-                    if lo <= hi:
-                        return lo <= now_min < hi
-                    return now_min >= lo or now_min < hi
-
-                if intensity >= 1 and in_window(first_lo, first_hi):
-                    if await db.was_reminder_sent_today(user_id, habit_id, "habit_first"):
-                        continue
-                    text = _build_habit_first_message(title, add_disable_hint=not first_sent)
-                    if await send_telegram_message(user_id, text):
-                        await db.log_reminder_sent(user_id, "habit_first", habit_id=habit_id)
-                        if not first_sent:
-                            await db.set_first_reminder_sent(user_id)
-                    continue
 
-                if intensity >= 2 and in_window(second_lo, second_hi):
-                    if await db.was_reminder_sent_today(user_id, habit_id, "habit_second"):
-                        continue
-                    text = _build_habit_second_message(title)
-                    if await send_telegram_message(user_id, text):
-                        await db.log_reminder_sent(user_id, "habit_second", habit_id=habit_id)
+            for rtype, min_intensity, lo, hi in _habit_windows(avg_min):
+                if intensity < min_intensity or not _in_window(now_min, lo, hi):
                     continue
+                if (user_id, habit_id, rtype) not in sent:
+                    if rtype == "habit_first":
+                        jobs.append(ReminderJob(
+                            user_id, rtype, _build_habit_first_message(title, add_disable_hint=not first_sent),
+                            habit_id=habit_id, first_reminder=not first_sent,
+                        ))
+                    elif rtype == "habit_second":
+                        jobs.append(ReminderJob(user_id, rtype, _build_habit_second_message(title), habit_id=habit_id))
+                    else:
+                        jobs.append(ReminderJob(user_id, rtype, _build_habit_third_message(title), habit_id=habit_id))
+                break
+
+        # Привычки без истории выполнения (пользователи до внедрения напоминаний): одно общее напоминание в 09:45–10:05
+        if no_history_habits and intensity >= 1 and _in_window(now_min, *NO_HISTORY_WINDOW):
+            if (user_id, "habit_first_no_history") not in sent_any:
+                n = len(no_history_habits)
+                text = f"У тебя есть привычки на сегодня ({n}). Не забудь отметить их в приложении! ✨"
+                if not first_sent:
+                    text += DISABLE_HINT
+                jobs.append(ReminderJob(user_id, "habit_first_no_history", text, first_reminder=not first_sent))
+
+        # Напоминание за неделю до дедлайна миссии
+        for mission in snapshot["missions"].get(user_id, []):
+            mid = mission.get("id")
+            mtitle = (mission.get("title") or "").strip() or "Миссия"
+            if mid and (user_id, mid, "mission_deadline_7") not in sent_missions:
+                text = f"За неделю до дедлайна миссии: осталось 7 дней для завершения «{mtitle}» 📅"
+                jobs.append(ReminderJob(user_id, "mission_deadline_7", text, mission_id=mid))
+
+        # Ежедневное напоминание о целях (раз в день, в 10:00 по умолчанию)
+        if goals_window and (user_id, "goal_daily") not in sent_any:
+            n = snapshot["open_goals"].get(user_id, 0)
+            if n:
+                text = f"У тебя {n} незавершённых целей на сегодня. Загляни в приложение! 🎯"
+                jobs.append(ReminderJob(user_id, "goal_daily", text))
+    today = now_dt.date().isoformat()
+    for job in jobs:
+        job.sent_on = today
+    return jobs
 
-                if intensity >= 3 and in_window(third_lo, third_hi):
-                    if await db.was_reminder_sent_today(user_id, habit_id, "habit_third"):
-                        continue
-                    text = _build_habit_third_message(title)
-                    if await send_telegram_message(user_id, text):
-                        await db.log_reminder_sent(user_id, "habit_third", habit_id=habit_id)
-
-            # Привычки без истории выполнения (пользователи до внедрения напоминаний): одно общее напоминание в 09:45–10:05
-            if no_history_habits and intensity >= 1:
-                if default_first_lo <= now_min < default_first_hi:
-                    if not await db.was_reminder_sent_today(user_id, None, "habit_first_no_history"):
-                        n = len(no_history_habits)
-                        text = f"У тебя есть привычки на сегодня ({n}). Не забудь отметить их в приложении! ✨"
-                        if not first_sent:
-                            text += DISABLE_HINT
-                        if await send_telegram_message(user_id, text):
-                            await db.log_reminder_sent(user_id, "habit_first_no_history", habit_id=None)
-                            if not first_sent:
-                                await db.set_first_reminder_sent(user_id)
-
-            # Напоминание за неделю до дедлайна миссии
-            missions = await db.get_missions(user_id, include_completed=False)
-            week_later = (now_dt.date() + timedelta(days=7)).isoformat()
-            for mission in missions:
-                deadline = mission.get("deadline")
-                if not deadline:
-                    continue
-                try:
-                    dl = deadline[:10] if isinstance(deadline, str) and len(deadline) >= 10 else deadline
-                except Exception:
-                    continue
-                if dl != week_later:
-                    continue
-                mid = mission.get("id")
-                mtitle = (mission.get("title") or "").strip() or "Миссия"
-                if mid and not await db.was_reminder_sent_today_mission(user_id, mid, "mission_deadline_7"):
-                    text = f"За неделю до дедлайна миссии: осталось 7 дней для завершения «{mtitle}» 📅"
-                    if await send_telegram_message(user_id, text):
-                        await db.log_reminder_sent(user_id, "mission_deadline_7", mission_id=mid)
-
-            # Ежедневное напоминание о целях (раз в день, в 10:00 по умолчанию)
-            if now_time.hour == 10 and now_time.minute < 15:
-                if not await db.was_reminder_sent_today(user_id, None, "goal_daily"):
-                    goals = await db.get_goals(user_id, include_completed=False)
-                    if goals:
-                        n = len(goals)
-                        text = f"У тебя {n} незавершённых целей на сегодня. Загляни в приложение! 🎯"
-                        if await send_telegram_message(user_id, text):
-                            await db.log_reminder_sent(user_id, "goal_daily")
-        except Exception as e:
-            logger.exception("reminder user %s: %s", user_id, e)
-
-
-async def main() -> None:
+
+async def plan_tick(db: Database, now_dt: datetime) -> List[ReminderJob]:
+    """Снимок из БД (несколько общих запросов) и расчёт напоминаний к отправке на момент now_dt."""
+    now_time = now_dt.time()
+    snapshot = await db.get_reminder_snapshot(
+        today=now_dt.date().isoformat(),
+        mission_deadline=(now_dt.date() + timedelta(days=7)).isoformat(),
+        with_goals=now_time.hour == 10 and now_time.minute < 15,
+    )
+    return plan_reminders(snapshot, now_dt)
+
+
+def _window_minutes(lo: int, hi: int):
+    """Минуты окна [lo, hi) в порядке суток (окно через полночь — с начала суток)."""
+    if lo <= hi:
+        return range(lo, hi)
+    return [*range(0, hi), *range(lo, 24 * 60)]
+
+
+def _first_due_minute(lo: int, hi: int, settings: Dict, from_min: int) -> Optional[int]:
+    """Первая минута окна не раньше from_min, которая не попадает в тихие часы пользователя."""
+    quiet_start = settings.get("quiet_hours_start") or ""
+    quiet_end = settings.get("quiet_hours_end") or ""
+    for m in _window_minutes(lo, hi):
+        if m >= from_min and not _in_quiet_hours(time(m // 60, m % 60), quiet_start, quiet_end):
+            return m
+    return None
+
+
+class HabitMinutesCache:
+    """
+    Обычное время выполнения привычек области воркера ({habit_id: минуты от полуночи}, Database.get_habit_minutes):
+    один запрос на все привычки, пересчёт раз в сутки; у пользователей из reminder_schedule_dirty и у
+    пользователей забранных шардов — сразу.
+    """
+
+    def __init__(self):
+        self.minutes: Dict[int, Optional[int]] = {}
+        self.day: Optional[date] = None
+
+    async def get(
+        self, db: Database, shard: Optional[Tuple[int, Sequence[int]]] = None, today: Optional[date] = None
+    ) -> Dict[int, Optional[int]]:
+        today = today or _utc_now().date()
+        if self.day != today:
+            self.minutes = await db.get_habit_minutes(shard=shard)
+            self.day = today
+        return self.minutes
+
+    async def refresh(
+        self, db: Database, user_ids: Optional[List[int]] = None, shard: Optional[Tuple[int, Sequence[int]]] = None
+    ) -> None:
+        if self.day is not None:
+            self.minutes.update(await db.get_habit_minutes(user_ids=user_ids, shard=shard))
+
+
+def _to_utc(day: date, minute: int, tz: tzinfo) -> str:
+    """Минута местных суток day в поясе tz → 'YYYY-MM-DD HH:MM:SS' в UTC (формат reminder_schedule.due_at)."""
+    local = datetime.combine(day, time(minute // 60, minute % 60), tzinfo=tz)
+    return local.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def schedule_reminders(snapshot: Dict, day: date, from_min: int = 0, tz: Optional[tzinfo] = None) -> List[tuple]:
+    """
+    Строки reminder_schedule (user_id, habit_id, mission_id, reminder_type, due_at) на местные сутки day
+    пояса tz (None — DEFAULT_TIMEZONE) по тому же снимку, что и plan_reminders: момент — первая минута окна
+    (не раньше from_min) вне тихих часов. Уже отправленное сегодня и выполненные привычки в расписание не попадают.
+    """
+    tz = tz or zone()
+    sent, sent_any, sent_missions = snapshot["sent"], snapshot["sent_any"], snapshot["sent_missions"]
+    rows: List[tuple] = []
+
+    def add(settings, lo, hi, user_id, habit_id, mission_id, rtype):
+        m = _first_due_minute(lo, hi, settings, from_min)
+        if m is not None:
+            rows.append((user_id, habit_id, mission_id, rtype, _to_utc(day, m, tz)))
+
+    for user_id, settings in snapshot["settings"].items():
+        if not settings.get("notifications_enabled", True):
+            continue
+        intensity = int(settings.get("reminder_intensity") or 2)
+        no_history = False
+        for habit in snapshot["habits"].get(user_id, []):
+            if habit.get("avg_min") is None:
+                no_history = True
+                continue
+            for rtype, min_intensity, lo, hi in _habit_windows(habit["avg_min"]):
+                if intensity >= min_intensity and (user_id, habit["id"], rtype) not in sent:
+                    add(settings, lo, hi, user_id, habit["id"], None, rtype)
+        if no_history and intensity >= 1 and (user_id, "habit_first_no_history") not in sent_any:
+            add(settings, *NO_HISTORY_WINDOW, user_id, None, None, "habit_first_no_history")
+        for mission in snapshot["missions"].get(user_id, []):
+            if (user_id, mission["id"], "mission_deadline_7") not in sent_missions:
+                add(settings, *DAY_WINDOW, user_id, None, mission["id"], "mission_deadline_7")
+        if snapshot["open_goals"].get(user_id) and (user_id, "goal_daily") not in sent_any:
+            add(settings, *GOALS_WINDOW, user_id, None, None, "goal_daily")
+    return rows
+
+
+async def rebuild_schedule(
+    db: Database,
+    now_dt: datetime,
+    user_ids: Optional[List[int]] = None,
+    shard: Optional[Tuple[int, Sequence[int]]] = None,
+    zones: Optional[Sequence[str]] = None,
+    habit_minutes: Optional[Dict[int, Optional[int]]] = None,
+) -> Dict[str, int]:
+    """
+    Пересчитать расписание на текущие местные сутки: у указанных пользователей или у всех пользователей
+    шардов shard (None — у всех), при zones — только у пользователей этих поясов (в них наступила полночь).
+    Пользователи группируются по поясу: снимок и расчёт — на местную дату пояса. now_dt — момент с tzinfo,
+    habit_minutes — кэш HabitMinutesCache (None — время привычек считается в снимке).
+    Возвращает {пояс: число строк расписания}.
+    """
+    buckets = bucket_by_zone(await db.get_user_timezones(user_ids=user_ids, shard=shard))
+    if zones is not None:
+        buckets = {tz_name: uids for tz_name, uids in buckets.items() if tz_name in zones}
+    # Все пользователи области в одном поясе (обычная установка) — один снимок по области, без списков id
+    whole = user_ids is None and zones is None and len(buckets) == 1
+    rows: List[tuple] = []
+    built: Dict[str, int] = {}
+    for tz_name, uids in buckets.items():
+        tz = zone(tz_name)
+        local = now_dt.astimezone(tz)
+        day = local.date()
+        n = len(rows)
+        for start in ([0] if whole else range(0, len(uids), ZONE_BATCH)):
+            snapshot = await db.get_reminder_snapshot(
+                today=day.isoformat(),
+                mission_deadline=(day + timedelta(days=7)).isoformat(),
+                with_goals=True,
+                user_ids=None if whole else uids[start:start + ZONE_BATCH],
+                shard=shard,
+                habit_minutes=habit_minutes,
+            )
+            rows.extend(schedule_reminders(snapshot, day, from_min=local.hour * 60 + local.minute, tz=tz))
+        built[tz_name] = len(rows) - n
+    if zones is None:
+        await db.replace_reminder_schedule(rows, user_ids=user_ids, shard=shard)
+    else:
+        await db.replace_reminder_schedule(rows, user_ids=[uid for uids in buckets.values() for uid in uids])
+    return built
+
+
+async def apply_habit_events(db: Database, shard: Optional[Tuple[int, Sequence[int]]] = None) -> List[int]:
+    """
+    Забрать события выполнения привычек за сегодня (их пишут отметки в боте и мини-приложении).
+    Напоминания по выполненным привычкам удаляются из расписания сразу, без снимка и пересборки;
+    возвращает пользователей, у которых отметку сняли, — их расписание нужно пересобрать.
+    """
+    events = await db.take_habit_events(shard=shard)
+    if not events:
+        return []
+    done = [hid for hid, (_, is_done) in events.items() if is_done]
+    dropped = await db.drop_habit_reminders(done) if done else 0
+    undone = sorted({uid for uid, is_done in events.values() if not is_done})
+    logger.info(
+        "События привычек: выполнено %s (снято напоминаний: %s), отметка снята у %s пользователей",
+        len(done), dropped, len(undone),
+    )
+    return undone
+
+
+async def deliver(
+    db: Database, delivery: TelegramDelivery, jobs: List[ReminderJob]
+) -> Tuple[List[ReminderJob], DeliveryReport]:
+    """
+    Занять все напоминания пачки в reminder_sent_log одним запросом (уникальный ключ на день), отправить
+    занятые пулом TelegramDelivery и одним запросом освободить недоставленные (кроме тех, что Telegram мог
+    принять без ответа — report.uncertain: они остаются занятыми). Напоминания, уже занятые другим тиком или шардом,
+    пропускаются. Возвращает отправлявшиеся напоминания и отчёт (results — по ним).
+    """
+    claims = await db.claim_reminders(
+        [(job.user_id, job.reminder_type, job.habit_id, job.mission_id, job.sent_on) for job in jobs]
+    )
+    claimed = [job for job, claim_id in zip(jobs, claims) if claim_id is not None]
+    claim_ids = [claim_id for claim_id in claims if claim_id is not None]
+    first_marked = set()
+
+    async def on_sent(i: int) -> None:
+        job = claimed[i]
+        if job.first_reminder and job.user_id not in first_marked:
+            first_marked.add(job.user_id)
+            await db.set_first_reminder_sent(job.user_id)
+
+    report = await delivery.send_many([(job.user_id, job.text) for job in claimed], on_sent=on_sent)
+    await db.release_reminder_claims(
+        [cid for i, (cid, ok) in enumerate(zip(claim_ids, report.results)) if not ok and i not in report.uncertain]
+    )
+    return claimed, report
+
+
+@dataclass
+class DueBatch:
+    """Итог одного прохода run_due."""
+    popped: int = 0  # забрано строк расписания
+    jobs: List[ReminderJob] = field(default_factory=list)  # отправлявшиеся напоминания (занятые этим проходом)
+    report: DeliveryReport = field(default_factory=DeliveryReport)  # results — по jobs
+
+
+async def run_due(
+    db: Database,
+    delivery: TelegramDelivery,
+    shard: Optional[Tuple[int, Sequence[int]]] = None,
+    habit_minutes: Optional[Dict[int, Optional[int]]] = None,
+    clock: Callable[[], datetime] = _utc_now,
+) -> DueBatch:
+    """
+    Забрать наступившие строки расписания (своих шардов), перепроверить их по свежему снимку только этих
+    пользователей (окно, тихие часы, отметки и отправки за местные сутки — по снимку на пояс) и отправить
+    одной пачкой. Строки забираются и перепроверяются на один и тот же момент clock().
+    """
+    now_dt = clock()
+    due = await db.pop_due_reminders(now_dt.strftime("%Y-%m-%d %H:%M:%S"), limit=DUE_BATCH, shard=shard)
+    if not due:
+        return DueBatch()
+    keys: Dict[tuple, str] = {}
+    for r in due:
+        key = (r["user_id"], r["reminder_type"], r["habit_id"], r["mission_id"])
+        keys[key] = min(keys.get(key, r["due_at"]), r["due_at"])
+    jobs: List[ReminderJob] = []
+    for tz_name, uids in bucket_by_zone(await db.get_user_timezones(sorted({r["user_id"] for r in due}))).items():
+        local = now_dt.astimezone(zone(tz_name))
+        snapshot = await db.get_reminder_snapshot(
+            today=local.date().isoformat(),
+            mission_deadline=(local.date() + timedelta(days=7)).isoformat(),
+            with_goals=_in_window(local.hour * 60 + local.minute, *GOALS_WINDOW),
+            user_ids=uids,
+            habit_minutes=habit_minutes,
+        )
+        for job in plan_reminders(snapshot, local):
+            job.due_at = keys.get((job.user_id, job.reminder_type, job.habit_id, job.mission_id))
+            if job.due_at is not None:
+                jobs.append(job)
+    claimed, report = await deliver(db, delivery, jobs)
+    # Исход неизвестен — не повторяем, чтобы не отправить напоминание дважды
+    failed = [job for i, (job, ok) in enumerate(zip(claimed, report.results)) if not ok and i not in report.uncertain]
+    if failed:
+        retry_at = (clock() + timedelta(seconds=RETRY_SEC)).strftime("%Y-%m-%d %H:%M:%S")
+        await db.add_reminder_schedule(
+            [(job.user_id, job.habit_id, job.mission_id, job.reminder_type, retry_at) for job in failed]
+        )
+    logger.info(
+        "due: %s строк, отправлено %s за %.2f с (%.1f сообщ./с), не отправлено %s (без ответа %s), 429: %s, "
+        "повторов: %s, занято другими: %s",
+        len(due), report.sent, report.elapsed, report.per_second, report.failed, len(report.uncertain),
+        report.throttled, report.retries, len(jobs) - len(claimed),
+    )
+    return DueBatch(len(due), claimed, report)
+
+
+async def _sleep_seconds(
+    db: Database,
+    now_dt: datetime,
+    shard: Optional[Tuple[int, Sequence[int]]] = None,
+    zones: Sequence[str] = (),
+) -> float:
+    """От now_dt до ближайшей строки расписания, но не дольше MAX_SLEEP_SEC и не позже ближайшей полуночи в поясах zones."""
+    delay = float(MAX_SLEEP_SEC)
+    next_due = await db.next_reminder_due_at(shard=shard)
+    if next_due:
+        due_dt = datetime.strptime(next_due, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+        delay = min(delay, (due_dt - now_dt).total_seconds())
+    for tz_name in zones:
+        local = now_dt.astimezone(zone(tz_name))
+        midnight = datetime.combine(local.date() + timedelta(days=1), time(0, 0), tzinfo=local.tzinfo)
+        delay = min(delay, (midnight.astimezone(timezone.utc) - now_dt).total_seconds())
+    return max(delay, 1.0)
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """«i/N» → (i, N), 0 <= i < N."""
+    try:
+        shard, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise ValueError(f"шард задаётся как i/N, получено {value!r}")
+    if not 0 <= shard < count:
+        raise ValueError(f"номер шарда должен быть от 0 до {count - 1}, получено {value!r}")
+    return shard, count
+
+
+def assign_shards(shard: int, count: int, leases: Dict[int, float], now_ts: float, ttl: float = LEASE_TTL_SEC) -> List[int]:
+    """
+    Шарды, которые обслуживает этот процесс: свой и часть упавших (heartbeat старше ttl или не было).
+    Упавшие раздаются живым по кругу; все процессы считают одинаково по одной таблице аренды, а
+    уникальный ключ reminder_sent_log не даёт отправить дважды, пока представления расходятся.
+    """
+    alive = sorted({shard} | {j for j, ts in leases.items() if j < count and now_ts - ts < ttl})
+    dead = [j for j in range(count) if j not in alive]
+    return sorted([shard] + [j for k, j in enumerate(dead) if alive[k % len(alive)] == shard])
+
+
+async def _maintenance(db: Database, retention: RetentionSettings) -> None:
+    try:
+        await run_maintenance(db, retention)
+    except Exception as e:
+        logger.exception("Обслуживание БД: %s", e)
+
+
+@dataclass
+class WorkerState:
+    """Состояние цикла воркера между тиками (run_tick)."""
+    shard: int = 0
+    count: int = 1
+    owner: str = ""
+    retention: RetentionSettings = field(default_factory=RetentionSettings.from_env)
+    # Пояс → местная дата, на которую построено его расписание (None — расписание ещё не строилось)
+    zone_days: Optional[Dict[str, date]] = None
+    owned: List[int] = field(default_factory=list)
+    habit_times: HabitMinutesCache = field(default_factory=HabitMinutesCache)
+    maintenance_day: Optional[date] = None
+    maintenance_task: Optional[asyncio.Task] = None
+
+
+async def run_tick(
+    db: Database,
+    delivery: TelegramDelivery,
+    state: WorkerState,
+    clock: Callable[[], datetime] = _utc_now,
+) -> Tuple[float, List[DueBatch]]:
+    """
+    Один проход цикла воркера: heartbeat и шарды, события привычек и пересборки расписания, обслуживание БД,
+    отправка наступившего. clock — текущее время (UTC, с tzinfo); симуляция (--simulate) подставляет свои часы.
+    Возвращает (сколько спать до следующего прохода, пачки отправки).
+    """
+    now_dt = clock()
+    shard, count = state.shard, state.count
+    await db.heartbeat_reminder_shard(shard, count, state.owner)
+    mine = assign_shards(shard, count, await db.get_reminder_shard_leases(count), _utc_now().timestamp())
+    scope = None if count == 1 else (count, mine)
+    # Сначала события отметок: выполненные привычки уходят из расписания до выборки наступивших строк
+    undone = await apply_habit_events(db, shard=scope)
+    dirty = sorted(set(await db.take_reminder_schedule_dirty(shard=scope)) | set(undone))
+    habit_times = state.habit_times
+    minutes = await habit_times.get(db, shard=scope, today=now_dt.date())
+    if state.zone_days is None:
+        built = await rebuild_schedule(db, now_dt, shard=scope, habit_minutes=minutes)
+        state.zone_days = {}
+        logger.info(
+            "Расписание пересобрано (шарды %s из %s): %s напоминаний, поясов: %s",
+            mine, count, sum(built.values()), len(built),
+        )
+    else:
+        # Пересобираем только пояса, где наступили новые местные сутки
+        new_day = [z for z, d in state.zone_days.items() if now_dt.astimezone(zone(z)).date() != d]
+        built = (
+            await rebuild_schedule(db, now_dt, shard=scope, zones=new_day, habit_minutes=minutes)
+            if new_day else {}
+        )
+        if new_day:
+            logger.info("Новые сутки в поясах %s: %s напоминаний", new_day, sum(built.values()))
+        added = [j for j in mine if j not in state.owned]
+        if added:
+            logger.warning("Шард %s/%s забирает шарды %s без heartbeat", shard, count, added)
+            await habit_times.refresh(db, shard=(count, added))
+            built.update(await rebuild_schedule(db, now_dt, shard=(count, added), habit_minutes=minutes))
+        if dirty:
+            await habit_times.refresh(db, user_ids=dirty)
+            built.update(await rebuild_schedule(db, now_dt, user_ids=dirty, habit_minutes=minutes))
+    for z in built:
+        state.zone_days[z] = now_dt.astimezone(zone(z)).date()
+    if state.owned and mine != state.owned:
+        logger.info("Шард %s/%s: обслуживаемые шарды %s → %s", shard, count, state.owned, mine)
+    state.owned = mine
+    # Обслуживание БД раз в сутки выполняет владелец шарда 0 — фоновой задачей, не задерживая отправку
+    local = now_dt.astimezone(zone())
+    if (
+        0 in mine
+        and 0 <= state.retention.maintenance_hour <= local.hour
+        and state.maintenance_day != local.date()
+        and (state.maintenance_task is None or state.maintenance_task.done())
+    ):
+        state.maintenance_day = local.date()
+        state.maintenance_task = asyncio.create_task(_maintenance(db, state.retention))
+    batches = [await run_due(db, delivery, shard=scope, habit_minutes=minutes, clock=clock)]
+    while batches[-1].popped >= DUE_BATCH:
+        await db.heartbeat_reminder_shard(shard, count, state.owner)
+        batches.append(await run_due(db, delivery, shard=scope, habit_minutes=minutes, clock=clock))
+    return await _sleep_seconds(db, clock(), shard=scope, zones=list(state.zone_days)), batches
+
+
+async def main(shard_spec: str = SHARD) -> None:
     if not BOT_TOKEN:
         logger.error("BOT_TOKEN не задан. Задайте в .env")
         return
+    shard, count = parse_shard(shard_spec)
     db = Database(DB_PATH)
-    await db.init_db()
-    logger.info("Reminder worker started (interval=%ss, timezone=Europe/Moscow)", INTERVAL_SEC)
-    while True:
-        try:
-            await run_tick(db)
-        except Exception as e:
-            logger.exception("run_tick: %s", e)
-        await asyncio.sleep(INTERVAL_SEC)
+    await db.open()
+    # Лимит Telegram общий на бота — делим его между шардами
+    delivery = TelegramDelivery(BOT_TOKEN, global_rate=GLOBAL_RATE / count)
+    try:
+        await db.init_db()
+        db.start_wal_checkpointer("reminder")
+        logger.info(
+            "Reminder worker started (shard %s/%s, max sleep=%ss, default timezone=%s)",
+            shard, count, MAX_SLEEP_SEC, DEFAULT_TIMEZONE,
+        )
+        state = WorkerState(shard=shard, count=count, owner=f"{socket.gethostname()}:{os.getpid()}")
+        while True:
+            delay = float(MAX_SLEEP_SEC)
+            try:
+                delay, _ = await run_tick(db, delivery, state)
+            except Exception as e:
+                logger.exception("reminder loop: %s", e)
+            await asyncio.sleep(delay)
+    finally:
+        await delivery.close()
+        await db.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Воркер умных напоминаний")
+    parser.add_argument(
+        "--shard", default=SHARD, help="i/N — обслуживать пользователей с user_id %% N == i (по умолчанию REMINDER_SHARD или 0/1)"
+    )
+    sim = parser.add_argument_group("симуляция суток без Telegram (reminder_simulation.py)")
+    sim.add_argument("--simulate", action="store_true", help="проиграть сутки на синтетической БД и напечатать отчёт")
+    sim.add_argument("--users", type=int, default=5000, help="пользователей в синтетической БД")
+    sim.add_argument("--habits", type=int, default=3, help="привычек на пользователя в среднем")
+    sim.add_argument("--days", type=int, default=30, help="дней истории выполнения")
+    sim.add_argument("--db", help="вместо синтетической БД взять копию этой")
+    sim.add_argument("--zones", default="", help="пояса пользователей через запятую (по умолчанию DEFAULT_TIMEZONE)")
+    sim.add_argument("--done-share", type=float, default=0.6, help="доля привычек, которые отмечают за сутки")
+    sim.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    if args.simulate:
+        from reminder_simulation import simulate
+        asyncio.run(simulate(
+            users=args.users, habits=args.habits, days=args.days, seed=args.seed, db_path=args.db,
+            timezones=[z.strip() for z in args.zones.split(",") if z.strip()], done_share=args.done_share,
+        ))
+    else:
+        asyncio.run(main(args.shard))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный замер: задержка GET /api/user/{id}/habits (p50/p99).
+
+Создаёт временную БД с одним пользователем, N привычками и историей выполнения
+за D дней, затем гоняет эндпоинт через ASGI-транспорт httpx (без сети и uvicorn):
+сначала последовательно, потом пачками по 9 параллельных запросов (как loadAll()).
+
+Запуск из корня проекта:
+  python scripts/bench_habits_api.py --habits 10 --days 120 --requests 200
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCH_BOT_TOKEN = "123456:bench-token"
+os.environ["BOT_TOKEN"] = BENCH_BOT_TOKEN
+
+import httpx  # noqa: E402
+
+import webapp_server  # noqa: E402
+from database import Database  # noqa: E402
+
+USER_ID = 424242
+
+
+def _init_data(user_id: int) -> str:
+    """Валидная подпись initData для тестового пользователя."""
+    fields = {
+        "auth_date": str(int(time.time())),
+        "query_id": "bench",
+        "user": json.dumps({"id": user_id, "first_name": "Bench", "username": "bench"}),
+    }
+    check_str = "\n".join(f"{k}={fields[k]}" for k in sorted(fields))
+    secret = hmac.new(b"WebAppData", BENCH_BOT_TOKEN.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret, check_str.encode(), hashlib.sha256).hexdigest()
+    return "&".join(f"{k}={quote(v)}" for k, v in fields.items())
+
+
+async def _seed(db: Database, habits: int, days: int) -> None:
+    await db.add_user(USER_ID, "bench", "Bench", "")
+    today = date.today()
+    for i in range(habits):
+        hid = await db.add_habit(USER_ID, f"Привычка {i}", "")
+        for d in range(days):
+            await db.increment_habit_count(hid, (today - timedelta(days=d)).isoformat())
+
+
+def _pct(values, p: float) -> float:
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+def _report(name: str, samples) -> None:
+    ms = [s * 1000 for s in samples]
+    print(
+        f"{name:<12} n={len(ms):<5} p50={_pct(ms, 50):8.2f} ms  p99={_pct(ms, 99):8.2f} ms  "
+        f"mean={statistics.mean(ms):8.2f} ms"
+    )
+
+
+async def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--habits", type=int, default=10)
+    ap.add_argument("--days", type=int, default=120)
+    ap.add_argument("--requests", type=int, default=200)
+    args = ap.parse_args()
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "bench.db"))
+        await db.init_db()
+        await _seed(db, args.habits, args.days)
+        webapp_server.db = db
+
+        headers = {"X-Telegram-Init-Data": _init_data(USER_ID)}
+        url = f"/api/user/{USER_ID}/habits"
+        transport = httpx.ASGITransport(app=webapp_server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            r = await client.get(url, headers=headers)
+            assert r.status_code == 200 and len(r.json()) == args.habits, r.text
+
+            seq = []
+            for _ in range(args.requests):
+                t0 = time.perf_counter()
+                await client.get(url, headers=headers)
+                seq.append(time.perf_counter() - t0)
+
+            async def one():
+                t0 = time.perf_counter()
+                await client.get(url, headers=headers)
+                return time.perf_counter() - t0
+
+            par = []
+            for _ in range(max(1, args.requests // 9)):
+                par.extend(await asyncio.gather(*(one() for _ in range(9))))
+
+        print(f"habits={args.habits} days={args.days}")
+        _report("sequential", seq)
+        _report("parallel x9", par)
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк проверки Telegram initData (validate_telegram_init_data).
+
+Сравнивает первую проверку строки (HMAC + разбор JSON) с повторной,
+которая берётся из LRU-кэша — так выглядит каждый следующий запрос
+мини-приложения в рамках одного сеанса.
+
+Запуск из корня проекта:
+  python scripts/bench_init_data.py [--n 20000]
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+import timeit
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCH_BOT_TOKEN = "123456:bench-token"
+os.environ["BOT_TOKEN"] = BENCH_BOT_TOKEN
+
+import webapp_server  # noqa: E402
+
+
+def _init_data(user_id: int) -> str:
+    """Валидная подпись initData для тестового пользователя."""
+    fields = {
+        "auth_date": str(int(time.time())),
+        "query_id": f"bench-{user_id}",
+        "user": json.dumps({"id": user_id, "first_name": "Bench", "username": "bench"}),
+    }
+    check_str = "\n".join(f"{k}={fields[k]}" for k in sorted(fields))
+    secret = hmac.new(b"WebAppData", BENCH_BOT_TOKEN.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret, check_str.encode(), hashlib.sha256).hexdigest()
+    return "&".join(f"{k}={quote(v)}" for k, v in fields.items())
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--n", type=int, default=20000)
+    args = ap.parse_args()
+    validate = webapp_server.validate_telegram_init_data
+
+    # Холодная проверка: каждый раз новая строка (кэш не помогает)
+    fresh = [_init_data(1000 + i) for i in range(args.n)]
+    it = iter(fresh)
+    cold = timeit.timeit(lambda: validate(next(it)), number=args.n)
+
+    # Горячая: одна и та же строка, как в течение сеанса
+    same = fresh[-1]
+    assert validate(same) is not None
+    hot = timeit.timeit(lambda: validate(same), number=args.n)
+
+    # Неверная подпись — всегда полный расчёт
+    bad = same[: same.rindex("hash=") + 5] + "0" * 64
+    invalid = timeit.timeit(lambda: validate(bad), number=args.n)
+
+    for name, total in (("первая проверка", cold), ("из кэша", hot), ("неверная подпись", invalid)):
+        print(f"{name:<18} {total / args.n * 1e6:8.2f} мкс/вызов")
+    print(f"ускорение повторной проверки: x{cold / hot:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный замер планировщика напоминаний (reminder_worker.plan_tick) на синтетической БД.
+
+Создаёт временную БД с N пользователями (настройки, привычки с историей за 30 дней,
+миссии с дедлайнами, цели, часть уже отправленных сегодня напоминаний) и для
+нескольких моментов суток измеряет: число SQL-запросов, время снимка + расчёта
+и число запланированных сообщений. Затем — ночную пересборку reminder_schedule
+(со временем привычек в снимке и из суточного кэша) и пробуждение воркера, когда
+ничего не наступило. Отправки не выполняются.
+
+Запуск из корня проекта:
+  python scripts/bench_reminder_planner.py --users 10000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench-token")
+
+from database import Database  # noqa: E402
+import reminder_worker  # noqa: E402
+from reminder_simulation import build_synthetic_db  # noqa: E402
+
+
+async def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=10000)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "reminders.db")
+        db = Database(path)
+        await db.init_db()
+        await db.close()
+        t0 = time.perf_counter()
+        build_synthetic_db(path, args.users, seed=args.seed)
+        print(f"users={args.users}: синтетическая БД за {time.perf_counter() - t0:.1f} с")
+
+        db = Database(path)
+        await db.open()
+        queries = []
+        for conn in [db._writer, *db._reader_conns]:
+            await conn.set_trace_callback(queries.append)
+
+        today = date.today()
+        for hh, mm in ((7, 0), (9, 50), (10, 5), (13, 30), (19, 0), (23, 30)):
+            now_dt = datetime.combine(today, datetime.min.time()).replace(hour=hh, minute=mm)
+            queries.clear()
+            t0 = time.perf_counter()
+            jobs = await reminder_worker.plan_tick(db, now_dt)
+            elapsed = time.perf_counter() - t0
+            by_type = {}
+            for job in jobs:
+                by_type[job.reminder_type] = by_type.get(job.reminder_type, 0) + 1
+            print(
+                f"{hh:02d}:{mm:02d}  запросов={len(queries):<3} время={elapsed * 1000:8.1f} ms  "
+                f"сообщений={len(jobs):<5} {by_type}"
+            )
+
+        midnight = datetime.combine(today, datetime.min.time(), tzinfo=reminder_worker.zone())
+        queries.clear()
+        t0 = time.perf_counter()
+        rows = sum((await reminder_worker.rebuild_schedule(db, midnight)).values())
+        selects = sum(q.lstrip().upper().startswith(("SELECT", "WITH")) for q in queries)
+        print(
+            f"пересборка расписания: SELECT-запросов={selects} время={(time.perf_counter() - t0) * 1000:.1f} ms "
+            f"строк={rows}"
+        )
+        t0 = time.perf_counter()
+        minutes = await db.get_habit_minutes()
+        t_minutes = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        rows = sum((await reminder_worker.rebuild_schedule(db, midnight, habit_minutes=minutes)).values())
+        print(
+            f"время привычек (круговое среднее, кэш на сутки): {t_minutes * 1000:.1f} ms на {len(minutes)} привычек; "
+            f"пересборка с кэшем: {(time.perf_counter() - t0) * 1000:.1f} ms строк={rows}"
+        )
+        queries.clear()
+        t0 = time.perf_counter()
+        await db.take_reminder_schedule_dirty()
+        await db.pop_due_reminders(f"{today - timedelta(days=1)} 00:00:00")
+        await db.next_reminder_due_at()
+        print(
+            f"пробуждение без наступивших напоминаний: запросов={len(queries)} "
+            f"время={(time.perf_counter() - t0) * 1000:.2f} ms"
+        )
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
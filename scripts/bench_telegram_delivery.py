@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Замер и проверка отправки напоминаний (telegram_delivery.TelegramDelivery) на локальном
+фейковом Telegram (scripts/fake_telegram_server.py) с настоящими лимитами: ~30 сообщений/с
+на бота и 1 сообщение/с в чат.
+
+1. Прежняя схема: новый httpx-клиент на каждое сообщение, отправка строго по очереди.
+2. Пул с общим клиентом и token bucket: скорость, число 429, порядок сообщений в чате.
+3. Сервер отвечает 429 (retry_after=1) на первые запросы — все сообщения всё равно доходят.
+
+Код выхода 1, если какое-то сообщение не доставлено или нарушен порядок в чате.
+
+Запуск из корня проекта:
+  python scripts/bench_telegram_delivery.py [--messages 600] [--latency-ms 20 80]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram_server import FakeTelegram  # noqa: E402
+from telegram_delivery import TelegramDelivery  # noqa: E402
+
+TOKEN = "123456:bench-token"
+
+
+def _messages(n: int, seed: int = 1):
+    """n сообщений: у большинства пользователей одно напоминание, у части — 2–3 за раз."""
+    rnd = random.Random(seed)
+    out, chat = [], 1000
+    while len(out) < n:
+        chat += 1
+        for k in range(rnd.choice((1, 1, 1, 2, 3))):
+            out.append((chat, f"Напоминание {k + 1} для {chat}"))
+    return out[:n]
+
+
+async def _sequential(url: str, messages) -> float:
+    """Как раньше в reminder_worker: клиент на каждое сообщение, по одному."""
+    t0 = time.monotonic()
+    for chat_id, text in messages:
+        async with httpx.AsyncClient(timeout=15.0) as client:
+            await client.post(f"{url}/bot{TOKEN}/sendMessage", json={"chat_id": chat_id, "text": text})
+    return time.monotonic() - t0
+
+
+def _order_ok(messages, accepted) -> bool:
+    expected, got = {}, {}
+    for chat_id, text in messages:
+        expected.setdefault(chat_id, []).append(text)
+    for chat_id, text in accepted:
+        got.setdefault(chat_id, []).append(text)
+    return expected == got
+
+
+async def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--messages", type=int, default=600)
+    ap.add_argument("--baseline", type=int, default=60, help="сообщений для прежней схемы")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--latency-ms", type=float, nargs=2, default=(20, 80), metavar=("MIN", "MAX"))
+    args = ap.parse_args()
+    latency = tuple(args.latency_ms)
+    ok = True
+
+    fake = FakeTelegram(latency_ms=latency)
+    url = await fake.start()
+    base = _messages(args.baseline, seed=2)
+    elapsed = await _sequential(url, base)
+    print(f"по очереди, клиент на сообщение: {len(base)} за {elapsed:.2f} с ({len(base) / elapsed:.1f} сообщ./с), "
+          f"соединений {fake.connections}, 429: {fake.throttled}")
+    await fake.close()
+
+    fake = FakeTelegram(latency_ms=latency)
+    url = await fake.start()
+    messages = _messages(args.messages)
+    delivery = TelegramDelivery(TOKEN, api_url=url, concurrency=args.concurrency)
+    report = await delivery.send_many(messages)
+    await delivery.close()
+    order = _order_ok(messages, fake.accepted)
+    ok &= report.sent == len(messages) and order
+    print(f"пул x{args.concurrency}, общий клиент: {report.sent}/{len(messages)} за {report.elapsed:.2f} с "
+          f"({report.per_second:.1f} сообщ./с), соединений {fake.connections}, 429: {fake.throttled}, "
+          f"порядок в чатах {'сохранён' if order else 'НАРУШЕН'}")
+    await fake.close()
+
+    fake = FakeTelegram(latency_ms=latency, throttle_first=5, retry_after=1)
+    url = await fake.start()
+    messages = _messages(40, seed=3)
+    delivery = TelegramDelivery(TOKEN, api_url=url, concurrency=args.concurrency)
+    report = await delivery.send_many(messages)
+    await delivery.close()
+    ok &= report.sent == len(messages) and report.elapsed >= 1.0
+    print(f"429 с retry_after=1 на первые 5 запросов: {report.sent}/{len(messages)} за {report.elapsed:.2f} с, "
+          f"429: {report.throttled}, повторов: {report.retries}")
+    await fake.close()
+
+    print("OK" if ok else "FAIL")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
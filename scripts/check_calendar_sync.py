@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Проверка инкрементальной выгрузки в Google Календарь (calendar_sync.sync_events) на локальном
+фейковом Calendar API (scripts/fake_google_calendar_server.py) и временной БД.
+
+Сценарии и ожидаемые запросы к API:
+1. первая выгрузка — по POST на каждую привычку, цель и подцель;
+2. повторная выгрузка без изменений — ни одного запроса;
+3. переименована одна цель, удалена другая, добавлена подцель — один PUT, один DELETE, один POST;
+4. добавлена привычка — один POST, удалена первая привычка — один DELETE (время остальных привычек
+   не зависит от их числа и места в списке, см. habit_suggested_time);
+5. событие цели удалено в самом календаре, цель снова изменена — PUT получает 404, событие создаётся заново;
+6. выгрузка целей выключена в настройках — события целей не удаляются, запросов нет.
+В конце события в календаре должны совпасть с calendar_event_map. Код выхода 1 при расхождении.
+
+Запуск из корня проекта:
+  python scripts/check_calendar_sync.py [--habits 3] [--goals 3] [--subgoals 4]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from calendar_sync import CalendarSyncJob, load_calendar_events, sync_events, synced_kinds  # noqa: E402
+from database import Database  # noqa: E402
+from fake_google_calendar_server import FakeCalendar  # noqa: E402
+
+USER_ID = 1001
+TZ = "Europe/Moscow"
+
+
+async def _sync(db: Database, client: httpx.AsyncClient, fake: FakeCalendar, url: str, settings: dict) -> tuple:
+    fake.reset_calls()
+    job = CalendarSyncJob(USER_ID)
+    events = await load_calendar_events(db, USER_ID, settings, date.today().isoformat(), TZ)
+    await sync_events(db, client, "fake-token", USER_ID, events, job, synced_kinds(settings), url=url)
+    return job, dict(fake.calls)
+
+
+async def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--habits", type=int, default=3)
+    ap.add_argument("--goals", type=int, default=3)
+    ap.add_argument("--subgoals", type=int, default=4)
+    args = ap.parse_args()
+
+    failures = []
+
+    def expect(step: str, calls: dict, wanted: dict, job: CalendarSyncJob) -> None:
+        ok = calls == wanted and not job.errors
+        print(f"{'ok' if ok else 'FAIL'}: {step}: запросы {calls or '{}'}, создано {job.created}, "
+              f"обновлено {job.updated}, удалено {job.deleted}, без изменений {job.unchanged}"
+              + (f", ошибки {job.errors}" if job.errors else ""))
+        if not ok:
+            failures.append(f"{step}: ожидалось {wanted}")
+
+    fake = FakeCalendar(latency_ms=(1, 5))
+    url = await fake.start()
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "calendar.db"))
+        await db.init_db()
+        try:
+            async with httpx.AsyncClient() as client:
+                await db.add_user(USER_ID, "cal", "Cal", "")
+                settings = {"sync_habits": True, "sync_goals": True, "sync_subgoals": True}
+                deadline = (date.today() + timedelta(days=30)).isoformat()
+                habits = [await db.add_habit(USER_ID, f"Привычка {i}", "") for i in range(args.habits)]
+                goals = [await db.add_goal(USER_ID, f"Цель {i}", "", deadline, 1) for i in range(args.goals)]
+                mid = await db.add_mission(USER_ID, "Миссия", "", deadline)
+                for i in range(args.subgoals):
+                    await db.add_subgoal(mid, f"Подцель {i}", "")
+                total = args.habits + args.goals + args.subgoals
+
+                job, calls = await _sync(db, client, fake, url, settings)
+                expect("первая выгрузка", calls, {"POST": total}, job)
+                job, calls = await _sync(db, client, fake, url, settings)
+                expect("без изменений", calls, {}, job)
+
+                await db.update_goal(goals[0], "Цель 0 (новое название)", "", deadline, 1)
+                await db.delete_goal(goals[-1])
+                await db.add_subgoal(mid, "Новая подцель", "")
+                job, calls = await _sync(db, client, fake, url, settings)
+                expect("изменение, удаление и добавление", calls, {"PUT": 1, "DELETE": 1, "POST": 1}, job)
+
+                await db.add_habit(USER_ID, "Новая привычка", "")
+                job, calls = await _sync(db, client, fake, url, settings)
+                expect("добавлена привычка", calls, {"POST": 1}, job)
+                await db.delete_habit(habits[0])
+                job, calls = await _sync(db, client, fake, url, settings)
+                expect("удалена привычка", calls, {"DELETE": 1}, job)
+
+                event_id, _ = (await db.get_calendar_event_map(USER_ID))[("goal", goals[0])]
+                fake.remove(event_id)
+                await db.update_goal(goals[0], "Цель 0 (ещё раз)", "", deadline, 1)
+                job, calls = await _sync(db, client, fake, url, settings)
+                expect("событие удалено в календаре", calls, {"PUT": 1, "POST": 1}, job)
+
+                job, calls = await _sync(db, client, fake, url, {**settings, "sync_goals": False})
+                expect("выгрузка целей выключена", calls, {}, job)
+
+                mapped = {event_id for event_id, _ in (await db.get_calendar_event_map(USER_ID)).values()}
+                if mapped != set(fake.events):
+                    failures.append("calendar_event_map не совпадает с событиями календаря")
+                print(f"событий в календаре: {len(fake.events)}, в calendar_event_map: {len(mapped)}")
+        finally:
+            await db.close()
+            await fake.close()
+    for failure in failures:
+        print("FAIL: " + failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Регрессионная проверка планов запросов: ни один «горячий» запрос не должен
+делать полный проход по таблице (SCAN).
+
+Создаёт временную БД через Database.init_db(), вызывает методы Database, которые
+срабатывают на каждом открытии мини-приложения и на каждом тике воркера напоминаний,
+перехватывает реально выполненный SQL (trace callback на соединениях пула) и для
+каждого запроса смотрит EXPLAIN QUERY PLAN. Код выхода 1, если найден SCAN.
+
+Запуск из корня проекта:
+  python scripts/check_query_plans.py [-v]
+"""
+import asyncio
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database  # noqa: E402
+
+USER_ID = 1001
+
+# Полный проход допустим только по служебным «таблицам» SQLite и константам
+_ALLOWED_SCAN = re.compile(r"^SCAN ((\d+ )?CONSTANT ROW|json_each|pragma_)", re.IGNORECASE)
+_QUERY_START = re.compile(r"^\s*(SELECT|WITH|UPDATE|DELETE|INSERT|REPLACE)\b", re.IGNORECASE)
+_CTE_NAME = re.compile(r"(?:\bWITH|,)\s*(\w+)\s+AS\s*\(", re.IGNORECASE)
+
+
+def _derived_names(sql: str) -> set:
+    """Имена CTE и их алиасов: проход по уже отфильтрованному промежуточному результату — не SCAN таблицы."""
+    names = {n.lower() for n in _CTE_NAME.findall(sql)}
+    for cte in list(names):
+        for alias in re.findall(rf"\b(?:FROM|JOIN)\s+{cte}\s+(?:AS\s+)?(\w+)", sql, re.IGNORECASE):
+            names.add(alias.lower())
+    return names
+
+
+def _is_table_scan(line: str, derived: set) -> bool:
+    if not line.upper().startswith("SCAN ") or _ALLOWED_SCAN.match(line):
+        return False
+    target = line.split()[1]
+    return not (target.startswith("(subquery-") or target.lower() in derived)
+
+
+async def _exercise(db: Database) -> None:
+    """Хот-пас: то, что дергают loadAll() мини-приложения, increment и тик воркера."""
+    today = date.today().isoformat()
+    await db.add_user(USER_ID, "plan", "Plan", "")
+    hid = await db.add_habit(USER_ID, "Пить воду", "")
+    await db.increment_habit_count(hid)
+    await db.decrement_habit_count(hid)
+    await db.increment_habit_count(hid, (date.today() - timedelta(days=1)).isoformat())
+    mid = await db.add_mission(USER_ID, "Миссия", "", today)
+    await db.add_subgoal(mid, "Подцель", "")
+    await db.add_goal(USER_ID, "Цель", "", today, 1)
+    await db.log_reminder_sent(USER_ID, "habit_first", habit_id=hid)
+
+    await db.get_user(USER_ID)
+    await db.get_missions(USER_ID, include_completed=True)
+    await db.get_goals(USER_ID, include_completed=True)
+    await db.get_habits(USER_ID, active_only=False)
+    await db.get_habits_enriched(USER_ID)
+    await db.get_subgoals(mid)
+    await db.get_subgoals_for_missions([mid, mid + 1])
+    await db.get_habit_streak_for_habit(hid)
+    await db.get_habit_skip_streak(hid)
+    await db.get_habit_total_completions(hid)
+    await db.get_habit_last_7_days(USER_ID)
+    await db.get_habit_calendar_month(USER_ID, date.today().year, date.today().month)
+    await db.get_habit_completions_by_date(USER_ID, days=30)
+    await db.get_habit_streak(USER_ID)
+    await db.get_user_analytics(USER_ID, days=30)
+    await db.get_weight_history(USER_ID, period="month")
+    await db.get_user_achievements(USER_ID)
+    await db.get_time_capsule(USER_ID)
+    await db.get_time_capsule_history(USER_ID)
+    await db.get_shaolen_requests_today(USER_ID)
+    await db.get_shaolen_history(USER_ID)
+    await db.get_todays_habit_titles(USER_ID)
+    await db.get_google_fit_tokens(USER_ID)
+    await db.save_steps_daily(USER_ID, {today: 1234})
+    await db.get_steps_daily(USER_ID, today, today)
+    await db.get_steps_daily(USER_ID, (date.today() - timedelta(days=30)).isoformat())
+    await db.get_calendar_sync_settings(USER_ID)
+    await db.get_calendar_event_map(USER_ID)
+
+    await db.get_user_reminder_settings(USER_ID)
+    await db.get_habits_not_done_today(USER_ID)
+    await db.get_habit_reminder_enabled(hid)
+    await db.get_habit_avg_completion_time(hid, days=30)
+    await db.get_habit_minutes(user_ids=[USER_ID])
+    await db.was_reminder_sent_today(USER_ID, hid, "habit_first")
+    await db.was_reminder_sent_today(USER_ID, None, "goal_daily")
+    await db.was_reminder_sent_today_mission(USER_ID, mid, "mission_deadline_7")
+    await db.replace_reminder_schedule(
+        [(USER_ID, hid, None, "habit_first", f"{today} 07:00:00")], user_ids=[USER_ID]
+    )
+    await db.drop_habit_reminders([hid])
+    await db.next_reminder_due_at()
+    await db.pop_due_reminders(f"{today} 08:00:00", limit=10)
+    await db.pop_due_reminders(f"{today} 08:00:00", limit=10, shard=(2, [1]))
+    await db.set_user_timezone(USER_ID, "Asia/Novosibirsk")
+    await db.get_user_timezones([USER_ID])
+    await db.heartbeat_reminder_shard(0, 2, "plan")
+    await db.get_reminder_shard_leases(2)
+    claims = await db.claim_reminders([(USER_ID, "habit_second", hid, None), (USER_ID, "goal_daily", None, None)])
+    await db.claim_reminders([(USER_ID, "habit_second", hid, None, today)])
+    await db.release_reminder_claims([c for c in claims if c])
+    # Ежесуточное обслуживание (maintenance.py)
+    await db.claim_reminders([(USER_ID, "goal_daily", None, None)])
+    await db.rollup_reminder_sent_log((date.today() + timedelta(days=1)).isoformat())
+    await db.get_shaolen_history_before(today)
+    await db.delete_shaolen_history([1, 2])
+    await db.delete_rows_before("analytics", today)
+    await db.delete_rows_before("shaolen_daily_requests", today)
+
+
+def _plan(conn: sqlite3.Connection, sql: str):
+    try:
+        return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+    except sqlite3.Error as e:
+        return [f"(EXPLAIN не выполнен: {e})"]
+
+
+async def main() -> int:
+    verbose = "-v" in sys.argv[1:]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "plans.db")
+        db = Database(path)
+        await db.init_db()
+        traced = []
+        for conn in [db._writer, *db._reader_conns]:
+            await conn.set_trace_callback(traced.append)
+        await _exercise(db)
+        await db.close()
+
+        queries = []
+        for sql in traced:
+            if _QUERY_START.match(sql) and sql not in queries:
+                queries.append(sql)
+
+        conn = sqlite3.connect(path)
+        failures = 0
+        for sql in queries:
+            plan = _plan(conn, sql)
+            derived = _derived_names(sql)
+            scans = [p for p in plan if _is_table_scan(p, derived)]
+            if scans:
+                failures += 1
+            if scans or verbose:
+                print(("FULL SCAN" if scans else "ok") + ": " + " ".join(sql.split())[:160])
+                for p in plan:
+                    print("    " + p)
+        conn.close()
+    print(f"{datetime.now():%H:%M:%S} проверено запросов: {len(queries)}, с полным проходом: {failures}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
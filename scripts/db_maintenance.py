@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Обслуживание БД по срокам хранения (maintenance.run_maintenance):
+сворачивает старый reminder_sent_log в reminder_sent_daily, выгружает старую
+shaolen_history в сжатый архив, чистит analytics и shaolen_daily_requests,
+возвращает место на диск и печатает, сколько байт освобождено.
+
+Сроки задаются переменными RETENTION_*_DAYS (см. maintenance.RetentionSettings);
+ключи ниже переопределяют их для одного запуска. Воркер напоминаний выполняет то же
+раз в сутки в MAINTENANCE_HOUR.
+
+Запуск из корня проекта:
+  python scripts/db_maintenance.py
+  python scripts/db_maintenance.py --full-vacuum   # один раз для старой БД: перевести в auto_vacuum=INCREMENTAL
+
+--full-vacuum переписывает весь файл и держит блокировку записи — запускать при остановленных
+бот, веб-приложении и воркере или в тихое время.
+Требует: DB_PATH в .env или переменных окружения.
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+from dotenv import load_dotenv
+
+# Добавляем родительскую директорию в путь для импортов
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database  # noqa: E402
+from maintenance import RetentionSettings, run_maintenance  # noqa: E402
+
+load_dotenv()
+
+DB_PATH = os.getenv("DB_PATH", "goals_bot.db")
+
+
+async def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--full-vacuum", action="store_true", help="полный VACUUM с переводом в auto_vacuum=INCREMENTAL")
+    ap.add_argument("--reminder-log-days", type=int, help="срок reminder_sent_log (0 — хранить всё)")
+    ap.add_argument("--shaolen-history-days", type=int, help="срок shaolen_history (0 — хранить всё)")
+    ap.add_argument("--analytics-days", type=int, help="срок analytics (0 — хранить всё)")
+    ap.add_argument("--archive-dir", help="папка архива shaolen_history")
+    args = ap.parse_args()
+
+    settings = RetentionSettings.from_env()
+    for name in ("reminder_log_days", "shaolen_history_days", "analytics_days", "archive_dir"):
+        if getattr(args, name) is not None:
+            setattr(settings, name, getattr(args, name))
+
+    print(f"База: {DB_PATH}")
+    db = Database(DB_PATH)
+    await db.open()
+    try:
+        await db.init_db()
+        report = await run_maintenance(db, settings, full_vacuum=args.full_vacuum)
+    finally:
+        await db.close()
+    print(f"reminder_sent_log свёрнуто в reminder_sent_daily: {report.reminder_log_rolled_up}")
+    print(f"shaolen_history в архив: {report.shaolen_archived}" + (f" → {report.archive_path}" if report.archive_path else ""))
+    print(f"analytics удалено: {report.analytics_deleted}")
+    print(f"shaolen_daily_requests удалено: {report.shaolen_requests_deleted}")
+    print(
+        f"Размер файлов БД: {report.bytes_before} → {report.bytes_after} байт "
+        f"(освобождено {report.reclaimed_bytes} байт)"
+    )
+    if report.auto_vacuum != 2:
+        print(
+            f"auto_vacuum не INCREMENTAL: {report.free_bytes_after} байт свободных страниц остаются в файле "
+            "до запуска с --full-vacuum"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Локальный фейковый Google Calendar API (события основного календаря) для проверки выгрузки
+в календарь без настоящего аккаунта Google.
+
+Поддерживает то, чем пользуется calendar_sync.py, под путём /calendar/v3/calendars/primary/events:
+POST (создать, в ответе id), GET (список), PUT/PATCH /<id> (перезаписать/дополнить), DELETE /<id>.
+Как настоящий API: без заголовка Authorization — 401, неизвестный id — 404, уже удалённое
+событие — 410. Отвечает с задержкой --latency-ms, --fail-first первых запросов получают 503.
+Считает запросы по методам.
+
+Запуск из корня проекта:
+  python scripts/fake_google_calendar_server.py --port 8082
+  GOOGLE_CALENDAR_EVENTS_URL=http://127.0.0.1:8082/calendar/v3/calendars/primary/events python webapp_server.py
+"""
+import argparse
+import asyncio
+import json
+import random
+import uuid
+from collections import Counter
+from typing import Dict, Optional, Set, Tuple
+
+EVENTS_PATH = "/calendar/v3/calendars/primary/events"
+
+
+class FakeCalendar:
+    """Фейковые события основного календаря. Используется и как модуль (scripts/check_calendar_sync.py)."""
+
+    def __init__(self, latency_ms: Tuple[float, float] = (20, 80), fail_first: int = 0):
+        self.latency_ms = latency_ms
+        self.fail_first = fail_first  # первые N запросов — 503
+        self.events: Dict[str, dict] = {}
+        self.deleted: Set[str] = set()
+        self.calls: Counter = Counter()  # метод → число запросов
+        self.requests = 0
+        self.connections = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def remove(self, event_id: str) -> None:
+        """Удалить событие «в самом календаре» — как пользователь в интерфейсе Google."""
+        self.events.pop(event_id, None)
+        self.deleted.add(event_id)
+
+    def reset_calls(self) -> None:
+        self.calls.clear()
+
+    async def _handle(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> Tuple[int, Optional[dict]]:
+        self.requests += 1
+        self.calls[method] += 1
+        if self.requests <= self.fail_first:
+            return 503, {"error": {"code": 503, "message": "Backend Error"}}
+        if not headers.get("authorization", "").startswith("Bearer "):
+            return 401, {"error": {"code": 401, "message": "Login Required"}}
+        path = path.split("?", 1)[0].rstrip("/")
+        if not path.startswith(EVENTS_PATH):
+            return 404, {"error": {"code": 404, "message": "Not Found"}}
+        event_id = path[len(EVENTS_PATH):].lstrip("/")
+        await asyncio.sleep(random.uniform(*self.latency_ms) / 1000)
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            return 400, {"error": {"code": 400, "message": "Parse Error"}}
+        if not event_id:
+            if method == "GET":
+                return 200, {"kind": "calendar#events", "items": list(self.events.values())}
+            if method == "POST":
+                if not payload.get("start") or not payload.get("end"):
+                    return 400, {"error": {"code": 400, "message": "Missing time"}}
+                event_id = uuid.uuid4().hex
+                self.events[event_id] = {**payload, "id": event_id}
+                return 200, self.events[event_id]
+            return 405, {"error": {"code": 405, "message": "Method Not Allowed"}}
+        if event_id not in self.events:
+            code = 410 if event_id in self.deleted else 404
+            return code, {"error": {"code": code, "message": "Deleted" if code == 410 else "Not Found"}}
+        if method == "GET":
+            return 200, self.events[event_id]
+        if method == "PUT":
+            self.events[event_id] = {**payload, "id": event_id}
+            return 200, self.events[event_id]
+        if method == "PATCH":
+            self.events[event_id].update(payload)
+            return 200, self.events[event_id]
+        if method == "DELETE":
+            self.remove(event_id)
+            return 204, None
+        return 405, {"error": {"code": 405, "message": "Method Not Allowed"}}
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                status, payload = await self._handle(method, path, headers, body)
+                data = json.dumps(payload).encode() if payload is not None else b""
+                reason = {
+                    200: "OK", 204: "No Content", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+                    405: "Method Not Allowed", 410: "Gone", 503: "Service Unavailable",
+                }[status]
+                writer.write(
+                    f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запустить сервер; возвращает URL для GOOGLE_CALENDAR_EVENTS_URL."""
+        self._server = await asyncio.start_server(self._serve, host, port)
+        port = self._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}{EVENTS_PATH}"
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+
+async def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8082)
+    ap.add_argument("--latency-ms", type=float, nargs=2, default=(20, 80), metavar=("MIN", "MAX"))
+    ap.add_argument("--fail-first", type=int, default=0)
+    args = ap.parse_args()
+    fake = FakeCalendar(tuple(args.latency_ms), args.fail_first)
+    url = await fake.start(args.host, args.port)
+    print(f"Фейковый Google Calendar API: {url} (Ctrl+C — остановить)")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(f"событий {len(fake.events)}, запросов {dict(fake.calls)}, соединений: {fake.connections}")
+    finally:
+        await fake.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Локальный фейковый Telegram Bot API для проверки отправки напоминаний без настоящего бота.
+
+Принимает POST /bot<token>/sendMessage (HTTP/1.1, keep-alive), отвечает с задержкой
+--latency-ms и, как настоящий API, возвращает 429 с parameters.retry_after, если бот
+превышает общий лимит (--global-rate сообщений за скользящую секунду) или пишет в один
+чат чаще --chat-interval секунд. Считает принятые сообщения и ответы 429.
+
+Запуск из корня проекта:
+  python scripts/fake_telegram_server.py --port 8081
+  TELEGRAM_API_URL=http://127.0.0.1:8081 python reminder_worker.py
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+
+class FakeTelegram:
+    """Фейковый sendMessage с лимитами Telegram. Используется и как модуль (scripts/bench_telegram_delivery.py)."""
+
+    def __init__(
+        self,
+        global_rate: int = 30,
+        chat_interval: float = 1.0,
+        latency_ms: Tuple[float, float] = (20, 80),
+        retry_after: int = 1,
+        throttle_first: int = 0,
+    ):
+        self.global_rate = global_rate
+        self.chat_interval = chat_interval
+        self.latency_ms = latency_ms
+        self.retry_after = retry_after
+        self.throttle_first = throttle_first  # первые N запросов — принудительно 429
+        self.accepted: List[Tuple[int, str]] = []
+        self.throttled = 0
+        self.requests = 0
+        self.connections = 0
+        self._window: deque = deque()
+        self._chat_last: Dict[int, float] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def _check_limits(self, chat_id: int) -> bool:
+        now = time.monotonic()
+        while self._window and now - self._window[0] >= 1.0:
+            self._window.popleft()
+        if self.requests <= self.throttle_first or len(self._window) >= self.global_rate:
+            return False
+        if now - self._chat_last.get(chat_id, -1e9) < self.chat_interval:
+            return False
+        self._window.append(now)
+        self._chat_last[chat_id] = now
+        return True
+
+    async def _handle_send(self, body: bytes) -> Tuple[int, dict]:
+        self.requests += 1
+        try:
+            payload = json.loads(body or b"{}")
+            chat_id = int(payload["chat_id"])
+            text = str(payload.get("text") or "")
+        except (ValueError, KeyError, TypeError):
+            return 400, {"ok": False, "error_code": 400, "description": "Bad Request: chat_id is empty"}
+        if not self._check_limits(chat_id):
+            self.throttled += 1
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        await asyncio.sleep(random.uniform(*self.latency_ms) / 1000)
+        self.accepted.append((chat_id, text))
+        return 200, {"ok": True, "result": {"message_id": len(self.accepted), "chat": {"id": chat_id}, "text": text}}
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                if method == "POST" and path.endswith("/sendMessage"):
+                    status, payload = await self._handle_send(body)
+                else:
+                    status, payload = 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+                data = json.dumps(payload).encode()
+                reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests"}[status]
+                writer.write(
+                    f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запустить сервер; возвращает базовый URL для TELEGRAM_API_URL."""
+        self._server = await asyncio.start_server(self._serve, host, port)
+        port = self._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+
+async def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--global-rate", type=int, default=30)
+    ap.add_argument("--chat-interval", type=float, default=1.0)
+    ap.add_argument("--latency-ms", type=float, nargs=2, default=(20, 80), metavar=("MIN", "MAX"))
+    args = ap.parse_args()
+    fake = FakeTelegram(args.global_rate, args.chat_interval, tuple(args.latency_ms))
+    url = await fake.start(args.host, args.port)
+    print(f"Фейковый Telegram Bot API: {url} (Ctrl+C — остановить)")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(f"принято {len(fake.accepted)}, 429: {fake.throttled}, соединений: {fake.connections}")
+    finally:
+        await fake.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
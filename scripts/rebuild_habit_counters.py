@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Проверка и пересборка счётчиков привычек в таблице habits
+(total_completions, current_streak, longest_streak, last_done_date)
+по фактическим записям habit_records.
+
+Счётчики обновляются при каждой отметке привычки; скрипт нужен после ручных
+правок БД или импорта данных, а также для периодической сверки.
+
+Запуск из корня проекта:
+  python scripts/rebuild_habit_counters.py           # только показать расхождения
+  python scripts/rebuild_habit_counters.py --fix     # исправить
+
+Код выхода 1, если найдены расхождения и не передан --fix.
+Требует: DB_PATH в .env или переменных окружения.
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+from dotenv import load_dotenv
+
+# Добавляем родительскую директорию в путь для импортов
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database  # noqa: E402
+
+load_dotenv()
+
+DB_PATH = os.getenv("DB_PATH", "goals_bot.db")
+
+
+async def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--fix", action="store_true", help="записать пересчитанные значения")
+    args = ap.parse_args()
+
+    print(f"База: {DB_PATH}")
+    db = Database(DB_PATH)
+    try:
+        await db.init_db()
+        mismatches = await db.check_habit_counters(fix=args.fix)
+    finally:
+        await db.close()
+
+    for m in mismatches:
+        print(f"  habit {m['habit_id']}: {m['field']} = {m['stored']!r}, ожидается {m['expected']!r}")
+    habits = len({m["habit_id"] for m in mismatches})
+    if not mismatches:
+        print("Счётчики совпадают с habit_records.")
+    elif args.fix:
+        print(f"Исправлено привычек: {habits}")
+    else:
+        print(f"Привычек с расхождениями: {habits}. Запустите с --fix, чтобы исправить.")
+    return 1 if mismatches and not args.fix else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
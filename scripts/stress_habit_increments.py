@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Стресс-тест счётчика привычки: тысячи параллельных increment/decrement
+из нескольких процессов (как бот, веб-сервер и воркер на одной БД) и из
+нескольких пулов соединений внутри каждого процесса.
+
+В конце сверяет итоговый count с числом сделанных нажатий и счётчики
+в habits (total_completions, серии) с пересчётом по habit_records.
+Код выхода 1 при расхождении.
+
+Запуск из корня проекта:
+  python scripts/stress_habit_increments.py --processes 4 --instances 3 --ops 1000
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database  # noqa: E402
+
+USER_ID = 777
+
+
+async def _worker(path: str, habit_id: int, instances: int, ops: int, seed: int) -> int:
+    """Выполнить ops increment (delta 1..5) и ещё ~10% decrement через instances независимых пулов.
+    Возвращает чистое изменение count, которое должно получиться."""
+    rnd = random.Random(seed)
+    dbs = [Database(path) for _ in range(instances)]
+    for db in dbs:
+        await db.open()
+    plan = []
+    for _ in range(ops):
+        delta = rnd.choice((1, 1, 1, 2, 5))
+        plan.append(("inc", delta))
+    for i in range(0, ops, 10):
+        plan.insert(i, ("dec", 1))
+
+    async def one(i: int, op: str, delta: int) -> int:
+        db = dbs[i % instances]
+        if op == "inc":
+            await db.increment_habit_count(habit_id, delta=delta)
+            return delta
+        await db.decrement_habit_count(habit_id, delta=delta)
+        return -delta
+
+    results = await asyncio.gather(*(one(i, op, d) for i, (op, d) in enumerate(plan)))
+    for db in dbs:
+        await db.close()
+    return sum(results)
+
+
+def _run_worker(args) -> int:
+    logging.disable(logging.WARNING)
+    return asyncio.run(_worker(*args))
+
+
+async def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--processes", type=int, default=4)
+    ap.add_argument("--instances", type=int, default=3, help="пулов Database на процесс")
+    ap.add_argument("--ops", type=int, default=1000, help="операций на процесс")
+    args = ap.parse_args()
+    logging.disable(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "stress.db")
+        db = Database(path)
+        await db.init_db()
+        await db.add_user(USER_ID, "stress", "Stress", "")
+        habit_id = await db.add_habit(USER_ID, "Отжимания", "")
+        # Запас, чтобы decrement никогда не упирался в 0 и итог был детерминирован
+        start = await db.increment_habit_count(habit_id, delta=args.processes * args.ops)
+        await db.close()
+
+        t0 = time.perf_counter()
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(args.processes) as pool:
+            deltas = pool.map(
+                _run_worker,
+                [(path, habit_id, args.instances, args.ops, seed) for seed in range(args.processes)],
+            )
+        elapsed = time.perf_counter() - t0
+
+        db = Database(path)
+        await db.open()
+        today = date.today().isoformat()
+        async with db._read() as conn:
+            async with conn.execute(
+                "SELECT count FROM habit_records WHERE habit_id = ? AND date = ?", (habit_id, today)
+            ) as c:
+                final = (await c.fetchone())[0]
+        mismatches = await db.check_habit_counters()
+        await db.close()
+
+    total_ops = args.processes * (args.ops + (args.ops + 9) // 10)
+    expected = start + sum(deltas)
+    print(
+        f"processes={args.processes} instances={args.instances} ops≈{total_ops} "
+        f"за {elapsed:.2f} с ({total_ops / elapsed:.0f} оп/с)"
+    )
+    print(f"count: ожидалось {expected}, в БД {final}")
+    for m in mismatches:
+        print(f"  счётчик habit {m['habit_id']}: {m['field']} = {m['stored']!r}, ожидается {m['expected']!r}")
+    ok = final == expected and not mismatches
+    print("OK" if ok else "FAIL")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
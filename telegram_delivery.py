@@ -0,0 +1,211 @@
+"""
+Отправка сообщений через Telegram Bot API пачками (воркер напоминаний).
+
+Один общий httpx-клиент на процесс (keep-alive; HTTP/2, если установлен пакет h2),
+ограниченный пул корутин, token bucket на общий лимит бота (~30 сообщений/с),
+интервал между сообщениями в один чат и повтор после 429 с учётом retry_after.
+Адрес API переопределяется TELEGRAM_API_URL — например, на локальный фейковый
+сервер scripts/fake_telegram_server.py.
+"""
+import asyncio
+import heapq
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import httpx
+
+from http_clients import HTTP2_AVAILABLE
+
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+SEND_CONCURRENCY = int(os.getenv("TELEGRAM_SEND_CONCURRENCY", "8"))
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))  # сообщений в секунду на бота
+CHAT_INTERVAL_SEC = float(os.getenv("TELEGRAM_CHAT_INTERVAL_SEC", "1.0"))  # между сообщениями в один чат
+MAX_ATTEMPTS = 5  # попыток на сообщение (429, 5xx, запрос не ушёл: нет соединения)
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity подряд.
+    pause(seconds) останавливает выдачу — так соблюдается retry_after из ответа 429."""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            self._tokens = 0.0
+            self._updated = until
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+@dataclass
+class DeliveryReport:
+    """Итог одной пачки: results[i] — доставлено ли i-е сообщение; uncertain — индексы недоставленных,
+    которые Telegram мог всё же принять (таймаут чтения и т. п.): их нельзя отправлять повторно."""
+    results: List[bool] = field(default_factory=list)
+    uncertain: Set[int] = field(default_factory=set)
+    sent: int = 0
+    failed: int = 0
+    throttled: int = 0  # ответов 429
+    retries: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def per_second(self) -> float:
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+
+def _retry_after(response: httpx.Response) -> float:
+    try:
+        return float(response.json().get("parameters", {}).get("retry_after", 1))
+    except (ValueError, AttributeError):
+        return 1.0
+
+
+class TelegramDelivery:
+    """Отправка sendMessage с общим клиентом и лимитами. Создаётся один раз на процесс, закрывается close()."""
+
+    def __init__(
+        self,
+        token: str,
+        api_url: str = TELEGRAM_API_URL,
+        concurrency: int = SEND_CONCURRENCY,
+        global_rate: float = GLOBAL_RATE,
+        chat_interval: float = CHAT_INTERVAL_SEC,
+        timeout: float = 15.0,
+    ):
+        self._url = f"{api_url.rstrip('/')}/bot{token}/sendMessage"
+        self.concurrency = max(1, concurrency)
+        self.chat_interval = chat_interval
+        self._bucket = TokenBucket(global_rate)
+        self._chat_next: Dict[int, float] = {}  # chat_id → monotonic-время, раньше которого в чат не пишем
+        self._client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+        )
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+    async def _send(self, chat_id: int, text: str, report: DeliveryReport) -> Optional[bool]:
+        """True — доставлено, False — не доставлено, None — неизвестно (запрос ушёл, ответа нет)."""
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            if attempt > 1:
+                report.retries += 1
+            await self._bucket.acquire()
+            try:
+                r = await self._client.post(self._url, json={"chat_id": chat_id, "text": text})
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                # Запрос не ушёл (нет соединения) — повторить безопасно
+                logger.warning("Telegram sendMessage chat %s: %s", chat_id, e)
+                await asyncio.sleep(attempt)
+                continue
+            except httpx.HTTPError as e:
+                # Запрос мог дойти (таймаут чтения, обрыв после отправки) — не повторяем, чтобы не отправить дважды
+                logger.warning("Telegram sendMessage chat %s: %s, без повтора", chat_id, e)
+                return None
+            if r.status_code == 200:
+                return True
+            if r.status_code == 429:
+                # Flood control действует на весь бот — приостанавливаем все отправки
+                report.throttled += 1
+                self._bucket.pause(_retry_after(r))
+                continue
+            if r.status_code >= 500:
+                await asyncio.sleep(attempt)
+                continue
+            logger.warning("Telegram sendMessage %s: %s", r.status_code, r.text)
+            return False
+        return False
+
+    async def send_many(
+        self,
+        messages: Sequence[Tuple[int, str]],
+        on_sent: Optional[Callable[[int], Awaitable[None]]] = None,
+    ) -> DeliveryReport:
+        """
+        Отправить сообщения [(chat_id, text)] пулом из concurrency корутин. Сообщения в один чат
+        уходят по порядку с интервалом chat_interval; пока чат ждёт, корутина берёт другой.
+        on_sent(i) вызывается сразу после доставки i-го сообщения.
+        """
+        report = DeliveryReport(results=[False] * len(messages))
+        by_chat: Dict[int, List[int]] = {}
+        for i, (chat_id, _) in enumerate(messages):
+            by_chat.setdefault(chat_id, []).append(i)
+        # Куча (когда можно писать в чат, порядковый номер, chat_id, оставшиеся индексы сообщений)
+        ready = [
+            (self._chat_next.get(chat_id, 0.0), n, chat_id, indexes)
+            for n, (chat_id, indexes) in enumerate(by_chat.items())
+        ]
+        heapq.heapify(ready)
+        seq = len(ready)
+        in_flight = 0
+        changed = asyncio.Event()
+
+        async def worker() -> None:
+            nonlocal seq, in_flight
+            while ready or in_flight:
+                if not ready:
+                    # Очередь пуста, но другие корутины ещё могут вернуть в неё чат
+                    changed.clear()
+                    await changed.wait()
+                    continue
+                at, _, chat_id, indexes = heapq.heappop(ready)
+                in_flight += 1
+                try:
+                    delay = at - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    i = indexes[0]
+                    ok = await self._send(chat_id, messages[i][1], report)
+                    self._chat_next[chat_id] = time.monotonic() + self.chat_interval
+                    if len(indexes) > 1:
+                        heapq.heappush(ready, (self._chat_next[chat_id], seq, chat_id, indexes[1:]))
+                        seq += 1
+                    report.results[i] = bool(ok)
+                    if ok is None:
+                        report.uncertain.add(i)
+                    if ok:
+                        report.sent += 1
+                        if on_sent is not None:
+                            try:
+                                await on_sent(i)
+                            except Exception as e:
+                                logger.exception("on_sent chat %s: %s", chat_id, e)
+                    else:
+                        report.failed += 1
+                finally:
+                    in_flight -= 1
+                    changed.set()
+
+        t0 = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(by_chat)))))
+        report.elapsed = time.monotonic() - t0
+        now = time.monotonic()
+        self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+        return report
@@ -0,0 +1,116 @@
+"""
+Часовые пояса пользователей для напоминаний.
+
+Пояс хранится в users.timezone (имя IANA, например Asia/Novosibirsk). Если пользователь не задал
+его явно, пояс выводится из города и кода страны профиля: сначала по таблице крупных городов
+стран с несколькими поясами, затем по основному поясу страны. NULL — DEFAULT_TIMEZONE.
+"""
+import os
+from datetime import timedelta, timezone, tzinfo
+from functools import lru_cache
+from typing import Optional
+
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:
+    ZoneInfo = None
+    ZoneInfoNotFoundError = Exception
+
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Europe/Moscow").strip() or "Europe/Moscow"
+
+# Основной пояс страны (ISO 3166-1 alpha-2). Для стран с несколькими поясами — пояс столицы,
+# уточняется по CITY_TIMEZONES
+COUNTRY_TIMEZONES = {
+    "RU": "Europe/Moscow", "BY": "Europe/Minsk", "UA": "Europe/Kyiv", "KZ": "Asia/Almaty",
+    "UZ": "Asia/Tashkent", "KG": "Asia/Bishkek", "TJ": "Asia/Dushanbe", "TM": "Asia/Ashgabat",
+    "AM": "Asia/Yerevan", "GE": "Asia/Tbilisi", "AZ": "Asia/Baku", "MD": "Europe/Chisinau",
+    "LV": "Europe/Riga", "LT": "Europe/Vilnius", "EE": "Europe/Tallinn", "FI": "Europe/Helsinki",
+    "PL": "Europe/Warsaw", "CZ": "Europe/Prague", "SK": "Europe/Bratislava", "HU": "Europe/Budapest",
+    "DE": "Europe/Berlin", "AT": "Europe/Vienna", "CH": "Europe/Zurich", "FR": "Europe/Paris",
+    "BE": "Europe/Brussels", "NL": "Europe/Amsterdam", "LU": "Europe/Luxembourg", "IT": "Europe/Rome",
+    "ES": "Europe/Madrid", "PT": "Europe/Lisbon", "GB": "Europe/London", "IE": "Europe/Dublin",
+    "DK": "Europe/Copenhagen", "NO": "Europe/Oslo", "SE": "Europe/Stockholm", "IS": "Atlantic/Reykjavik",
+    "GR": "Europe/Athens", "CY": "Asia/Nicosia", "BG": "Europe/Sofia", "RO": "Europe/Bucharest",
+    "RS": "Europe/Belgrade", "ME": "Europe/Podgorica", "HR": "Europe/Zagreb", "SI": "Europe/Ljubljana",
+    "TR": "Europe/Istanbul", "IL": "Asia/Jerusalem", "AE": "Asia/Dubai", "QA": "Asia/Qatar",
+    "SA": "Asia/Riyadh", "EG": "Africa/Cairo", "IN": "Asia/Kolkata", "TH": "Asia/Bangkok",
+    "VN": "Asia/Ho_Chi_Minh", "ID": "Asia/Jakarta", "MY": "Asia/Kuala_Lumpur", "SG": "Asia/Singapore",
+    "CN": "Asia/Shanghai", "HK": "Asia/Hong_Kong", "JP": "Asia/Tokyo", "KR": "Asia/Seoul",
+    "MN": "Asia/Ulaanbaatar", "LK": "Asia/Colombo", "US": "America/New_York", "CA": "America/Toronto",
+    "MX": "America/Mexico_City", "BR": "America/Sao_Paulo", "AR": "America/Argentina/Buenos_Aires",
+    "AU": "Australia/Sydney", "NZ": "Pacific/Auckland",
+}
+
+# Города стран с несколькими поясами (название в нижнем регистре, как пишут в профиле)
+CITY_TIMEZONES = {
+    ("RU", "калининград"): "Europe/Kaliningrad", ("RU", "kaliningrad"): "Europe/Kaliningrad",
+    ("RU", "самара"): "Europe/Samara", ("RU", "samara"): "Europe/Samara",
+    ("RU", "ижевск"): "Europe/Samara", ("RU", "ульяновск"): "Europe/Ulyanovsk",
+    ("RU", "саратов"): "Europe/Saratov", ("RU", "астрахань"): "Europe/Astrakhan",
+    ("RU", "волгоград"): "Europe/Volgograd",
+    ("RU", "екатеринбург"): "Asia/Yekaterinburg", ("RU", "yekaterinburg"): "Asia/Yekaterinburg",
+    ("RU", "челябинск"): "Asia/Yekaterinburg", ("RU", "пермь"): "Asia/Yekaterinburg",
+    ("RU", "уфа"): "Asia/Yekaterinburg", ("RU", "тюмень"): "Asia/Yekaterinburg",
+    ("RU", "оренбург"): "Asia/Yekaterinburg", ("RU", "сургут"): "Asia/Yekaterinburg",
+    ("RU", "омск"): "Asia/Omsk", ("RU", "omsk"): "Asia/Omsk",
+    ("RU", "новосибирск"): "Asia/Novosibirsk", ("RU", "novosibirsk"): "Asia/Novosibirsk",
+    ("RU", "томск"): "Asia/Tomsk", ("RU", "барнаул"): "Asia/Barnaul",
+    ("RU", "кемерово"): "Asia/Novokuznetsk", ("RU", "новокузнецк"): "Asia/Novokuznetsk",
+    ("RU", "красноярск"): "Asia/Krasnoyarsk", ("RU", "krasnoyarsk"): "Asia/Krasnoyarsk",
+    ("RU", "иркутск"): "Asia/Irkutsk", ("RU", "irkutsk"): "Asia/Irkutsk",
+    ("RU", "улан-удэ"): "Asia/Irkutsk", ("RU", "чита"): "Asia/Chita",
+    ("RU", "якутск"): "Asia/Yakutsk", ("RU", "yakutsk"): "Asia/Yakutsk",
+    ("RU", "владивосток"): "Asia/Vladivostok", ("RU", "vladivostok"): "Asia/Vladivostok",
+    ("RU", "хабаровск"): "Asia/Vladivostok", ("RU", "khabarovsk"): "Asia/Vladivostok",
+    ("RU", "южно-сахалинск"): "Asia/Sakhalin", ("RU", "магадан"): "Asia/Magadan",
+    ("RU", "петропавловск-камчатский"): "Asia/Kamchatka",
+    ("KZ", "актобе"): "Asia/Aqtobe", ("KZ", "атырау"): "Asia/Atyrau", ("KZ", "актау"): "Asia/Aqtau",
+    ("KZ", "уральск"): "Asia/Oral",
+    ("US", "chicago"): "America/Chicago", ("US", "houston"): "America/Chicago",
+    ("US", "dallas"): "America/Chicago", ("US", "denver"): "America/Denver",
+    ("US", "phoenix"): "America/Phoenix", ("US", "los angeles"): "America/Los_Angeles",
+    ("US", "san francisco"): "America/Los_Angeles", ("US", "seattle"): "America/Los_Angeles",
+    ("US", "лос-анджелес"): "America/Los_Angeles", ("US", "сан-франциско"): "America/Los_Angeles",
+    ("US", "чикаго"): "America/Chicago", ("US", "сиэтл"): "America/Los_Angeles",
+    ("CA", "vancouver"): "America/Vancouver", ("CA", "ванкувер"): "America/Vancouver",
+    ("CA", "calgary"): "America/Edmonton", ("CA", "edmonton"): "America/Edmonton",
+    ("CA", "winnipeg"): "America/Winnipeg",
+    ("AU", "perth"): "Australia/Perth", ("AU", "adelaide"): "Australia/Adelaide",
+    ("AU", "brisbane"): "Australia/Brisbane",
+    ("ID", "bali"): "Asia/Makassar", ("ID", "бали"): "Asia/Makassar", ("ID", "denpasar"): "Asia/Makassar",
+}
+
+
+@lru_cache(maxsize=None)
+def valid_timezone(name: Optional[str]) -> Optional[str]:
+    """Имя пояса IANA, если оно известно системе, иначе None."""
+    name = (name or "").strip()
+    if not name or ZoneInfo is None:
+        return None
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+    return name
+
+
+def infer_timezone(city: Optional[str] = None, country_code: Optional[str] = None) -> Optional[str]:
+    """Пояс по городу и коду страны профиля; None, если вывести нельзя."""
+    code = (country_code or "").strip().upper()
+    name = (city or "").strip().lower().replace("ё", "е")
+    if name:
+        tz = CITY_TIMEZONES.get((code, name))
+        if tz is None and not code:
+            tz = next((z for (_, c), z in CITY_TIMEZONES.items() if c == name), None)
+        if tz:
+            return valid_timezone(tz)
+    return valid_timezone(COUNTRY_TIMEZONES.get(code))
+
+
+@lru_cache(maxsize=None)
+def zone(name: Optional[str] = None) -> tzinfo:
+    """tzinfo пояса пользователя (NULL или неизвестный пояс — DEFAULT_TIMEZONE). Без базы поясов — UTC+3."""
+    name = valid_timezone(name) or valid_timezone(DEFAULT_TIMEZONE)
+    if name is None:
+        return timezone(timedelta(hours=3))
+    return ZoneInfo(name)
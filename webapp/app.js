@@ -1468,7 +1468,8 @@ async function runWaterCalculate(useGeo, city, country, countryCode) {
     }
     renderProfile();
     var createHabit = (typeof confirm !== "undefined") ? confirm("Сформировать привычку «Пить воду» на основе расчёта?") : false;
-    var formulaNote = [city && "город " + city, country && country, temp != null && "темп. " + temp + " °C", humidity != null && "влажность " + humidity + "%", formula].filter(Boolean).join("; ");
+    var stepsNote = res && res.activity_from_steps_days ? "активность по шагам Google Fit: " + res.activity_minutes + " мин/день" : "";
+    var formulaNote = [city && "город " + city, country && country, temp != null && "темп. " + temp + " °C", humidity != null && "влажность " + humidity + "%", stepsNote, formula].filter(Boolean).join("; ");
     if (createHabit) {
       await fetchJSON(state.baseUrl + "/api/user/" + state.userId + "/water-habit", {
         method: "POST",
@@ -1986,27 +1987,24 @@ async function loadAll() {
   }
   
   try {
-    await fetchJSON(base + "/api/user/" + uid + "/ensure-examples", { method: "POST" }).catch(function() {});
     var profileFallback = {
       first_name: (tg && tg.initDataUnsafe && tg.initDataUnsafe.user && tg.initDataUnsafe.user.first_name) || "",
       last_name: (tg && tg.initDataUnsafe && tg.initDataUnsafe.user && tg.initDataUnsafe.user.last_name) || "",
       username: (tg && tg.initDataUnsafe && tg.initDataUnsafe.user && tg.initDataUnsafe.user.username) || "",
       display_name: ""
     };
-    const [achievementCheckRes, missions, goals, habits, analytics, profile, weightHistoryRes, achievementsRes] = await Promise.all([
-      fetchJSON(base + "/api/user/" + uid + "/achievement-check").catch(function() { return {}; }),
-      fetchJSON(base + "/api/user/" + uid + "/missions").catch(e => { if (e && e.status === 401) throw e; console.error("❌ Миссии:", e.message); return []; }),
-      fetchJSON(base + "/api/user/" + uid + "/goals").catch(e => { if (e && e.status === 401) throw e; console.error("❌ Цели:", e.message); return []; }),
-      fetchJSON(base + "/api/user/" + uid + "/habits").catch(e => { if (e && e.status === 401) throw e; console.error("❌ Привычки:", e.message); return []; }),
-      fetchJSON(base + "/api/user/" + uid + "/analytics?period=" + (state.analyticsPeriod || "month")).catch(e => {
-        if (e && e.status === 401) throw e;
-        console.error("❌ Аналитика:", e.message);
-        return { period: "month", missions: { total: 0, completed: 0, avg_progress: 0 }, goals: { total: 0, completed: 0, completion_rate: 0 }, habits: { total: 0, total_completions: 0, streak: 0 }, habit_chart: { labels: [], values: [] } };
-      }),
-      fetchJSON(base + "/api/user/" + uid + "/profile").catch(e => { if (e && e.status === 401) throw e; return profileFallback; }),
-      fetchJSON(base + "/api/user/" + uid + "/weight-history?period=7").catch(function() { return { data: [] }; }),
-      fetchJSON(base + "/api/user/" + uid + "/achievements").catch(function() { return { achievements: [] }; })
-    ]);
+    // Один запрос вместо ~10: примеры, достижения, миссии с подцелями, цели, привычки, аналитика, профиль, вес, капсула
+    const boot = await fetchJSON(
+      base + "/api/user/" + uid + "/bootstrap?analytics_period=" + encodeURIComponent(state.analyticsPeriod || "month") + "&weight_period=7"
+    );
+    const achievementCheckRes = boot.achievement_check || {};
+    const missions = boot.missions;
+    const goals = boot.goals;
+    const habits = boot.habits;
+    const analytics = boot.analytics;
+    const profile = boot.profile;
+    const weightHistoryRes = boot.weight_history;
+    const achievementsRes = boot.achievements;
     
     console.log('✅ Данные получены:');
     console.log('  Миссии:', missions?.length || 0);
@@ -2033,14 +2031,13 @@ async function loadAll() {
     state.cache.achievements = (achievementsRes && achievementsRes.achievements) ? achievementsRes.achievements : [];
 
     state.cache.subgoalsByMission = {};
-    if (missionsList.length) {
-      var subs = await Promise.all(missionsList.map(function(m) {
-        return fetchJSON(base + "/api/mission/" + m.id + "/subgoals").then(function(r) { return Array.isArray(r) ? r : []; }).catch(function() { return []; });
-      }));
-      missionsList.forEach(function(m, i) { state.cache.subgoalsByMission[m.id] = subs[i] || []; });
-    }
+    var subgoalsByMission = boot.subgoals || {};
+    missionsList.forEach(function(m) {
+      var subs = subgoalsByMission[m.id];
+      state.cache.subgoalsByMission[m.id] = Array.isArray(subs) ? subs : [];
+    });
 
-    var capsuleRes = await fetchJSON(base + "/api/user/" + uid + "/time-capsule").catch(function() { return { capsule: null, can_edit: false }; });
+    var capsuleRes = boot.time_capsule || { capsule: null, can_edit: false };
     state.capsule = (capsuleRes && capsuleRes.capsule) || null;
     state.capsuleCanEdit = !!(capsuleRes && capsuleRes.can_edit);
 
@@ -2595,11 +2592,23 @@ function renderSettings() {
     calSyncBtn.disabled = true;
     if (calSyncMsg) calSyncMsg.textContent = "Выгрузка…";
     try {
+      // Выгрузка идёт фоновой задачей: запускаем и опрашиваем статус, пока не завершится
       var r = await fetchJSON(state.baseUrl + "/api/user/" + state.userId + "/calendar-sync", { method: "POST" });
+      while (r && (r.status === "queued" || r.status === "running")) {
+        if (calSyncMsg) calSyncMsg.textContent = r.total ? "Выгрузка… " + r.done + " из " + r.total : "Выгрузка…";
+        await new Promise(function(resolve) { setTimeout(resolve, 1000); });
+        r = await fetchJSON(state.baseUrl + "/api/user/" + state.userId + "/calendar-sync/status");
+      }
+      if (r && r.status === "failed") throw new Error(r.detail || "calendar sync failed");
       var n = r && r.created != null ? r.created : 0;
+      var upd = r && r.updated != null ? r.updated : 0;
+      var del = r && r.deleted != null ? r.deleted : 0;
       var errs = r && r.errors && r.errors.length ? r.errors.join("; ") : "";
       var hint = r && r.hint ? r.hint : "";
-      if (calSyncMsg) calSyncMsg.textContent = errs ? "Создано: " + n + ". Ошибки: " + errs : "Создано событий: " + n;
+      var summary = n + upd + del > 0
+        ? "Создано: " + n + ", обновлено: " + upd + ", удалено: " + del
+        : "Календарь уже актуален";
+      if (calSyncMsg) calSyncMsg.textContent = errs ? summary + ". Ошибки: " + errs : summary;
       if (n > 0 && tg) tg.showAlert("В календарь добавлено " + n + " событий.");
       if (hint && tg) tg.showAlert(hint);
     } catch (e) {
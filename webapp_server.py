@@ -5,12 +5,14 @@ import re
 import json
 import hmac
 import hashlib
+import time
 from urllib.parse import quote, urlencode
 import subprocess
+from collections import OrderedDict
 from contextlib import asynccontextmanager
 from urllib.parse import unquote
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
@@ -20,10 +22,12 @@ import logging
 
 import asyncio
 
-import aiosqlite
-import httpx
-
+from calendar_sync import CalendarSyncJobs, load_calendar_events, sync_events, synced_kinds
+from google_fit import StepsCache, activity_minutes_from_steps
+from google_tokens import GoogleTokenManager
 from database import Database
+from http_clients import HttpClients
+from user_timezones import DEFAULT_TIMEZONE, infer_timezone, valid_timezone, zone as user_zone
 
 try:
     from groq import Groq
@@ -39,6 +43,10 @@ LIMIT_SHAOLEN_PER_DAY = 50
 GOOGLE_FIT_CLIENT_ID = os.getenv("GOOGLE_FIT_CLIENT_ID", "")
 GOOGLE_FIT_CLIENT_SECRET = os.getenv("GOOGLE_FIT_CLIENT_SECRET", "")
 WEBAPP_BASE_URL = os.getenv("WEBAPP_BASE_URL", "").rstrip("/")  # https://your-domain.com
+DB_PATH = os.getenv("DB_PATH", "goals_bot.db")
+# Как долго (сек) не повторять UPSERT в users для уже виденного пользователя с теми же именами
+USER_UPSERT_TTL_SEC = int(os.getenv("USER_UPSERT_TTL_SEC", "600"))
+USER_UPSERT_CACHE_SIZE = 10000
 
 # Списки моделей по приоритету: при 429 (лимит Groq) пробуем следующую. Для пользователя без изменений.
 # Чтобы добавить новую модель — допишите строку в нужный список.
@@ -51,10 +59,37 @@ SHAOLEN_VISION_MODELS = [
 ]
 
 
+# Ключ проверки подписи initData зависит только от BOT_TOKEN — считаем один раз
+_INIT_DATA_SECRET = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest() if BOT_TOKEN else b""
+# Сколько секунд initData считается действительной после auth_date (0 — не проверять)
+INIT_DATA_MAX_AGE_SEC = int(os.getenv("INIT_DATA_MAX_AGE_SEC", "86400"))
+INIT_DATA_CACHE_SIZE = 1024
+# Проверенные строки initData -> (данные, до какого time.time() действительны). Мини-приложение
+# шлёт одну и ту же строку весь сеанс, поэтому HMAC и разбор JSON нужны только на первом запросе.
+_init_data_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+
+def _init_data_expires_at(data: dict) -> float:
+    if INIT_DATA_MAX_AGE_SEC <= 0:
+        return float("inf")
+    try:
+        return int(data.get("auth_date") or 0) + INIT_DATA_MAX_AGE_SEC
+    except ValueError:
+        return 0.0
+
+
 def validate_telegram_init_data(init_data: str) -> Optional[dict]:
     """Проверяет подпись Telegram WebApp initData и возвращает данные (в т.ч. user) или None."""
     if not init_data or not BOT_TOKEN:
         return None
+    now = time.time()
+    cached = _init_data_cache.get(init_data)
+    if cached is not None:
+        if now < cached[1]:
+            _init_data_cache.move_to_end(init_data)
+            return dict(cached[0])
+        del _init_data_cache[init_data]
+        return None
     data = {}
     hash_val = ""
     for part in init_data.split("&"):
@@ -68,15 +103,20 @@ def validate_telegram_init_data(init_data: str) -> Optional[dict]:
     if not hash_val or "user" not in data:
         return None
     check_str = "\n".join(f"{k}={data[k]}" for k in sorted(data.keys()))
-    secret = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
-    expected = hmac.new(secret, check_str.encode(), hashlib.sha256).hexdigest()
+    expected = hmac.new(_INIT_DATA_SECRET, check_str.encode(), hashlib.sha256).hexdigest()
     if not hmac.compare_digest(expected, hash_val):
         return None
+    expires_at = _init_data_expires_at(data)
+    if now >= expires_at:
+        return None
     try:
         data["_user"] = json.loads(data["user"])
     except Exception:
         return None
-    return data
+    _init_data_cache[init_data] = (data, expires_at)
+    while len(_init_data_cache) > INIT_DATA_CACHE_SIZE:
+        _init_data_cache.popitem(last=False)
+    return dict(data)
 
 # Настройка логирования (консоль + файл для админки и просмотра логов)
 _log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
@@ -92,19 +132,36 @@ try:
 except Exception:
     pass
 
-db = Database()
+db = Database(DB_PATH)
+# Общие httpx-клиенты для Telegram, Google, Open-Meteo и ip-api (http_clients.py)
+http_pool = HttpClients()
+calendar_jobs = CalendarSyncJobs()
+# Access token Google по пользователю: кэш в памяти и одно обновление на пользователя (google_tokens.py)
+google_tokens = GoogleTokenManager(
+    db, lambda: http_pool.client("google_oauth"), GOOGLE_FIT_CLIENT_ID, GOOGLE_FIT_CLIENT_SECRET
+)
+# Шаги за сегодня: кэш с фоновым обновлением и история по дням в steps_daily (google_fit.py)
+google_fit_steps = StepsCache(db, google_tokens, lambda: http_pool.client("google_api"))
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     try:
+        await db.open()
         await db.init_db()
+        db.start_wal_checkpointer("webapp")
         logger.info(f"База данных инициализирована: {db.db_path}")
     except Exception as e:
         logger.error(f"Ошибка инициализации базы данных: {e}")
         raise
+    http_pool.open()
     yield
-    # Shutdown (если нужно)
+    # Shutdown: закрываем исходящие соединения, останавливаем checkpoint и закрываем пул соединений с БД
+    await calendar_jobs.shutdown()
+    await google_fit_steps.shutdown()
+    await google_tokens.shutdown()
+    await http_pool.aclose()
+    await db.close()
 
 app = FastAPI(title="Goals WebApp API", lifespan=lifespan)
 
@@ -190,6 +247,28 @@ class CapsuleReflectionBody(BaseModel):
 # Инициализация БД теперь в lifespan выше
 
 
+# Недавно записанные в users пользователи: user_id -> ((username, first_name, last_name), monotonic-время).
+# Без этого каждый GET /api/user/... был бы записью в БД (UPSERT + commit), а loadAll() шлёт 9 запросов разом.
+_seen_users: "OrderedDict[int, tuple]" = OrderedDict()
+user_upsert_stats = {"written": 0, "skipped": 0}
+
+
+async def _remember_telegram_user(user_id: int, u: dict) -> None:
+    """db.add_user только если имена из Telegram изменились или запись в кэше устарела (USER_UPSERT_TTL_SEC)."""
+    identity = (u.get("username"), u.get("first_name"), u.get("last_name"))
+    now = time.monotonic()
+    seen = _seen_users.get(user_id)
+    if seen and seen[0] == identity and now - seen[1] < USER_UPSERT_TTL_SEC:
+        user_upsert_stats["skipped"] += 1
+        return
+    await db.add_user(user_id, username=identity[0], first_name=identity[1], last_name=identity[2])
+    user_upsert_stats["written"] += 1
+    _seen_users[user_id] = (identity, now)
+    _seen_users.move_to_end(user_id)
+    while len(_seen_users) > USER_UPSERT_CACHE_SIZE:
+        _seen_users.popitem(last=False)
+
+
 # Middleware: проверка Telegram initData для /api/user/... и привязка к реальному user_id
 @app.middleware("http")
 async def check_telegram_user(request: Request, call_next):
@@ -214,12 +293,7 @@ async def check_telegram_user(request: Request, call_next):
         if path_user_id is not None and int(tg_user_id) != path_user_id:
             logger.warning(f"⛔ user_id в пути ({path_user_id}) не совпадает с Telegram ({tg_user_id})")
             return JSONResponse(status_code=403, content={"detail": "Доступ запрещён для этого пользователя."})
-        await db.add_user(
-            int(tg_user_id),
-            username=u.get("username"),
-            first_name=u.get("first_name"),
-            last_name=u.get("last_name"),
-        )
+        await _remember_telegram_user(int(tg_user_id), u)
         request.state.telegram_user_id = int(tg_user_id)
     response = await call_next(request)
     return response
@@ -318,28 +392,32 @@ async def api_set_missions_order(user_id: int, payload: MissionsOrderBody):
     return JSONResponse(content={"ok": True})
 
 
+async def _missions_data(user_id: int) -> List[Dict[str, Any]]:
+    """Миссии пользователя в виде для JSON (общая часть /missions и /bootstrap)."""
+    logger.info(f"Запрос миссий для пользователя {user_id}")
+    missions = await db.get_missions(user_id, include_completed=True)
+    logger.info(f"Найдено миссий: {len(missions) if missions else 0}")
+
+    # Преобразуем данные для JSON (убираем None, конвертируем типы)
+    result = []
+    for mission in (missions or []):
+        clean_mission = {}
+        for key, value in mission.items():
+            if value is None:
+                clean_mission[key] = None
+            elif isinstance(value, (int, float, bool, str)):
+                clean_mission[key] = value
+            else:
+                clean_mission[key] = str(value)
+        result.append(clean_mission)
+    return result
+
+
 @app.get("/api/user/{user_id}/missions", response_model=None)
 async def api_get_missions(user_id: int):
     """Получение миссий пользователя (user_id проверен через initData в middleware)."""
     try:
-        logger.info(f"Запрос миссий для пользователя {user_id}")
-        missions = await db.get_missions(user_id, include_completed=True)
-        logger.info(f"Найдено миссий: {len(missions) if missions else 0}")
-        
-        # Преобразуем данные для JSON (убираем None, конвертируем типы)
-        result = []
-        for mission in (missions or []):
-            clean_mission = {}
-            for key, value in mission.items():
-                if value is None:
-                    clean_mission[key] = None
-                elif isinstance(value, (int, float, bool, str)):
-                    clean_mission[key] = value
-                else:
-                    clean_mission[key] = str(value)
-            result.append(clean_mission)
-        
-        return JSONResponse(content=result)
+        return JSONResponse(content=await _missions_data(user_id))
     except Exception as e:
         logger.error(f"Ошибка получения миссий для пользователя {user_id}: {e}", exc_info=True)
         return JSONResponse(content=[])
@@ -506,28 +584,32 @@ async def api_set_goals_order(user_id: int, payload: GoalsOrderBody):
     return JSONResponse(content={"ok": True})
 
 
+async def _goals_data(user_id: int) -> List[Dict[str, Any]]:
+    """Цели пользователя в виде для JSON (общая часть /goals и /bootstrap)."""
+    logger.info(f"Запрос целей для пользователя {user_id}")
+    goals = await db.get_goals(user_id, include_completed=True)
+    logger.info(f"Найдено целей: {len(goals) if goals else 0}")
+
+    # Преобразуем данные для JSON
+    result = []
+    for goal in (goals or []):
+        clean_goal = {}
+        for key, value in goal.items():
+            if value is None:
+                clean_goal[key] = None
+            elif isinstance(value, (int, float, bool, str)):
+                clean_goal[key] = value
+            else:
+                clean_goal[key] = str(value)
+        result.append(clean_goal)
+    return result
+
+
 @app.get("/api/user/{user_id}/goals", response_model=None)
 async def api_get_goals(user_id: int):
     """Получение целей пользователя (user_id проверен через initData в middleware)."""
     try:
-        logger.info(f"Запрос целей для пользователя {user_id}")
-        goals = await db.get_goals(user_id, include_completed=True)
-        logger.info(f"Найдено целей: {len(goals) if goals else 0}")
-        
-        # Преобразуем данные для JSON
-        result = []
-        for goal in (goals or []):
-            clean_goal = {}
-            for key, value in goal.items():
-                if value is None:
-                    clean_goal[key] = None
-                elif isinstance(value, (int, float, bool, str)):
-                    clean_goal[key] = value
-                else:
-                    clean_goal[key] = str(value)
-            result.append(clean_goal)
-        
-        return JSONResponse(content=result)
+        return JSONResponse(content=await _goals_data(user_id))
     except Exception as e:
         logger.error(f"Ошибка получения целей для пользователя {user_id}: {e}", exc_info=True)
         return JSONResponse(content=[])
@@ -569,36 +651,35 @@ async def api_set_habits_order(user_id: int, payload: HabitsOrderBody):
     return JSONResponse(content={"ok": True})
 
 
+async def _habits_data(user_id: int) -> List[Dict[str, Any]]:
+    """Привычки пользователя со счётчиками в виде для JSON (общая часть /habits и /bootstrap)."""
+    logger.info(f"Запрос привычек для пользователя {user_id}")
+    habits = await db.get_habits_enriched(user_id)
+    logger.info(f"Найдено привычек: {len(habits) if habits else 0}")
+
+    # Преобразуем данные для JSON
+    result = []
+    for habit in (habits or []):
+        clean_habit = {}
+        for key, value in habit.items():
+            if key == 'today_count':
+                # Убеждаемся, что счетчик - это число
+                clean_habit[key] = int(value) if value is not None else 0
+            elif value is None:
+                clean_habit[key] = None
+            elif isinstance(value, (int, float, bool, str, list)):
+                clean_habit[key] = value
+            else:
+                clean_habit[key] = str(value)
+        result.append(clean_habit)
+    return result
+
+
 @app.get("/api/user/{user_id}/habits", response_model=None)
 async def api_get_habits(user_id: int):
     """Получение привычек пользователя (user_id проверен через initData в middleware)."""
     try:
-        logger.info(f"Запрос привычек для пользователя {user_id}")
-        habits = await db.get_habits(user_id, active_only=False)
-        logger.info(f"Найдено привычек: {len(habits) if habits else 0}")
-        
-        # Преобразуем данные для JSON
-        result = []
-        for habit in (habits or []):
-            clean_habit = {}
-            for key, value in habit.items():
-                if key == 'today_count':
-                    # Убеждаемся, что счетчик - это число
-                    clean_habit[key] = int(value) if value is not None else 0
-                elif value is None:
-                    clean_habit[key] = None
-                elif isinstance(value, (int, float, bool, str)):
-                    clean_habit[key] = value
-                else:
-                    clean_habit[key] = str(value)
-            hid = habit.get("id")
-            streak = await db.get_habit_streak_for_habit(hid, days=365) if hid else 0
-            total_completions = await db.get_habit_total_completions(hid) if hid else 0
-            clean_habit["streak"] = streak
-            clean_habit["total_completions"] = total_completions
-            result.append(clean_habit)
-
-        return JSONResponse(content=result)
+        return JSONResponse(content=await _habits_data(user_id))
     except Exception as e:
         logger.error(f"Ошибка получения привычек для пользователя {user_id}: {e}", exc_info=True)
         return JSONResponse(content=[])
@@ -653,23 +734,24 @@ def _send_achievement_telegram(user_id: int, habit_title: str) -> None:
     try:
         import asyncio
         async def _send():
-            async with httpx.AsyncClient(timeout=10) as client:
-                await client.post(url, json={"chat_id": user_id, "text": msg, "parse_mode": "Markdown"})
+            client = http_pool.client("telegram")
+            await client.post(url, json={"chat_id": user_id, "text": msg, "parse_mode": "Markdown"})
         asyncio.create_task(_send())
     except Exception as e:
         logger.warning("Не удалось отправить уведомление о достижении: %s", e)
 
 
 @app.post("/api/habits/{habit_id}/increment")
-async def api_increment_habit(habit_id: int):
-    """Увеличить счетчик привычки на 1. Возвращает achievement_unlocked, habit_title при достижении 21."""
+async def api_increment_habit(habit_id: int, delta: int = Query(1, ge=1, le=100)):
+    """Увеличить счетчик привычки на delta (по умолчанию 1; несколько нажатий подряд — одним запросом).
+    Возвращает achievement_unlocked, habit_title при достижении 21."""
     try:
-        count = await db.increment_habit_count(habit_id)
+        count = await db.increment_habit_count(habit_id, delta=delta)
         result = {"count": count}
         try:
             habit = await db.get_habit(habit_id)
             if habit:
-                total = await db.get_habit_total_completions(habit_id)
+                total = int(habit.get("total_completions") or 0)
                 notified = habit.get("achievement_21_notified") or 0
                 if total >= 21 and not notified:
                     await db.set_habit_achievement_notified(habit_id)
@@ -685,10 +767,10 @@ async def api_increment_habit(habit_id: int):
 
 
 @app.post("/api/habits/{habit_id}/decrement")
-async def api_decrement_habit(habit_id: int):
-    """Уменьшить счетчик привычки на 1"""
+async def api_decrement_habit(habit_id: int, delta: int = Query(1, ge=1, le=100)):
+    """Уменьшить счетчик привычки на delta (по умолчанию 1)"""
     try:
-        count = await db.decrement_habit_count(habit_id)
+        count = await db.decrement_habit_count(habit_id, delta=delta)
         return {"count": count}
     except Exception as e:
         logger.error(f"Ошибка уменьшения счетчика привычки {habit_id}: {e}")
@@ -739,6 +821,7 @@ class ProfileUpdate(BaseModel):
     country: Optional[str] = None
     country_code: Optional[str] = None  # ISO 2 буквы для геокодинга (Москва → RU)
     geo_consent: Optional[bool] = None
+    timezone: Optional[str] = None  # IANA (Asia/Novosibirsk) для напоминаний; "" — определять по городу
 
 
 class ReminderSettingsUpdate(BaseModel):
@@ -771,6 +854,8 @@ def _profile_out(user: dict) -> dict:
         "country": (user.get("country") or "").strip() or None,
         "country_code": (user.get("country_code") or "").strip().upper() or None,
         "geo_consent": bool(user.get("geo_consent")),
+        "timezone": user.get("timezone") or DEFAULT_TIMEZONE,
+        "timezone_auto": user.get("timezone_auto") != 0,
     }
 
 
@@ -870,18 +955,18 @@ async def api_google_fit_callback(request: Request, code: str = "", state: str =
     if not GOOGLE_FIT_CLIENT_ID or not GOOGLE_FIT_CLIENT_SECRET or not WEBAPP_BASE_URL:
         return JSONResponse(status_code=503, content={"detail": "Google Fit не настроен."})
     redirect_uri = f"{WEBAPP_BASE_URL}/api/google-fit/callback"
-    async with httpx.AsyncClient() as client:
-        r = await client.post(
-            "https://oauth2.googleapis.com/token",
-            data={
-                "code": code,
-                "client_id": GOOGLE_FIT_CLIENT_ID,
-                "client_secret": GOOGLE_FIT_CLIENT_SECRET,
-                "redirect_uri": redirect_uri,
-                "grant_type": "authorization_code",
-            },
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-        )
+    client = http_pool.client("google_oauth")
+    r = await client.post(
+        "https://oauth2.googleapis.com/token",
+        data={
+            "code": code,
+            "client_id": GOOGLE_FIT_CLIENT_ID,
+            "client_secret": GOOGLE_FIT_CLIENT_SECRET,
+            "redirect_uri": redirect_uri,
+            "grant_type": "authorization_code",
+        },
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    )
     if r.status_code != 200:
         logger.warning("Google token exchange failed: %s %s", r.status_code, r.text)
         from fastapi.responses import HTMLResponse
@@ -900,7 +985,7 @@ async def api_google_fit_callback(request: Request, code: str = "", state: str =
             status_code=500,
         )
     expires_at = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
-    await db.save_google_fit_tokens(user_id, access, refresh, expires_at)
+    await google_tokens.store(user_id, access, refresh, expires_at)
     logger.info("Google Fit tokens saved for user %s", user_id)
     from fastapi.responses import RedirectResponse
     success_url = f"{WEBAPP_BASE_URL}/google-fit-success.html"
@@ -910,114 +995,37 @@ async def api_google_fit_callback(request: Request, code: str = "", state: str =
 @app.get("/api/user/{user_id}/google-fit/status", response_model=None)
 async def api_google_fit_status(user_id: int):
     """Подключён ли Google Fit."""
-    tokens = await db.get_google_fit_tokens(user_id)
-    return JSONResponse(content={"connected": tokens is not None})
+    return JSONResponse(content={"connected": await google_tokens.connected(user_id)})
 
 
 @app.get("/api/user/{user_id}/google-fit/steps", response_model=None)
 async def api_google_fit_steps(user_id: int):
-    """Количество шагов за сегодня (по Google Fit)."""
-    tokens = await db.get_google_fit_tokens(user_id)
-    if not tokens:
+    """Количество шагов за сегодня (по Google Fit) — из кэша google_fit.py; age — сколько секунд назад получены."""
+    if not await google_tokens.connected(user_id):
         return JSONResponse(content={"steps": None, "error": "not_connected"})
-    access = tokens.get("access_token")
-    refresh = tokens.get("refresh_token")
-    expires_at = tokens.get("expires_at")
-    now = datetime.now(timezone.utc)
-    if expires_at and isinstance(expires_at, str):
-        try:
-            expires_at = datetime.fromisoformat(expires_at.replace("Z", "+00:00"))
-        except Exception:
-            expires_at = None
-    if expires_at and (now - timedelta(minutes=5)) >= expires_at and refresh:
-        async with httpx.AsyncClient() as client:
-            rr = await client.post(
-                "https://oauth2.googleapis.com/token",
-                data={
-                    "client_id": GOOGLE_FIT_CLIENT_ID,
-                    "client_secret": GOOGLE_FIT_CLIENT_SECRET,
-                    "refresh_token": refresh,
-                    "grant_type": "refresh_token",
-                },
-                headers={"Content-Type": "application/x-www-form-urlencoded"},
-            )
-        if rr.status_code == 200:
-            rdata = rr.json()
-            access = rdata.get("access_token")
-            exp = rdata.get("expires_in", 3600)
-            new_expires = now + timedelta(seconds=exp)
-            await db.save_google_fit_tokens(user_id, access, refresh, new_expires)
-    if not access:
-        return JSONResponse(content={"steps": None, "error": "token_expired"})
-    tz = timezone.utc
-    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    start_ms = int(today_start.timestamp() * 1000)
-    end_ms = int(now.timestamp() * 1000)
-    body = {
-        "aggregateBy": [{"dataTypeName": "com.google.step_count.delta"}],
-        "bucketByTime": {"durationMillis": 86400000},
-        "startTimeMillis": str(start_ms),
-        "endTimeMillis": str(end_ms),
-    }
-    try:
-        async with httpx.AsyncClient() as client:
-            fr = await client.post(
-                "https://www.googleapis.com/fitness/v1/users/me/dataset:aggregate",
-                json=body,
-                headers={"Authorization": f"Bearer {access}"},
-            )
-    except Exception as e:
-        logger.exception("Google Fitness API error: %s", e)
-        return JSONResponse(content={"steps": None, "error": "api_error"})
-    if fr.status_code != 200:
-        logger.warning("Fitness API %s: %s", fr.status_code, fr.text)
-        return JSONResponse(content={"steps": None, "error": "api_error"})
-    data = fr.json()
-    total = 0
-    for bucket in data.get("bucket", []):
-        for ds in bucket.get("dataset", []):
-            for pt in ds.get("point", []):
-                for v in pt.get("value", []):
-                    total += int(v.get("intVal", 0))
-    return JSONResponse(content={"steps": total})
+    tz = (await db.get_user_timezones([user_id])).get(user_id) or DEFAULT_TIMEZONE
+    return JSONResponse(content=await google_fit_steps.today(user_id, tz))
+
+
+@app.get("/api/user/{user_id}/google-fit/steps/history", response_model=None)
+async def api_google_fit_steps_history(user_id: int, days: int = 30):
+    """Шаги по дням за последние days дней из steps_daily (без запросов к Google): [{date, steps}]."""
+    days = max(1, min(days, 366))
+    tz = (await db.get_user_timezones([user_id])).get(user_id) or DEFAULT_TIMEZONE
+    today = datetime.now(timezone.utc).astimezone(user_zone(tz)).date()
+    rows = await db.get_steps_daily(user_id, (today - timedelta(days=days - 1)).isoformat())
+    return JSONResponse(content={"days": [{"date": str(r["date"]), "steps": r["steps"]} for r in rows]})
 
 
 @app.delete("/api/user/{user_id}/google-fit")
 async def api_google_fit_disconnect(user_id: int):
     """Отключить Google Fit."""
-    await db.delete_google_fit_tokens(user_id)
+    await google_tokens.forget(user_id)
+    google_fit_steps.forget(user_id)
     return JSONResponse(content={"ok": True})
 
 
 # --- Синхронизация с Google Календарь ---
-def _habit_suggested_time(title: str, index: int, total: int) -> tuple:
-    """
-    Определяет рекомендуемое время для привычки по названию.
-    Возвращает (hour, minute). Распределяет равномерно в течение дня (6–22 ч).
-    """
-    t = (title or "").lower()
-    # Вода: равномерно в течение дня — 8, 11, 14, 17, 20
-    if any(x in t for x in ["вод", "воды", "пить", "воду"]):
-        slots = [(8, 0), (11, 0), (14, 0), (17, 0), (20, 0)]
-        h, m = slots[index % len(slots)]
-        return h, m
-    # Утренние: зарядка, спорт, витамины — 6:30–8:30
-    if any(x in t for x in ["зарядк", "спорт", "упражнен", "витамин", "утр", "таблет", "разминк"]):
-        return 7 + (index % 2), 0 if index % 2 == 0 else 30
-    # Вечерние: чтение, медитация, дневник, сон — 20–22
-    if any(x in t for x in ["чита", "книг", "медитац", "дневник", "сон", "спат", "отдых", "расслаб"]):
-        return 20 + (index % 3), 0
-    # Дневные: прогулка, ходьба, растяжка — 12, 18
-    if any(x in t for x in ["прогулк", "ходьб", "растяжк"]):
-        return 12 if index % 2 == 0 else 18, 0
-    # По умолчанию: равномерно 8–20
-    if total <= 0:
-        total = 1
-    step = max(1, (20 - 8) // total)
-    h = 8 + (index * step) % 12
-    return min(h, 20), 0
-
-
 @app.get("/api/user/{user_id}/calendar-sync-settings", response_model=None)
 async def api_calendar_sync_settings(user_id: int):
     """Настройки выгрузки в Google Календарь."""
@@ -1044,172 +1052,56 @@ async def api_update_calendar_sync_settings(user_id: int, payload: CalendarSyncS
 
 @app.post("/api/user/{user_id}/calendar-sync", response_model=None)
 async def api_calendar_sync(user_id: int):
-    """Выгрузить подцели, привычки и цели в Google Календарь."""
-    tokens = await db.get_google_fit_tokens(user_id)
-    if not tokens:
+    """Запустить выгрузку подцелей, привычек и целей в Google Календарь фоновой задачей (calendar_sync.py):
+    создаются, перезаписываются и удаляются только изменившиеся с прошлой выгрузки события.
+    Отвечает сразу (202, job_id и status); ход — GET /api/user/{user_id}/calendar-sync/status."""
+    if not await google_tokens.connected(user_id):
         return JSONResponse(status_code=400, content={"detail": "Подключите Google в настройках (Авторизация Google Fit / Синхронизация с Google)."})
+    running = calendar_jobs.get(user_id)
+    if running is not None and not running.finished:
+        return JSONResponse(status_code=202, content=running.to_dict())
     settings = await db.get_calendar_sync_settings(user_id)
-    access = tokens.get("access_token")
-    refresh = tokens.get("refresh_token")
-    expires_at = tokens.get("expires_at")
+    access = await google_tokens.access_token(user_id)
     now = datetime.now(timezone.utc)
-    if expires_at and isinstance(expires_at, str):
-        try:
-            expires_at = datetime.fromisoformat(expires_at.replace("Z", "+00:00"))
-        except Exception:
-            expires_at = None
-    if expires_at and (now - timedelta(minutes=5)) >= expires_at and refresh:
-        async with httpx.AsyncClient() as client:
-            rr = await client.post(
-                "https://oauth2.googleapis.com/token",
-                data={
-                    "client_id": GOOGLE_FIT_CLIENT_ID,
-                    "client_secret": GOOGLE_FIT_CLIENT_SECRET,
-                    "refresh_token": refresh,
-                    "grant_type": "refresh_token",
-                },
-                headers={"Content-Type": "application/x-www-form-urlencoded"},
-            )
-        if rr.status_code == 200:
-            rdata = rr.json()
-            access = rdata.get("access_token")
-            exp = rdata.get("expires_in", 3600)
-            new_expires = now + timedelta(seconds=exp)
-            await db.save_google_fit_tokens(user_id, access, refresh, new_expires)
     if not access:
         return JSONResponse(status_code=400, content={"detail": "Токен истёк. Отключите и подключите Google заново."})
 
-    headers = {"Authorization": f"Bearer {access}", "Content-Type": "application/json"}
-    created = 0
-    errors = []
-    today = now.strftime("%Y-%m-%d")
-    tz = "Europe/Moscow"
+    tz = (await db.get_user_timezones([user_id])).get(user_id) or DEFAULT_TIMEZONE
+    today = now.astimezone(user_zone(tz)).strftime("%Y-%m-%d")
 
-    try:
-        if settings.get("sync_habits", True):
-            habits = await db.get_habits(user_id, active_only=True)
-            for i, h in enumerate(habits):
-                title = (h.get("title") or "").strip() or "Привычка"
-                hour, minute = _habit_suggested_time(title, i, len(habits))
-                start_dt = f"{today}T{hour:02d}:{minute:02d}:00"
-                end_h = hour + 1 if minute == 30 else hour
-                end_m = 30 if minute == 0 else 0
-                end_dt = f"{today}T{end_h:02d}:{end_m:02d}:00"
-                event = {
-                    "summary": f"Привычка: {title}",
-                    "description": "Из приложения «Твои цели»",
-                    "start": {"dateTime": start_dt, "timeZone": tz},
-                    "end": {"dateTime": end_dt, "timeZone": tz},
-                    "recurrence": ["RRULE:FREQ=DAILY"],
-                }
-                try:
-                    async with httpx.AsyncClient() as client:
-                        r = await client.post(
-                            "https://www.googleapis.com/calendar/v3/calendars/primary/events",
-                            json=event,
-                            headers=headers,
-                        )
-                    if r.status_code in (200, 201):
-                        created += 1
-                    else:
-                        err_body = (r.text or "")[:200]
-                        logger.warning("Calendar API 403 habit %s: %s %s", title, r.status_code, err_body)
-                        errors.append(f"habit {title}: {r.status_code}")
-                except Exception as e:
-                    errors.append(f"habit {title}: {str(e)}")
-
-        if settings.get("sync_goals", True):
-            goals = await db.get_goals(user_id, include_completed=False)
-            for g in goals:
-                title = (g.get("title") or "").strip() or "Цель"
-                dl = g.get("deadline")
-                if not dl:
-                    continue
-                try:
-                    dl_str = str(dl)[:10] if dl else today
-                except Exception:
-                    dl_str = today
-                start_dt = f"{dl_str}T09:00:00"
-                end_dt = f"{dl_str}T10:00:00"
-                event = {
-                    "summary": f"Цель: {title}",
-                    "description": (g.get("description") or "")[:500] or "Из приложения «Твои цели»",
-                    "start": {"dateTime": start_dt, "timeZone": tz},
-                    "end": {"dateTime": end_dt, "timeZone": tz},
-                }
-                try:
-                    async with httpx.AsyncClient() as client:
-                        r = await client.post(
-                            "https://www.googleapis.com/calendar/v3/calendars/primary/events",
-                            json=event,
-                            headers=headers,
-                        )
-                    if r.status_code in (200, 201):
-                        created += 1
-                    else:
-                        err_body = (r.text or "")[:200]
-                        logger.warning("Calendar API 403 goal %s: %s %s", title, r.status_code, err_body)
-                        errors.append(f"goal {title}: {r.status_code}")
-                except Exception as e:
-                    errors.append(f"goal {title}: {str(e)}")
-
-        if settings.get("sync_subgoals", True):
-            missions = await db.get_missions(user_id, include_completed=False)
-            for m in missions:
-                dl = m.get("deadline")
-                if not dl:
-                    continue
-                try:
-                    dl_str = str(dl)[:10] if dl else today
-                except Exception:
-                    dl_str = today
-                mtitle = (m.get("title") or "").strip() or "Миссия"
-                subgoals = await db.get_subgoals(m.get("id") or 0)
-                for j, sg in enumerate(subgoals):
-                    sgtitle = (sg.get("title") or "").strip() or "Подцель"
-                    hour = 9 + (j % 8)
-                    event = {
-                        "summary": f"{mtitle}: {sgtitle}",
-                        "description": "Из приложения «Твои цели»",
-                        "start": {"dateTime": f"{dl_str}T{hour:02d}:00:00", "timeZone": tz},
-                        "end": {"dateTime": f"{dl_str}T{hour:02d}:30:00", "timeZone": tz},
-                    }
-                    try:
-                        async with httpx.AsyncClient() as client:
-                            r = await client.post(
-                                "https://www.googleapis.com/calendar/v3/calendars/primary/events",
-                                json=event,
-                                headers=headers,
-                            )
-                        if r.status_code in (200, 201):
-                            created += 1
-                        else:
-                            err_body = (r.text or "")[:200]
-                            logger.warning("Calendar API 403 subgoal %s: %s %s", sgtitle, r.status_code, err_body)
-                            errors.append(f"subgoal {sgtitle}: {r.status_code}")
-                    except Exception as e:
-                        errors.append(f"subgoal {sgtitle}: {str(e)}")
-
-        resp = {"ok": True, "created": created, "errors": errors[:10]}
-        # Если все запросы завершились ошибкой — подсказка по 403
-        if created == 0 and errors and any("403" in e for e in errors):
-            resp["hint"] = (
-                "403 Forbidden: Включите Google Calendar API в Google Cloud Console и "
-                "отключите/подключите Google в настройках (чтобы получить доступ к календарю)."
-            )
-        return JSONResponse(content=resp)
-    except Exception as e:
-        logger.exception("calendar sync: %s", e)
-        return JSONResponse(status_code=500, content={"detail": str(e)})
+    async def run(job):
+        events = await load_calendar_events(db, user_id, settings, today, tz)
+        await sync_events(db, http_pool.client("google_api"), access, user_id, events, job, synced_kinds(settings))
+        if job.unauthorized:
+            google_tokens.expire(user_id)
+
+    job = calendar_jobs.start(user_id, run)
+    return JSONResponse(status_code=202, content=job.to_dict())
+
+
+@app.get("/api/user/{user_id}/calendar-sync/status", response_model=None)
+async def api_calendar_sync_status(user_id: int):
+    """Ход последней выгрузки в календарь: status queued/running/done/failed, total, done,
+    created/updated/deleted/unchanged, errors."""
+    job = calendar_jobs.get(user_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"detail": "Выгрузка не запускалась."})
+    return JSONResponse(content=job.to_dict())
+
+
+async def _profile_data(user_id: int) -> Optional[Dict[str, Any]]:
+    """Профиль для JSON или None, если пользователя нет (общая часть /profile и /bootstrap)."""
+    user = await db.get_user(user_id)
+    return _profile_out(user) if user else None
 
 
 @app.get("/api/user/{user_id}/profile", response_model=None)
 async def api_get_profile(user_id: int):
     """Профиль пользователя: имя, пол, вес, рост, возраст, цель, город, статистика."""
-    user = await db.get_user(user_id)
-    if not user:
+    profile = await _profile_data(user_id)
+    if profile is None:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
-    return JSONResponse(content=_profile_out(user))
+    return JSONResponse(content=profile)
 
 
 @app.put("/api/user/{user_id}/profile")
@@ -1229,6 +1121,14 @@ async def api_update_profile(user_id: int, payload: ProfileUpdate):
         country_code=payload.country_code,
         geo_consent=payload.geo_consent,
     )
+    if payload.timezone is not None:
+        if not await db.set_user_timezone(user_id, payload.timezone.strip() or None):
+            raise HTTPException(status_code=400, detail="Неизвестный часовой пояс")
+    elif payload.city and not infer_timezone(payload.city, payload.country_code):
+        # Города нет в таблице user_timezones — берём пояс из геокодера (применится, если пользователь не задал свой)
+        geo = await _geocode_city(payload.city, country_code=payload.country_code or "")
+        if geo and valid_timezone(geo.get("timezone")):
+            await db.set_user_timezone(user_id, geo["timezone"], auto=True)
     if payload.weight is not None and payload.weight > 0:
         today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
         await db.add_weight_entry(user_id, today, payload.weight)
@@ -1238,13 +1138,18 @@ async def api_update_profile(user_id: int, payload: ProfileUpdate):
     return JSONResponse(content=_profile_out(user))
 
 
-@app.get("/api/user/{user_id}/weight-history", response_model=None)
-async def api_weight_history(user_id: int, period: str = "7"):
-    """История веса: period = 7 | week | month | 6months | year."""
+async def _weight_history_data(user_id: int, period: str = "7") -> Dict[str, Any]:
+    """История веса за period (общая часть /weight-history и /bootstrap)."""
     if period not in ("7", "week", "month", "6months", "year"):
         period = "7"
     rows = await db.get_weight_history(user_id, period=period)
-    return JSONResponse(content={"period": period, "data": rows})
+    return {"period": period, "data": rows}
+
+
+@app.get("/api/user/{user_id}/weight-history", response_model=None)
+async def api_weight_history(user_id: int, period: str = "7"):
+    """История веса: period = 7 | week | month | 6months | year."""
+    return JSONResponse(content=await _weight_history_data(user_id, period))
 
 
 class WeightEntryBody(BaseModel):
@@ -1282,22 +1187,22 @@ async def _geo_by_ip(ip: str) -> Optional[Dict[str, Any]]:
     if not ip or ip == "127.0.0.1":
         return None
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            r = await client.get(
-                f"http://ip-api.com/json/{ip}",
-                params={"fields": "city,country,lat,lon"},
-            )
-            if r.status_code != 200:
-                return None
-            data = r.json()
-            if data.get("status") != "success":
-                return None
-            return {
-                "city": data.get("city") or "",
-                "country": data.get("country") or "",
-                "lat": data.get("lat"),
-                "lon": data.get("lon"),
-            }
+        client = http_pool.client("ip_api")
+        r = await client.get(
+            f"http://ip-api.com/json/{ip}",
+            params={"fields": "city,country,lat,lon"},
+        )
+        if r.status_code != 200:
+            return None
+        data = r.json()
+        if data.get("status") != "success":
+            return None
+        return {
+            "city": data.get("city") or "",
+            "country": data.get("country") or "",
+            "lat": data.get("lat"),
+            "lon": data.get("lon"),
+        }
     except Exception as e:
         logger.warning("Гео по IP %s: %s", ip, e)
         return None
@@ -1306,23 +1211,23 @@ async def _geo_by_ip(ip: str) -> Optional[Dict[str, Any]]:
 async def _weather_by_coords(lat: float, lon: float) -> Optional[Dict[str, Any]]:
     """Погода по координатам (Open-Meteo): temp °C, humidity %."""
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            r = await client.get(
-                "https://api.open-meteo.com/v1/forecast",
-                params={
-                    "latitude": lat,
-                    "longitude": lon,
-                    "current": "temperature_2m,relative_humidity_2m",
-                },
-            )
-            if r.status_code != 200:
-                return None
-            data = r.json()
-            cur = data.get("current") or {}
-            return {
-                "temp": cur.get("temperature_2m"),
-                "humidity": cur.get("relative_humidity_2m"),
-            }
+        client = http_pool.client("open_meteo")
+        r = await client.get(
+            "https://api.open-meteo.com/v1/forecast",
+            params={
+                "latitude": lat,
+                "longitude": lon,
+                "current": "temperature_2m,relative_humidity_2m",
+            },
+        )
+        if r.status_code != 200:
+            return None
+        data = r.json()
+        cur = data.get("current") or {}
+        return {
+            "temp": cur.get("temperature_2m"),
+            "humidity": cur.get("relative_humidity_2m"),
+        }
     except Exception as e:
         logger.warning("Погода по координатам: %s", e)
         return None
@@ -1335,20 +1240,23 @@ async def _geocode_city(city: str, country: str = "", country_code: str = "") ->
         code = (country_code or "").strip().upper()
         if len(code) == 2:
             params["countryCode"] = code  # Open-Meteo API: camelCase
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            r = await client.get(
-                "https://geocoding-api.open-meteo.com/v1/search",
-                params=params,
-            )
-            if r.status_code != 200:
-                return None
-            data = r.json()
-            results = data.get("results") or []
-            if not results:
-                return None
-            # Берём первый результат (при фильтре по стране — нужный город)
-            r0 = results[0]
-            return {"lat": r0.get("latitude"), "lon": r0.get("longitude"), "name": r0.get("name"), "country": r0.get("country") or r0.get("country_code")}
+        client = http_pool.client("open_meteo")
+        r = await client.get(
+            "https://geocoding-api.open-meteo.com/v1/search",
+            params=params,
+        )
+        if r.status_code != 200:
+            return None
+        data = r.json()
+        results = data.get("results") or []
+        if not results:
+            return None
+        # Берём первый результат (при фильтре по стране — нужный город)
+        r0 = results[0]
+        return {
+            "lat": r0.get("latitude"), "lon": r0.get("longitude"), "name": r0.get("name"),
+            "country": r0.get("country") or r0.get("country_code"), "timezone": r0.get("timezone"),
+        }
     except Exception as e:
         logger.warning("Геокодинг %s: %s", city, e)
         return None
@@ -1359,40 +1267,40 @@ async def _geocode_search(query: str, count: int = 10) -> List[Dict[str, Any]]:
     if not (query or "").strip():
         return []
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            r = await client.get(
-                "https://geocoding-api.open-meteo.com/v1/search",
-                params={"name": query.strip(), "count": 20, "language": "ru"},
-            )
-            if r.status_code != 200:
-                return []
-            data = r.json()
-            raw = data.get("results") or []
-            # Сортировка по населению (сначала крупные города — реальные столицы/мегаполисы)
-            raw.sort(key=lambda x: -(x.get("population") or 0))
-            seen = set()
-            out = []
-            for r in raw:
-                name = (r.get("name") or "").strip()
-                # Полное название страны (API возвращает локализованное имя страны)
-                country_full = (r.get("country") or "").strip()
-                country_code = (r.get("country_code") or "").strip().upper()
-                if not name:
-                    continue
-                key = (name, country_code)
-                if key in seen:
-                    continue
-                seen.add(key)
-                out.append({
-                    "name": name,
-                    "country": country_full or country_code,
-                    "country_code": country_code,
-                    "lat": r.get("latitude"),
-                    "lon": r.get("longitude"),
-                })
-                if len(out) >= min(count, 15):
-                    break
-            return out
+        client = http_pool.client("open_meteo")
+        r = await client.get(
+            "https://geocoding-api.open-meteo.com/v1/search",
+            params={"name": query.strip(), "count": 20, "language": "ru"},
+        )
+        if r.status_code != 200:
+            return []
+        data = r.json()
+        raw = data.get("results") or []
+        # Сортировка по населению (сначала крупные города — реальные столицы/мегаполисы)
+        raw.sort(key=lambda x: -(x.get("population") or 0))
+        seen = set()
+        out = []
+        for r in raw:
+            name = (r.get("name") or "").strip()
+            # Полное название страны (API возвращает локализованное имя страны)
+            country_full = (r.get("country") or "").strip()
+            country_code = (r.get("country_code") or "").strip().upper()
+            if not name:
+                continue
+            key = (name, country_code)
+            if key in seen:
+                continue
+            seen.add(key)
+            out.append({
+                "name": name,
+                "country": country_full or country_code,
+                "country_code": country_code,
+                "lat": r.get("latitude"),
+                "lon": r.get("longitude"),
+            })
+            if len(out) >= min(count, 15):
+                break
+        return out
     except Exception as e:
         logger.warning("Поиск городов %s: %s", query, e)
         return []
@@ -1466,6 +1374,7 @@ class WaterCalculateBody(BaseModel):
     country_code: Optional[str] = None  # ISO 2 буквы для однозначного геокодинга
     temp: Optional[float] = None  # если уже есть погода
     humidity: Optional[float] = None
+    use_steps: Optional[bool] = True  # без activity_minutes — активность по шагам Google Fit из steps_daily
 
 
 @app.post("/api/user/{user_id}/water-calculate", response_model=None)
@@ -1481,6 +1390,16 @@ async def api_water_calculate(user_id: int, request: Request, payload: WaterCalc
             content={"detail": "Укажите вес в профиле"},
         )
     activity = float(payload.activity_minutes or 0)
+    steps_days = 0
+    if not activity and payload.use_steps:
+        # Средние шаги за последние полные дни (сегодня ещё не закончился)
+        yesterday = datetime.now(timezone.utc).astimezone(user_zone(user.get("timezone"))).date() - timedelta(days=1)
+        history = await db.get_steps_daily(
+            user_id, (yesterday - timedelta(days=6)).isoformat(), yesterday.isoformat()
+        )
+        from_steps = activity_minutes_from_steps(history)
+        if from_steps is not None:
+            activity, steps_days = from_steps, len(history)
     temp, humidity = payload.temp, payload.humidity
     city_out = (payload.city or "").strip() or None
     country_out = (payload.country or "").strip() or None
@@ -1521,6 +1440,7 @@ async def api_water_calculate(user_id: int, request: Request, payload: WaterCalc
         "liters": liters,
         "weight_kg": weight,
         "activity_minutes": activity,
+        "activity_from_steps_days": steps_days,  # >0 — активность оценена по шагам Google Fit за столько дней
         "climate_factor": round(climate * 100, 0),
         "temp": temp,
         "humidity": humidity,
@@ -1566,53 +1486,58 @@ async def api_ensure_user_examples(user_id: int):
     return JSONResponse(content={"ok": True})
 
 
-@app.get("/api/user/{user_id}/analytics", response_model=None)
-async def api_get_analytics(user_id: int, period: str = "month"):
-    """Получение аналитики пользователя. period: week (7 дн.), month (30 дн.), all (365 дн.)"""
-    from datetime import date, timedelta
+async def _analytics_data(user_id: int, period: str = "month") -> Dict[str, Any]:
+    """Аналитика пользователя за period (общая часть /analytics и /bootstrap)."""
     if period == "week":
         days = 7
     elif period == "all":
         days = 365
     else:
         days = 30  # month
-    try:
-        logger.info(f"Запрос аналитики для пользователя {user_id}, период={period}, days={days}")
-        analytics = await db.get_user_analytics(user_id, days=days)
-        chart_data = await db.get_habit_completions_by_date(user_id, days=days)
-        habit_streak = await db.get_habit_streak(user_id)
-
-        today = date.today()
-        labels_chart = [(today - timedelta(days=i)).isoformat() for i in range(days - 1, -1, -1)]
-        by_date = {r["date"]: r["completions"] for r in chart_data}
-        values_chart = [by_date.get(d, 0) for d in labels_chart]
-        
-        # Преобразуем все числа в float для JSON
-        result = {
-            "period": period,
-            "missions": {
-                "total": int(analytics.get("missions", {}).get("total", 0)),
-                "completed": int(analytics.get("missions", {}).get("completed", 0)),
-                "avg_progress": float(analytics.get("missions", {}).get("avg_progress", 0))
-            },
-            "goals": {
-                "total": int(analytics.get("goals", {}).get("total", 0)),
-                "completed": int(analytics.get("goals", {}).get("completed", 0)),
-                "completion_rate": float(analytics.get("goals", {}).get("completion_rate", 0))
-            },
-            "habits": {
-                "total": int(analytics.get("habits", {}).get("total", 0)),
-                "total_completions": int(analytics.get("habits", {}).get("total_completions", 0)),
-                "streak": int(habit_streak)
-            },
-            "habit_chart": {
-                "labels": labels_chart,
-                "values": values_chart
-            }
+    logger.info(f"Запрос аналитики для пользователя {user_id}, период={period}, days={days}")
+    analytics = await db.get_user_analytics(user_id, days=days)
+    chart_data = await db.get_habit_completions_by_date(user_id, days=days)
+    habit_streak = await db.get_habit_streak(user_id)
+
+    # Подписи — дни в поясе пользователя, как и даты отметок в habit_records
+    tz = (await db.get_user_timezones([user_id])).get(user_id) or DEFAULT_TIMEZONE
+    today = datetime.now(timezone.utc).astimezone(user_zone(tz)).date()
+    labels_chart = [(today - timedelta(days=i)).isoformat() for i in range(days - 1, -1, -1)]
+    by_date = {r["date"]: r["completions"] for r in chart_data}
+    values_chart = [by_date.get(d, 0) for d in labels_chart]
+
+    # Преобразуем все числа в float для JSON
+    result = {
+        "period": period,
+        "missions": {
+            "total": int(analytics.get("missions", {}).get("total", 0)),
+            "completed": int(analytics.get("missions", {}).get("completed", 0)),
+            "avg_progress": float(analytics.get("missions", {}).get("avg_progress", 0))
+        },
+        "goals": {
+            "total": int(analytics.get("goals", {}).get("total", 0)),
+            "completed": int(analytics.get("goals", {}).get("completed", 0)),
+            "completion_rate": float(analytics.get("goals", {}).get("completion_rate", 0))
+        },
+        "habits": {
+            "total": int(analytics.get("habits", {}).get("total", 0)),
+            "total_completions": int(analytics.get("habits", {}).get("total_completions", 0)),
+            "streak": int(habit_streak)
+        },
+        "habit_chart": {
+            "labels": labels_chart,
+            "values": values_chart
         }
-        
-        logger.info(f"Аналитика получена: {result}")
-        return JSONResponse(content=result)
+    }
+    logger.info(f"Аналитика получена: {result}")
+    return result
+
+
+@app.get("/api/user/{user_id}/analytics", response_model=None)
+async def api_get_analytics(user_id: int, period: str = "month"):
+    """Получение аналитики пользователя. period: week (7 дн.), month (30 дн.), all (365 дн.)"""
+    try:
+        return JSONResponse(content=await _analytics_data(user_id, period))
     except Exception as e:
         logger.error(f"Ошибка получения аналитики для пользователя {user_id}: {e}", exc_info=True)
         error_result = {
@@ -1624,51 +1549,125 @@ async def api_get_analytics(user_id: int, period: str = "month"):
         return JSONResponse(content=error_result)
 
 
+async def _achievements_data(user_id: int) -> Dict[str, Any]:
+    """Достижения по текущим привычкам и сохранённые (общая часть /achievements и /bootstrap)."""
+    out = []
+    habits = await db.get_habits_enriched(user_id)
+    for h in (habits or []):
+        hid = h.get("id")
+        total_completions = int(h.get("total_completions") or 0)
+        title = (h.get("title") or "").strip() or "Привычка"
+        out.append({
+            "habit_id": hid,
+            "title": title,
+            "streak": total_completions,
+            "achieved": total_completions >= 21,
+        })
+    saved = await db.get_user_achievements(user_id)
+    out.extend(saved)
+    return {"achievements": out}
+
+
 @app.get("/api/user/{user_id}/achievements", response_model=None)
 async def api_achievements(user_id: int):
     """Достижения: текущие привычки + сохранённые (привычки с 21+ повторениями, удалённые)."""
     try:
-        out = []
-        habits = await db.get_habits(user_id, active_only=False)
-        for h in (habits or []):
-            hid = h.get("id")
-            total_completions = await db.get_habit_total_completions(hid) if hid else 0
-            title = (h.get("title") or "").strip() or "Привычка"
-            out.append({
-                "habit_id": hid,
-                "title": title,
-                "streak": total_completions,
-                "achieved": total_completions >= 21,
-            })
-        saved = await db.get_user_achievements(user_id)
-        out.extend(saved)
-        return JSONResponse(content={"achievements": out})
+        return JSONResponse(content=await _achievements_data(user_id))
     except Exception as e:
         logger.exception("achievements: %s", e)
         return JSONResponse(content={"achievements": []})
 
 
+async def _achievement_check_data(user_id: int) -> Dict[str, Any]:
+    """Первая привычка с 21+ повторениями без уведомления: пометить и вернуть (общая часть с /bootstrap)."""
+    habits = await db.get_habits_enriched(user_id)
+    for h in (habits or []):
+        hid = h.get("id")
+        if not hid:
+            continue
+        total = int(h.get("total_completions") or 0)
+        notified = h.get("achievement_21_notified") or 0
+        if total >= 21 and not notified:
+            await db.set_habit_achievement_notified(hid)
+            title = (h.get("title") or "").strip() or "Привычка"
+            return {"ok": True, "achievement_unlocked": True, "habit_title": title}
+    return {"ok": True}
+
+
 @app.get("/api/user/{user_id}/achievement-check", response_model=None)
 async def api_achievement_check(user_id: int):
     """Проверка: если есть привычки с 21+ повторениями без уведомления — пометить и вернуть для показа в приложении."""
     try:
-        habits = await db.get_habits(user_id, active_only=False)
-        for h in (habits or []):
-            hid = h.get("id")
-            if not hid:
-                continue
-            total = await db.get_habit_total_completions(hid)
-            notified = h.get("achievement_21_notified") or 0
-            if total >= 21 and not notified:
-                await db.set_habit_achievement_notified(hid)
-                title = (h.get("title") or "").strip() or "Привычка"
-                return JSONResponse(content={"ok": True, "achievement_unlocked": True, "habit_title": title})
-        return JSONResponse(content={"ok": True})
+        return JSONResponse(content=await _achievement_check_data(user_id))
     except Exception as e:
         logger.warning("achievement-check: %s", e)
         return JSONResponse(content={"ok": False})
 
 
+async def _section(name: str, data, fallback):
+    """Данные секции bootstrap (корутина _*_data); при ошибке или None — fallback."""
+    try:
+        result = await data
+    except Exception as e:
+        logger.warning("bootstrap: секция %s не загружена: %s", name, e)
+        return fallback
+    return fallback if result is None else result
+
+
+@app.get("/api/user/{user_id}/bootstrap", response_model=None)
+async def api_bootstrap(user_id: int, analytics_period: str = "month", weight_period: str = "7"):
+    """
+    Всё, что мини-приложению нужно при открытии, одним ответом: проверка достижений, миссии
+    с подцелями, цели, привычки, аналитика, профиль, история веса, достижения и капсула времени.
+    Секции собираются параллельно по пулу соединений; подцели всех миссий — одним запросом.
+    Формат каждой секции совпадает с ответом соответствующего отдельного эндпоинта.
+    """
+    try:
+        await db.ensure_user_examples(user_id)
+    except Exception as e:
+        logger.warning("bootstrap: примеры не добавлены: %s", e)
+    empty_analytics = {
+        "period": analytics_period,
+        "missions": {"total": 0, "completed": 0, "avg_progress": 0.0},
+        "goals": {"total": 0, "completed": 0, "completion_rate": 0.0},
+        "habits": {"total": 0, "total_completions": 0, "streak": 0},
+        "habit_chart": {"labels": [], "values": []},
+    }
+    (
+        achievement_check, missions, goals, habits, analytics,
+        profile, weight_history, achievements, time_capsule,
+    ) = await asyncio.gather(
+        _section("achievement_check", _achievement_check_data(user_id), {"ok": False}),
+        _section("missions", _missions_data(user_id), []),
+        _section("goals", _goals_data(user_id), []),
+        _section("habits", _habits_data(user_id), []),
+        _section("analytics", _analytics_data(user_id, analytics_period), empty_analytics),
+        _section("profile", _profile_data(user_id), None),
+        _section("weight_history", _weight_history_data(user_id, weight_period), {"data": []}),
+        _section("achievements", _achievements_data(user_id), {"achievements": []}),
+        _section("time_capsule", _time_capsule_data(user_id), {"capsule": None, "can_edit": False}),
+    )
+    subgoals = {}
+    mission_ids = [m["id"] for m in missions if m.get("id") is not None]
+    try:
+        by_mission = await db.get_subgoals_for_missions(mission_ids)
+        subgoals = {str(mid): [_row_to_json(sg) for sg in rows] for mid, rows in by_mission.items()}
+    except Exception as e:
+        logger.warning("bootstrap: подцели не загружены: %s", e)
+    return JSONResponse(content={
+        "achievement_check": achievement_check,
+        "missions": missions,
+        "subgoals": subgoals,
+        "goals": goals,
+        "habits": habits,
+        "analytics": analytics,
+        "profile": profile,
+        "weight_history": weight_history,
+        "achievements": achievements,
+        "time_capsule": time_capsule,
+    })
+
+
 @app.get("/api/user/{user_id}/habit-last-7-days", response_model=None)
 async def api_habit_last_7_days(user_id: int):
     """Последние 7 дней (включая сегодня) для каждой привычки: + выполнено, - пропущено."""
@@ -1737,12 +1736,11 @@ def _parse_iso(s: Any) -> Optional[datetime]:
         return None
 
 
-@app.get("/api/user/{user_id}/time-capsule", response_model=None)
-async def api_get_time_capsule(user_id: int):
-    """Капсула времени: одна на пользователя. can_edit — можно ли редактировать (в течение часа после последнего редактирования)."""
+async def _time_capsule_data(user_id: int) -> Dict[str, Any]:
+    """Капсула времени пользователя и can_edit (общая часть /time-capsule и /bootstrap)."""
     cap = await db.get_time_capsule(user_id)
     if not cap:
-        return JSONResponse(content={"capsule": None, "can_edit": False})
+        return {"capsule": None, "can_edit": False}
     now = datetime.now()
     last = _parse_iso(cap.get("last_edited_at") or cap.get("created_at")) or now
     can_edit = (now - last).total_seconds() < 3600
@@ -1752,7 +1750,7 @@ async def api_get_time_capsule(user_id: int):
     open_at_s = str(open_at or "")
     if open_at_s and "Z" not in open_at_s and "+" not in open_at_s[-6:]:
         open_at_s = open_at_s + "Z"
-    return JSONResponse(content={
+    return {
         "capsule": {
             "title": cap.get("title") or "",
             "expected_result": cap.get("expected_result") or "",
@@ -1760,7 +1758,13 @@ async def api_get_time_capsule(user_id: int):
             "created_at": (cap.get("created_at").isoformat() if hasattr(cap.get("created_at"), "isoformat") else str(cap.get("created_at") or "")),
         },
         "can_edit": can_edit,
-    })
+    }
+
+
+@app.get("/api/user/{user_id}/time-capsule", response_model=None)
+async def api_get_time_capsule(user_id: int):
+    """Капсула времени: одна на пользователя. can_edit — можно ли редактировать (в течение часа после последнего редактирования)."""
+    return JSONResponse(content=await _time_capsule_data(user_id))
 
 
 _DEFAULT_CAPSULE_TITLE = "Через 30 дней привычек я надеюсь…"
@@ -1925,18 +1929,34 @@ def _is_stats_or_today_request(text: str) -> bool:
     return any(t in low for t in triggers)
 
 
-async def _build_stats_context_for_shaolen(db: Database, user_id: int, text: str) -> str:
+def _habits_day_streak(habits: list) -> int:
+    """
+    Серия дней подряд (считая сегодня) хотя бы с одной выполненной привычкой — по результату
+    get_habits_enriched: за последние 7 дней по last_7_days, дальше — по самой длинной текущей серии привычки.
+    """
+    run = 0
+    for i in range(7, 0, -1):
+        if not any((h.get("last_7_days") or [0] * 7)[i - 1] for h in habits):
+            break
+        run += 1
+    return max([run] + [int(h.get("streak") or 0) for h in habits])
+
+
+async def _build_stats_context_for_shaolen(db: Database, user_id: int, text: str, habits: list) -> str:
     """
     Если запрос про статистику/сегодня/неделю — возвращает блок для system-промпта
     с актуальными данными (сегодня отмеченные привычки, аналитика за 7 дней).
-    Иначе пустая строка.
+    habits — результат get_habits_enriched. Иначе пустая строка.
     """
     if not _is_stats_or_today_request(text):
         return ""
     try:
-        today_habits = await db.get_todays_habit_titles(user_id)
+        today_habits = sorted(
+            (h.get("title") or "").strip() for h in habits
+            if (h.get("last_7_days") or [0])[-1] and (h.get("title") or "").strip()
+        )
         analytics_7 = await db.get_user_analytics(user_id, days=7)
-        streak = await db.get_habit_streak(user_id)
+        streak = _habits_day_streak(habits)
         parts = [
             "Данные по запросу пользователя (ответь на его вопрос, опираясь на эти цифры):",
             "— Сегодня отмечены привычки: " + (", ".join(today_habits) if today_habits else "пока ни одной") + ".",
@@ -2236,13 +2256,13 @@ async def api_shaolen_ask(user_id: int, payload: ShaolenAsk):
 
     missions = await db.get_missions(user_id, include_completed=True)
     goals = await db.get_goals(user_id, include_completed=True)
-    habits = await db.get_habits(user_id, active_only=False)
+    habits = await db.get_habits_enriched(user_id, active_only=False)
     system_text = _build_shaolen_system_prompt(
         [dict(m) for m in missions],
         [dict(g) for g in goals],
-        [dict(h) for h in habits],
+        habits,
     )
-    stats_ctx = await _build_stats_context_for_shaolen(db, user_id, text)
+    stats_ctx = await _build_stats_context_for_shaolen(db, user_id, text, habits)
     if stats_ctx:
         system_text += "\n\n" + stats_ctx
     if has_image:
@@ -2401,6 +2421,19 @@ async def api_admin_status(request: Request):
     })
 
 
+@app.get("/api/admin/metrics")
+async def api_admin_metrics(request: Request):
+    """Счётчики процесса веб-сервера (с момента запуска)."""
+    if not _admin_token(request):
+        return JSONResponse(status_code=403, content=_admin_403_body())
+    return JSONResponse(content={
+        "user_upserts": {**user_upsert_stats, "cached_users": len(_seen_users)},
+        "http": http_pool.metrics(),
+        "google_tokens": google_tokens.metrics(),
+        "google_fit_steps": google_fit_steps.metrics(),
+    })
+
+
 @app.post("/api/admin/bot/start")
 async def api_admin_bot_start(request: Request):
     if not _admin_token(request):
@@ -2586,11 +2619,11 @@ async def api_admin_sync_telegram_names(request: Request):
         failed_ids = []
         for uid in user_ids:
             try:
-                async with httpx.AsyncClient(timeout=10.0) as client:
-                    r = await client.get(
-                        f"https://api.telegram.org/bot{BOT_TOKEN}/getChat",
-                        params={"chat_id": uid},
-                    )
+                client = http_pool.client("telegram")
+                r = await client.get(
+                    f"https://api.telegram.org/bot{BOT_TOKEN}/getChat",
+                    params={"chat_id": uid},
+                )
                 data = r.json()
                 if not data.get("ok"):
                     failed_ids.append(uid)
@@ -2599,13 +2632,7 @@ async def api_admin_sync_telegram_names(request: Request):
                 first_name = (chat.get("first_name") or "").strip() or None
                 last_name = (chat.get("last_name") or "").strip() or None
                 username = (chat.get("username") or "").strip() or None
-                async with aiosqlite.connect(db.db_path) as conn:
-                    await conn.execute(
-                        """UPDATE users SET first_name = ?, last_name = ?, username = ?
-                           WHERE user_id = ?""",
-                        (first_name, last_name, username, uid),
-                    )
-                    await conn.commit()
+                await db.set_user_telegram_names(uid, first_name, last_name, username)
                 updated += 1
                 await asyncio.sleep(0.05)
             except Exception as e:
@@ -2643,8 +2670,8 @@ async def api_admin_broadcast(request: Request):
         url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
         for uid in user_ids:
             try:
-                async with httpx.AsyncClient(timeout=15.0) as client:
-                    r = await client.post(url, json={"chat_id": uid, "text": text})
+                client = http_pool.client("telegram")
+                r = await client.post(url, json={"chat_id": uid, "text": text})
                 if r.status_code == 200 and (r.json() or {}).get("ok"):
                     sent += 1
                 else: